@@ -0,0 +1,229 @@
+"""Confound regressor matrices for FEAT, built in memory.
+
+The confounds file FEAT reads (confoundev_files) is a whitespace separated text
+matrix with one row per volume. `build_confounds` assembles its columns as one
+NumPy array, in the order
+  - dummy scan spikes: one column per dummy volume, 1 at that volume,
+  - motion parameters and their temporal derivatives, optionally with squares,
+  - extra columns, e.g. other regressors from the HCP Results directory,
+  - motion outlier spikes, one column per outlier volume,
+and `write_confounds` writes it in a single call.
+
+Motion outliers are found as fsl_motion_outliers does, without another FSL
+run: framewise displacement (FD) above a threshold, computed from the motion
+parameters, and DVARS above the boxplot upper fence, computed from the BOLD
+series in one streaming pass of volume blocks. Files are named after a hash
+of their inputs (`confounds_key`), so an existing file is reused rather than
+rebuilt.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from utils.feat_cache import cache_key, hash_file
+from utils.nifti_header import read_header
+from utils.nifti_stream import iter_volume_blocks
+from utils.zip_vfs import atomic_write
+
+log = logging.getLogger(__name__)
+
+# enough significant digits for motion parameters in mm and radians
+CONFOUND_FORMAT = "%.10g"
+
+# number of motion parameters (3 translations, 3 rotations)
+MOTION_PARAMS = 6
+
+# radius (mm) of the sphere rotations are projected onto for framewise displacement (Power et al. 2012)
+FD_RADIUS = 50.0
+
+
+def read_regressors(path: str) -> np.ndarray:
+    """Read a whitespace separated regressor file as an (nvols, n) float array."""
+    return np.loadtxt(path, ndmin=2)
+
+
+def motion_regressors(motion: np.ndarray, squares: bool = False) -> np.ndarray:
+    """
+    Motion confounds from motion parameters.
+    Args:
+        motion (ndarray): (nvols, 6) motion parameters, or (nvols, 12) parameters and derivatives as in HCP
+            Movement_Regressors.txt
+        squares (bool, optional): add the squares of the parameters and derivatives (24 regressors in all)
+
+    Returns:
+        regressors (ndarray): (nvols, 12) or (nvols, 24) array
+    """
+    if motion.shape[1] == MOTION_PARAMS:
+        # backward differences, 0 for the first volume
+        derivatives = np.vstack([np.zeros((1, MOTION_PARAMS)), np.diff(motion, axis=0)])
+        motion = np.hstack([motion, derivatives])
+
+    if squares:
+        motion = np.hstack([motion, motion ** 2])
+
+    return motion
+
+
+def dummy_spikes(nvols: int, dummy_scans: int) -> np.ndarray:
+    """(nvols, dummy_scans) spike regressors, one per initial dummy volume."""
+    return np.eye(nvols, dummy_scans)
+
+
+def framewise_displacement(motion: np.ndarray, radius: float = FD_RADIUS, degrees: bool = True) -> np.ndarray:
+    """
+    Framewise displacement: the sum of absolute volume to volume changes of the motion parameters, with rotations
+    converted to displacements on a sphere of `radius` mm.
+    Args:
+        motion (ndarray): (nvols, >= 6) motion parameters, translations (mm) then rotations, as in HCP
+            Movement_Regressors.txt
+        radius (float, optional): sphere radius in mm
+        degrees (bool, optional): rotations are in degrees (HCP) rather than radians
+
+    Returns:
+        fd (ndarray): (nvols,) displacement in mm, 0 for the first volume
+    """
+    deltas = np.abs(np.diff(motion[:, :MOTION_PARAMS], axis=0))
+    rotations = np.deg2rad(deltas[:, 3:]) if degrees else deltas[:, 3:]
+    return np.concatenate([[0.0], deltas[:, :3].sum(axis=1) + radius * rotations.sum(axis=1)])
+
+
+def dvars(path: str, block_vols: int, vfs=None, start: int = 0) -> np.ndarray:
+    """
+    DVARS: the root mean square over voxels of the volume to volume signal change, in one streaming pass. Voxels
+    are those finite and non-zero in volume `start`.
+    Args:
+        path (str): path to a 4D .nii or .nii.gz file
+        block_vols (int): maximum number of volumes per block, see nifti_stream.block_length
+        vfs (ZipVirtualFS, optional): read virtual paths from their archive
+        start (int, optional): first volume to include, e.g. after dummy scans
+
+    Returns:
+        dvars (ndarray): (nvols,) values, 0 up to and including volume `start`
+    """
+    values = np.zeros(read_header(path, vfs=vfs).nvols)
+    mask = None
+    previous = None
+    for t0, t1, block in iter_volume_blocks(path, block_vols, vfs=vfs, start=start):
+        if mask is None:
+            mask = np.isfinite(block[..., 0]) & (block[..., 0] != 0)
+        data = block[mask]
+        if previous is not None:
+            data = np.column_stack([previous, data])
+        changes = np.diff(data, axis=1)
+        values[t1 - changes.shape[1]:t1] = np.sqrt(np.mean(changes ** 2, axis=0))
+        previous = data[:, -1]
+
+    return values
+
+
+def boxplot_outliers(values: np.ndarray, start: int = 0) -> np.ndarray:
+    """Indices of values from `start` on above the boxplot upper fence, Q3 + 1.5 IQR. Non-finite values are left
+    out, and none are outliers."""
+    values = np.asarray(values[start:], dtype=float)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return np.zeros(0, dtype=int)
+    q1, q3 = np.percentile(values[finite], [25, 75])
+    return start + np.flatnonzero(finite & (values > q3 + 1.5 * (q3 - q1)))
+
+
+def outlier_spikes(nvols: int, volumes) -> np.ndarray:
+    """(nvols, n) spike regressors, one per outlier volume."""
+    volumes = np.asarray(sorted(volumes), dtype=int)
+    spikes = np.zeros((nvols, len(volumes)))
+    spikes[volumes, np.arange(len(volumes))] = 1
+    return spikes
+
+
+def build_confounds(nvols: int, motion=None, dummy_scans: int = 0, squares: bool = False, extra=(),
+                    spike_volumes=()) -> np.ndarray:
+    """
+    Assemble the confound matrix.
+    Args:
+        nvols (int): number of volumes of the functional series
+        motion (ndarray, optional): motion parameters, see motion_regressors
+        dummy_scans (int, optional): number of dummy scan spikes
+        squares (bool, optional): add squared motion regressors
+        extra (list of ndarray, optional): further (nvols, n) regressors, appended as they are
+        spike_volumes (list of int, optional): outlier volumes, each given a spike regressor (dummy scans are
+            skipped, they have their own)
+
+    Returns:
+        confounds (ndarray): (nvols, n) array
+
+    Raises:
+        ValueError: if a regressor does not have one row per volume
+    """
+    columns = []
+    if dummy_scans > 0:
+        columns.append(dummy_spikes(nvols, dummy_scans))
+    if motion is not None:
+        columns.append(motion_regressors(motion, squares=squares))
+    columns.extend(extra)
+    spike_volumes = sorted({int(volume) for volume in spike_volumes if volume >= dummy_scans})
+    if spike_volumes:
+        columns.append(outlier_spikes(nvols, spike_volumes))
+
+    for regressors in columns:
+        if regressors.shape[0] != nvols:
+            raise ValueError(f"Confound regressors have {regressors.shape[0]} rows, expected {nvols} (one per volume)")
+
+    return np.hstack(columns) if columns else np.zeros((nvols, 0))
+
+
+def write_confounds(confounds: np.ndarray, path: str):
+    """Write a confound matrix as text in one formatting pass, replacing `path` atomically."""
+    nvols, ncols = confounds.shape
+    row = " ".join([CONFOUND_FORMAT] * ncols) + "\n"
+
+    with atomic_write(path, "w") as fp:
+        fp.write((row * nvols) % tuple(confounds.ravel()))
+
+
+def confounds_key(nvols: int, motion_file=None, dummy_scans: int = 0, squares: bool = False, extra_files=(),
+                  spike_volumes=()) -> str:
+    """Hash the inputs of a confound matrix (file contents and options) into a short key."""
+    parts = {
+        "nvols": nvols,
+        "motion": hash_file(motion_file) if motion_file else None,
+        "dummy-scans": dummy_scans,
+        "squares": squares,
+        "extra": [hash_file(filename) for filename in extra_files],
+        "spikes": sorted(int(volume) for volume in spike_volumes),
+    }
+    return cache_key(parts)[:16]
+
+
+def confounds_file(outpath: str, nvols: int, motion_file=None, dummy_scans: int = 0, squares: bool = False,
+                   extra_files=(), spike_volumes=()) -> str:
+    """
+    Build and write the confound matrix, unless a file for the same inputs exists already.
+    Args:
+        outpath (str): directory to write to
+        nvols (int): number of volumes of the functional series
+        motion_file (str, optional): motion parameters file, e.g. Movement_Regressors.txt
+        dummy_scans (int, optional): number of dummy scan spikes
+        squares (bool, optional): add squared motion regressors
+        extra_files (list of str, optional): further regressor files, appended column wise
+        spike_volumes (list of int, optional): motion outlier volumes, see build_confounds
+
+    Returns:
+        filename (str): path of the confounds file, confounds-<key>.txt
+    """
+    key = confounds_key(nvols, motion_file, dummy_scans, squares, extra_files, spike_volumes)
+    filename = os.path.join(outpath, "confounds-" + key + ".txt")
+    if os.path.exists(filename):
+        log.info("Reusing confounds file %s", filename)
+        return filename
+
+    motion = read_regressors(motion_file) if motion_file else None
+    extra = [read_regressors(extra_file) for extra_file in extra_files]
+    confounds = build_confounds(nvols, motion=motion, dummy_scans=dummy_scans, squares=squares, extra=extra,
+                                spike_volumes=spike_volumes)
+
+    write_confounds(confounds, filename)
+    log.info("Wrote %d confound regressors to %s", confounds.shape[1], filename)
+
+    return filename
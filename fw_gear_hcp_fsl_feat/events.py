@@ -0,0 +1,263 @@
+"""Event file ingestion and conversion to FSL custom EV files.
+
+Events may be given as
+  - BIDS events.tsv: one event per row with onset, duration and trial_type,
+  - FSL custom 3 column files: rows of "onset duration weight", one EV per file,
+  - FSL custom 1 entry per volume files: one value per volume, one EV per file,
+  - a zip archive bundling any of the above.
+`read_events` sniffs the format of each file from its content, reads zip
+members straight from the archive, and normalizes everything into one EV
+table (see `EV_COLUMNS`). FEAT still reads EVs from files, so `write_ev`
+writes out only the EVs a design uses.
+
+A BIDS events.tsv is converted by grouping the table by trial_type in a single
+pass, see `bids_to_evs`.
+"""
+
+import io
+import logging
+import os
+import re
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# columns used as the EV weight (parametric modulation), in order of preference
+WEIGHT_COLUMNS = ["modulation", "amplitude"]
+
+# enough significant digits for onsets of long runs in seconds
+EV_FORMAT = "%.10g"
+
+# columns of the EV table: events file, EV name, format ("3col" or "1entry"), and the FSL columns. 1 entry per
+# volume EVs keep their value in weight, with onset and duration unset.
+EV_COLUMNS = ["source", "ev", "kind", "onset", "duration", "weight"]
+
+_NUMBER = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+
+def bids_to_evs(df: pd.DataFrame) -> "OrderedDict[str, np.ndarray]":
+    """
+    Split a BIDS events table into FSL 3 column EVs, one per trial_type.
+    Args:
+        df (DataFrame): events with onset, duration and trial_type columns, and optionally modulation or amplitude
+            (used as weight, default 1)
+
+    Returns:
+        evs (OrderedDict): (n, 3) float arrays of onset, duration, weight by trial_type, in order of first appearance
+    """
+    missing = [column for column in ["onset", "duration", "trial_type"] if column not in df.columns]
+    if missing:
+        raise ValueError(f"Events table is missing column(s): {', '.join(missing)}")
+
+    onset = pd.to_numeric(df["onset"], errors="coerce")
+    duration = pd.to_numeric(df["duration"], errors="coerce")
+
+    weight_column = next((column for column in WEIGHT_COLUMNS if column in df.columns), None)
+    if weight_column:
+        weight = pd.to_numeric(df[weight_column], errors="coerce").fillna(1.0)
+    else:
+        weight = pd.Series(1.0, index=df.index)
+
+    # events without onset or duration ("n/a") cannot be modelled
+    valid = onset.notna() & duration.notna() & df["trial_type"].notna()
+    if not valid.all():
+        log.warning("Dropping %d event(s) with n/a onset, duration or trial_type", int((~valid).sum()))
+
+    table = pd.DataFrame({"onset": onset, "duration": duration, "weight": weight})[valid]
+    table_values = table.to_numpy(dtype=float)
+    trial_types = df["trial_type"][valid].astype(str)
+
+    evs = OrderedDict()
+    for trial_type, rows in trial_types.groupby(trial_types, sort=False).indices.items():
+        evs[trial_type] = table_values[rows]
+
+    return evs
+
+
+def _first_row(text):
+    for line in text.splitlines():
+        if line.strip():
+            return line.split()
+    return []
+
+
+def _stem(name):
+    stem = os.path.basename(name)
+    for extension in [".tsv", ".txt", ".csv"]:
+        if stem.endswith(extension):
+            return stem[:-len(extension)]
+    return stem
+
+
+def sniff_bids(name, text):
+    row = _first_row(text)
+    return "onset" in row and "duration" in row
+
+
+def sniff_3col(name, text):
+    row = _first_row(text)
+    return len(row) == 3 and all(_NUMBER.match(value) for value in row)
+
+
+def sniff_1entry(name, text):
+    row = _first_row(text)
+    return len(row) == 1 and bool(_NUMBER.match(row[0]))
+
+
+def read_bids(name, text):
+    """Read a BIDS events.tsv into EV table rows, one EV per trial_type."""
+    df = pd.read_csv(io.StringIO(text), sep="\t")
+    if "trial_type" not in df.columns:
+        # a single condition, named after the file
+        df["trial_type"] = _stem(name)
+
+    frames = [
+        pd.DataFrame({"ev": trial_type, "kind": "3col", "onset": values[:, 0], "duration": values[:, 1],
+                      "weight": values[:, 2]})
+        for trial_type, values in bids_to_evs(df).items()
+    ]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=EV_COLUMNS[1:])
+
+
+def read_3col(name, text):
+    """Read an FSL custom 3 column file, a single EV named after the file."""
+    values = np.loadtxt(io.StringIO(text), ndmin=2)
+    return pd.DataFrame({"ev": _stem(name), "kind": "3col", "onset": values[:, 0], "duration": values[:, 1],
+                         "weight": values[:, 2]})
+
+
+def read_1entry(name, text):
+    """Read an FSL custom 1 entry per volume file, a single EV named after the file."""
+    values = np.loadtxt(io.StringIO(text), ndmin=1)
+    return pd.DataFrame({"ev": _stem(name), "kind": "1entry", "onset": np.nan, "duration": np.nan,
+                         "weight": values})
+
+
+# event file formats: name -> (sniffer, reader), tried in order. Sniffers take the file name and content and return
+# True if they recognize the format; readers return EV table rows (without the source column).
+EVENT_FORMATS = OrderedDict([
+    ("bids", (sniff_bids, read_bids)),
+    ("3col", (sniff_3col, read_3col)),
+    ("1entry", (sniff_1entry, read_1entry)),
+])
+
+
+def register_format(name, sniffer, reader):
+    """Add an event file format, tried before the built-in ones."""
+    EVENT_FORMATS[name] = (sniffer, reader)
+    EVENT_FORMATS.move_to_end(name, last=False)
+
+
+def sniff_format(name, text):
+    """
+    Detect the format of an event file from its content.
+    Args:
+        name (str): file name
+        text (str): file content
+
+    Returns:
+        format (str): key of EVENT_FORMATS
+
+    Raises:
+        ValueError: if no format matches
+    """
+    for event_format, (sniffer, _) in EVENT_FORMATS.items():
+        if sniffer(name, text):
+            return event_format
+    raise ValueError(f"Unrecognized event file format: {name}")
+
+
+def parse_events(name, text):
+    """Parse the content of one event file into EV table rows, see read_events."""
+    event_format = sniff_format(name, text)
+    table = EVENT_FORMATS[event_format][1](name, text)
+    log.info("Read %s as %s events: %d EV(s)", name, event_format, table["ev"].nunique())
+    table.insert(0, "source", os.path.basename(name))
+    return table
+
+
+def read_events(path, task=None):
+    """
+    Read an event file, or a zip archive of event files, into one EV table. Zip members are read from the archive
+    without extracting them.
+    Args:
+        path (str): event file or zip archive
+        task (str, optional): only read archive members with the task in their name, if any do
+
+    Returns:
+        table (DataFrame): EV table with EV_COLUMNS
+    """
+    if not zipfile.is_zipfile(path):
+        with open(path) as fp:
+            tables = [parse_events(os.path.basename(path), fp.read())]
+    else:
+        with zipfile.ZipFile(path, "r") as archive:
+            members = [info.filename for info in archive.infolist()
+                       if not info.is_dir() and not os.path.basename(info.filename).startswith(".")]
+            if task and any(task in os.path.basename(member) for member in members):
+                members = [member for member in members if task in os.path.basename(member)]
+
+            tables = []
+            for member in members:
+                with archive.open(member) as fp:
+                    tables.append(parse_events(member, io.TextIOWrapper(fp).read()))
+
+    if not tables:
+        return pd.DataFrame(columns=EV_COLUMNS)
+
+    table = pd.concat(tables, ignore_index=True)[EV_COLUMNS]
+    for column in ["source", "ev", "kind"]:
+        table[column] = table[column].astype("category")
+
+    return table
+
+
+def find_ev(table, title):
+    """
+    Select the EV for a design EV title: the EV of that name, else the only EV whose name contains the title.
+    Args:
+        table (DataFrame): EV table, see read_events
+        title (str): EV title from the design
+
+    Returns:
+        rows (DataFrame): rows of the EV, empty if there is no unique match
+    """
+    names = [name for name in table["ev"].unique() if name == title]
+    if not names:
+        names = [name for name in table["ev"].unique() if title in name]
+    if len(names) != 1:
+        return table.iloc[:0]
+
+    rows = table[table["ev"] == names[0]]
+    if rows["source"].nunique() > 1:
+        # the same EV from several event files (e.g. runs) is ambiguous for a single run design
+        return table.iloc[:0]
+
+    return rows
+
+
+def write_ev(rows, outpath):
+    """
+    Write one EV of the EV table to an FSL custom EV file, named <events file>-<ev>.txt, or <ev>.txt for an events
+    file holding only that EV.
+    Args:
+        rows (DataFrame): rows of a single EV, see find_ev
+        outpath (str): directory to write to
+
+    Returns:
+        filename (str): path of the EV file
+    """
+    os.makedirs(outpath, exist_ok=True)
+    source, ev, kind = rows.iloc[0][["source", "ev", "kind"]]
+    stem = _stem(str(source))
+    filename = os.path.join(outpath, (stem if stem == str(ev) else stem + "-" + str(ev)) + ".txt")
+
+    columns = ["onset", "duration", "weight"] if kind == "3col" else ["weight"]
+    with open(filename, "w") as fp:
+        np.savetxt(fp, rows[columns].to_numpy(dtype=float), fmt=EV_FORMAT, delimiter=" ")
+
+    return filename
@@ -0,0 +1,413 @@
+"""In-memory model of FSL FEAT design (.fsf) files.
+
+An FSF file is a Tcl script of `set KEY VALUE` lines, e.g.
+
+    set fmri(npts) 300
+    set feat_files(1) "/path/to/bold.nii.gz"
+
+`FsfDesign` parses the file once, keeps every line (comments included) in
+order, and indexes the settings by key. Settings are read and changed in
+memory and the design is written out once, so rendering a design costs a
+single pass over the template however many settings change. Lines that are
+not changed are written back exactly as read.
+
+`render_designs` renders one template for a whole table of sessions (a
+parameter sweep or a cohort), parsing the template once and collecting
+validation errors per session.
+"""
+
+import logging
+import os
+import re
+from collections import OrderedDict, namedtuple
+
+from utils.zip_vfs import atomic_write
+
+log = logging.getLogger(__name__)
+
+# result of rendering one row of bindings, see render_designs
+RenderedDesign = namedtuple("RenderedDesign", ["name", "design", "path", "errors"])
+
+# "set KEY VALUE" lines
+SETTING = re.compile(r"^\s*set\s+(\S+)\s+(.*?)\s*$")
+
+_INT = re.compile(r"^[+-]?\d+$")
+_FLOAT = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+
+def parse_value(text):
+    """Convert a value as written in an FSF file to str, int or float.
+
+    Quoted values are strings without their quotes, unquoted numbers are int
+    or float, and anything else is returned as written.
+    """
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return text[1:-1]
+    if _INT.match(text):
+        return int(text)
+    if _FLOAT.match(text):
+        return float(text)
+    return text
+
+
+def format_value(value):
+    """Convert a value to its FSF representation: strings are quoted, numbers are not."""
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value) + '"'
+
+
+class FsfDesign:
+    """Ordered, editable set of FSF design settings.
+
+    Settings are accessed by their full key, e.g. ``design["fmri(npts)"]``,
+    and are converted with `parse_value` / `format_value`. Setting a key that
+    is not in the file appends a new `set` line.
+
+    Example:
+        >>> design = FsfDesign.read("template.fsf")
+        >>> design["fmri(npts)"] = 300
+        >>> design.feat_files[1] = "/data/bold.nii.gz"
+        >>> design.write("design.fsf")
+    """
+
+    def __init__(self, lines=()):
+        """
+        Args:
+            lines (iterable of str): lines of an FSF file, with or without
+                their line endings
+        """
+        self._lines = [line.rstrip("\n") for line in lines]
+        self._index = OrderedDict()
+        for number, line in enumerate(self._lines):
+            match = SETTING.match(line)
+            if match:
+                self._index[match.group(1)] = number
+
+    @classmethod
+    def read(cls, filename):
+        """Parse an FSF file."""
+        with open(filename) as fp:
+            return cls(fp)
+
+    @classmethod
+    def from_text(cls, text):
+        """Parse the content of an FSF file."""
+        return cls(text.splitlines())
+
+    def copy(self):
+        """Return an independent copy of the design, without parsing it again."""
+        design = FsfDesign()
+        design._lines = list(self._lines)
+        design._index = OrderedDict(self._index)
+        return design
+
+    # ---- settings ---- #
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def raw(self, key, default=None):
+        """Return the value of a setting as written in the file."""
+        if key not in self._index:
+            return default
+        return SETTING.match(self._lines[self._index[key]]).group(2)
+
+    def __getitem__(self, key):
+        if key not in self._index:
+            raise KeyError(key)
+        return parse_value(self.raw(key))
+
+    def get(self, key, default=None):
+        """Return the value of a setting, see `parse_value`, or default if it is not set."""
+        return self[key] if key in self._index else default
+
+    def __setitem__(self, key, value):
+        line = "set " + key + " " + format_value(value)
+        if key in self._index:
+            self._lines[self._index[key]] = line
+        else:
+            self._index[key] = len(self._lines)
+            self._lines.append(line)
+
+    def update(self, settings):
+        """Set several settings at once."""
+        for key, value in settings.items():
+            self[key] = value
+
+    def settings(self):
+        """Return all settings as an OrderedDict of values as written, in file order."""
+        return OrderedDict((key, self.raw(key)) for key in self._index)
+
+    def diff(self, other, ignore=("fmri(outputdir)",)):
+        """Return the keys whose values differ from another design, in file order.
+
+        Args:
+            other (FsfDesign): design to compare with
+            ignore (iterable of str, optional): keys not to compare. Defaults
+                to the output directory.
+
+        Returns:
+            list of str: keys set differently or only in one of the designs
+        """
+        keys = list(self._index) + [key for key in other if key not in self._index]
+        return [key for key in keys if key not in ignore and self.raw(key) != other.raw(key)]
+
+    # ---- typed access ---- #
+
+    def _numbered(self, name):
+        return NumberedSettings(self, name)
+
+    @property
+    def fmri(self):
+        """Settings of the fmri(...) array, e.g. ``design.fmri["npts"]``."""
+        return self._numbered("fmri")
+
+    @property
+    def feat_files(self):
+        """Input files, ``design.feat_files[1]``."""
+        return self._numbered("feat_files")
+
+    @property
+    def confoundev_files(self):
+        """Confound EV files, ``design.confoundev_files[1]``."""
+        return self._numbered("confoundev_files")
+
+    @property
+    def custom(self):
+        """Custom EV timing files by EV number, ``design.custom[1]`` for fmri(custom1)."""
+        return NumberedSettings(self, "fmri", prefix="custom")
+
+    @property
+    def outputdir(self):
+        return self.get("fmri(outputdir)", "")
+
+    @outputdir.setter
+    def outputdir(self, value):
+        self["fmri(outputdir)"] = value
+
+    @property
+    def npts(self):
+        return self.get("fmri(npts)")
+
+    @npts.setter
+    def npts(self, value):
+        self["fmri(npts)"] = int(value)
+
+    @property
+    def level(self):
+        return self.get("fmri(level)", 1)
+
+    @property
+    def analysis(self):
+        """FEAT stages to run, bits 1: prestats, 2: stats, 4: post-stats."""
+        return self.get("fmri(analysis)", 7)
+
+    @property
+    def confoundevs(self):
+        return bool(self.get("fmri(confoundevs)", 0))
+
+    @property
+    def registration(self):
+        """True if any registration (initial highres, highres, standard) is switched on."""
+        return any(self.get("fmri(" + name + "_yn)", 0) for name in ["reginitial_highres", "reghighres", "regstandard"])
+
+    def ev_titles(self):
+        """Return the EV titles by EV number, in file order."""
+        titles = OrderedDict()
+        for key in self._index:
+            match = re.match(r"fmri\(evtitle(\d+)\)$", key)
+            if match:
+                titles[int(match.group(1))] = str(self[key])
+        return titles
+
+    # ---- validation ---- #
+
+    def validate(self, nvols=None, confounds_file=None):
+        """Check the design for inconsistencies.
+
+        Args:
+            nvols (int, optional): number of volumes of the functional input,
+                compared with fmri(npts)
+            confounds_file (str, optional): confounds file provided for the
+                analysis, if any, compared with fmri(confoundevs)
+
+        Returns:
+            list of str: problems found, empty if the design is consistent
+        """
+        errors = []
+
+        if nvols is not None and self.npts != nvols:
+            errors.append(f"fmri(npts) is {self.npts}, but the functional input has {nvols} volumes")
+
+        if not self.confoundevs and confounds_file:
+            errors.append("confounds file selected in gear options, but not set in FSF TEMPLATE")
+        elif self.confoundevs and not confounds_file:
+            errors.append("confounds file was not selected in gear options, but is set in FSF TEMPLATE")
+
+        for number in range(1, int(self.get("fmri(multiple)", 1)) + 1):
+            if not self.feat_files.get(number):
+                errors.append(f"feat_files({number}) is not set")
+
+        titles = self.ev_titles()
+        if "fmri(evs_orig)" in self and self["fmri(evs_orig)"] != len(titles):
+            errors.append(f"fmri(evs_orig) is {self['fmri(evs_orig)']}, but {len(titles)} EVs are titled")
+
+        for number in titles:
+            # shapes 2 (1 entry per volume) and 3 (3 column format) read a custom file
+            if self.fmri.get(f"shape{number}") in (2, 3) and not self.custom.get(number):
+                errors.append(f"fmri(custom{number}) is not set for EV {number} ({titles[number]})")
+
+        return errors
+
+    # ---- output ---- #
+
+    def to_text(self):
+        """Serialize the design."""
+        return "\n".join(self._lines) + "\n"
+
+    def write(self, filename):
+        """Write the design to a file, renaming it into place when complete."""
+        with atomic_write(filename, "w") as fp:
+            fp.write(self.to_text())
+
+
+class NumberedSettings:
+    """View of the settings of one FSF array, e.g. feat_files(N) or fmri(customN)."""
+
+    def __init__(self, design, name, prefix=""):
+        self._design = design
+        self._name = name
+        self._prefix = prefix
+
+    def _key(self, index):
+        return f"{self._name}({self._prefix}{index})"
+
+    def __contains__(self, index):
+        return self._key(index) in self._design
+
+    def __getitem__(self, index):
+        return self._design[self._key(index)]
+
+    def __setitem__(self, index, value):
+        self._design[self._key(index)] = value
+
+    def get(self, index, default=None):
+        return self._design.get(self._key(index), default)
+
+
+def render_design(template, func_file, npts, ev_files=None, confounds_file=None, outputdir=None, regstandard=None):
+    """Render a design for one session from a template.
+
+    Args:
+        template (FsfDesign): parsed template, left unchanged
+        func_file (str): functional input, feat_files(1)
+        npts (int): number of volumes of func_file, fmri(npts)
+        ev_files (dict, optional): custom EV timing file by EV number or EV
+            title, fmri(customN)
+        confounds_file (str, optional): confound EVs file, confoundev_files(1)
+        outputdir (str, optional): output directory, fmri(outputdir). Defaults
+            to the template's.
+        regstandard (str, optional): standard space image, fmri(regstandard)
+
+    Returns:
+        design (FsfDesign): the rendered design
+        errors (list of str): problems found, see `FsfDesign.validate`.
+            fmri(npts) is set from `npts` and not checked again.
+    """
+    design = template.copy()
+    errors = []
+
+    if outputdir:
+        design.outputdir = outputdir
+    design.feat_files[1] = func_file
+    design.npts = npts
+    if regstandard:
+        design.fmri["regstandard"] = regstandard
+    if confounds_file:
+        design.confoundev_files[1] = confounds_file
+
+    numbers = {title: number for number, title in design.ev_titles().items()}
+    for ev, filename in (ev_files or {}).items():
+        number = ev if isinstance(ev, int) else numbers.get(ev)
+        if number is None:
+            errors.append(f"No EV titled {ev} in the template")
+            continue
+        design.custom[number] = filename
+
+    errors.extend(design.validate(confounds_file=confounds_file))
+
+    return design, errors
+
+
+def render_designs(template, bindings, out_dir=None):
+    """Render one template for many sessions.
+
+    The template is parsed once. Each row of bindings gives the arguments of
+    `render_design` (func_file, npts, ev_files, confounds_file, outputdir,
+    regstandard) and a "name". EV files may also be given as "ev_<title>"
+    columns. Problems are collected per row instead of being logged as errors,
+    so one bad session does not fail the whole batch.
+
+    Example:
+        >>> rows = pd.DataFrame({"name": ["sub-01", "sub-02"], "func_file": [...], "npts": [300, 310],
+        ...                      "ev_lf": [...], "ev_rf": [...]})
+        >>> results = render_designs("template.fsf", rows, out_dir="designs")
+        >>> failed = {result.name: result.errors for result in results if result.errors}
+
+    Args:
+        template (str or FsfDesign): template file or parsed template
+        bindings (iterable of dict, or pandas.DataFrame): one row per session
+        out_dir (str, optional): write each design to <out_dir>/<name>.fsf.
+            Rows with errors are not written. Defaults to None, writing nothing.
+
+    Returns:
+        list of RenderedDesign: (name, design, path, errors) per row, in order
+    """
+    if not isinstance(template, FsfDesign):
+        template = FsfDesign.read(template)
+
+    if hasattr(bindings, "to_dict"):
+        bindings = bindings.to_dict("records")
+
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    results = []
+    for row_number, row in enumerate(bindings):
+        # empty cells of a table are None, "" or NaN
+        row = {key: value for key, value in row.items() if value is not None and value == value and value != ""}
+
+        name = str(row.get("name", row_number))
+        ev_files = dict(row.get("ev_files", {}))
+        ev_files.update({key[len("ev_"):]: value for key, value in row.items() if key.startswith("ev_") and key != "ev_files"})
+
+        try:
+            design, errors = render_design(
+                template,
+                row["func_file"],
+                int(row["npts"]),
+                ev_files=ev_files,
+                confounds_file=row.get("confounds_file"),
+                outputdir=row.get("outputdir"),
+                regstandard=row.get("regstandard"),
+            )
+        except (KeyError, TypeError, ValueError) as exc:
+            results.append(RenderedDesign(name, None, None, [f"Invalid bindings: {exc!r}"]))
+            continue
+
+        path = None
+        if out_dir and not errors:
+            path = os.path.join(out_dir, name + ".fsf")
+            design.write(path)
+        results.append(RenderedDesign(name, design, path, errors))
+
+    n_failed = sum(1 for result in results if result.errors)
+    log.info("Rendered %d designs, %d with errors", len(results), n_failed)
+
+    return results
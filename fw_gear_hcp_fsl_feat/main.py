@@ -4,25 +4,33 @@ import logging
 import os
 import os.path as op
 import glob
-from pathlib import Path
+import json
 from typing import List, Tuple
-import subprocess as sp
 import numpy as np
 import pandas as pd
 import sys
 import re
 import shutil
-import tempfile
 from collections import OrderedDict
-from zipfile import ZIP_DEFLATED, ZipFile
+from contextlib import ExitStack
 import errorhandler
 from typing import List, Tuple, Union
 import nibabel as nib
 import stat
 from flywheel_gear_toolkit.utils.zip_tools import zip_output
 
-from utils.command_line import exec_command
+from fw_gear_hcp_fsl_feat.confounds import boxplot_outliers, confounds_file, dvars, framewise_displacement, read_regressors
+from fw_gear_hcp_fsl_feat.events import EV_COLUMNS, find_ev, read_events, write_ev
+from fw_gear_hcp_fsl_feat.fsf import FsfDesign, render_design
+from utils.hcp_zip import extract_archives
+from utils.feat_cache import FeatCache, cache_key, hash_file, hash_zip_listing
 from utils.feat_html_singlefile import main as flathtml
+from utils.fly.set_performance_config import peak_rss_mb, set_mem_gb
+from utils.nifti_header import read_header
+from utils.nifti_stream import GB, NiftiStreamWriter, block_length, iter_volume_blocks, temporal_mean
+from utils.scheduler import JobScheduler, format_summary
+from utils.zip_stream import MEMBER_MODE, ParallelZipWriter, zip_tree
+from utils.zip_vfs import ZipVirtualFS
 
 log = logging.getLogger(__name__)
 
@@ -33,6 +41,31 @@ error_handler = errorhandler.ErrorHandler()
 stream_handler = logging.StreamHandler(stream=sys.stderr)
 log.addHandler(stream_handler)
 
+# design settings that only affect contrast estimation, thresholding and rendering
+CONTRAST_SETTINGS = re.compile(
+    r"fmri\((con_|conpic_|conname_|conmask|ncon_|ftest_|nftests_|thresh\)|prob_thresh|z_thresh|zdisplay|zmin|zmax"
+    r"|rendertype|bgimage|tsplot_yn)"
+)
+
+# model fit outputs that must be present to rerun only contrasts and post-stats
+REUSED_STATS = ["pe1.nii.gz", "res4d.nii.gz", "sigmasquareds.nii.gz", "dof"]
+
+# outputs of contrast estimation and post-stats, removed before they are redone
+STALE_POSTSTATS = [
+    "stats/cope*", "stats/varcope*", "stats/tstat*", "stats/zstat*", "stats/fstat*", "stats/zfstat*",
+    "thresh_*", "cluster_*", "rendered_thresh_*", "lmax_*", "tsplot", "report_poststats.html",
+    "report.html.zip", "index.html",
+]
+
+# digests of the files a FEAT model was fitted from, written to the .feat directory, see model_input_digests
+MODEL_INPUTS_FILE = "model-inputs.json"
+
+# peak memory of a FEAT run relative to its float32 functional series, see estimate_feat_mem_gb
+FEAT_MEM_FACTOR = 3
+
+# fmri(shapeN) for custom EVs by event file format (events.EV_COLUMNS "kind")
+EV_SHAPES = {"3col": 3, "1entry": 2}
+
 
 def prepare(
         gear_options: dict,
@@ -67,6 +100,10 @@ def prepare(
 def run(gear_options: dict, app_options: dict) -> int:
     """Run FSL-FEAT using HCPPipeline inputs.
 
+    One FEAT analysis is prepared for each task in app_options["tasks"] (batch mode if there are several), all from
+    the same unpacked session. The FEAT runs are executed concurrently within the gear_options["n_cpus"] and
+    gear_options["mem_gb"] budget.
+
     Arguments:
         gear_options: dict with gear-specific options
         app_options: dict with options for the BIDS-App
@@ -77,70 +114,501 @@ def run(gear_options: dict, app_options: dict) -> int:
 
     log.info("This is the beginning of the run file")
 
+    jobs = [prepare_task(gear_options, app_options, task) for task in get_tasks(app_options)]
+
+    if error_handler.fired:
+        log.critical('Failure: exiting with code 1 due to logged errors')
+        run_error = 1
+        return run_error
+
+    # skip FEAT runs whose results are cached from an earlier run with identical inputs
+    pending = [job for job in jobs if not restore_cached_feat(gear_options, job)]
+
+    # where an earlier run fitted the same model, rerun only contrasts and post-stats
+    for job in pending:
+        plan_incremental_feat(gear_options, job)
+
+    # FEAT needs the functional series on disk
+    if not gear_options["dry-run"]:
+        for job in pending:
+            get_vfs(gear_options).materialize(job["func_file"])
+
+    # This is what it is all about
+    run_error = run_feat_jobs(gear_options, pending) if pending else 0
+
+    if not gear_options["dry-run"]:
+
+        # a failed task does not stop the results of the others from being kept
+        succeeded = [job for job in jobs if not job.get("feat-failed")]
+
+        for job in pending:
+            if not job.get("feat-failed"):
+                record_model_inputs(gear_options, job)
+
+        for job in succeeded:
+            run_error = package_outputs(gear_options, job) or run_error
+
+        for job in pending:
+            if not job.get("feat-failed"):
+                store_cached_feat(gear_options, job)
+
+    else:
+        for job in jobs:
+            shutil.copy(job["design_file"], os.path.join(gear_options["output-dir"], job["output_prefix"] + "design.fsf"))
+
+    return run_error
+
+
+def get_tasks(app_options: dict) -> List[str]:
+    """Return the task names to analyze, a single task unless running in batch mode."""
+    return app_options.get("tasks") or [app_options["task-name"]]
+
+
+def prepare_task(gear_options: dict, app_options: dict, task: str) -> dict:
+    """
+    Prepare the inputs, confounds, events and design file for the FEAT analysis of one task.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+        task (str): task name, selecting the HCP Results directory and FSF template
+
+    Returns:
+        task_options (dict): copy of app_options for this task, including the FEAT command
+    """
+    batch = len(get_tasks(app_options)) > 1
+
+    task_options = dict(app_options)
+    task_options["task-name"] = task
+    task_options["batch"] = batch
+    task_options["funcpath"] = app_options.get("funcpaths", {}).get(task, app_options.get("funcpath"))
+    task_options["fsf_template"] = app_options.get("fsf_templates", {}).get(task, gear_options["FSF_TEMPLATE"])
+
+    # outputs of several tasks share work-dir and output-dir, so keep their names apart
+    task_options["output_prefix"] = task + "_" if batch else ""
+
+    log.info("Preparing FEAT analysis for task %s", task)
+
     # prepare inputs files (cp input files w/ correct names to workdir)
-    app_options = generate_input_files(gear_options, app_options)
+    task_options = generate_input_files(gear_options, task_options)
 
     # prepare confounds file
-    app_options = generate_confounds_file(gear_options, app_options)
+    task_options = generate_confounds_file(gear_options, task_options)
 
     # prepare events files
-    app_options = generate_event_files(gear_options, app_options)
+    task_options = generate_event_files(gear_options, task_options)
 
     # prepare fsf design file
-    app_options = generate_design_file(gear_options, app_options)
+    task_options = generate_design_file(gear_options, task_options)
+
+    # choose the .feat directory once, as FEAT would, adding "+" while it exists: a cache restore or an incremental
+    # run creates it, and a full FEAT run arrives at the same name
+    if task_options.get("feat_dir"):
+        while os.path.exists(task_options["feat_dir"]):
+            task_options["feat_dir"] = task_options["feat_dir"][:-len(".feat")] + "+.feat"
 
     # generate command
-    command = generate_command(gear_options, app_options)
+    task_options["command"] = generate_command(gear_options, task_options)
 
-    if error_handler.fired:
-        log.critical('Failure: exiting with code 1 due to logged errors')
-        run_error = 1
-        return run_error
+    return task_options
 
-    # This is what it is all about
-    stdout, stderr, run_error = exec_command(
-        command,
-        dry_run=gear_options["dry-run"],
-        shell=True,
-        cont_output=True,
-        cwd=gear_options["work-dir"]
+
+def run_feat_jobs(gear_options: dict, jobs: List[dict]) -> int:
+    """
+    Run the FEAT command of each prepared task through a local scheduler. A FEAT run is started as soon as a core
+    and its estimated memory are free within gear_options["n_cpus"] and gear_options["mem_gb"]. A task that only
+    reruns contrasts and post-stats (see plan_incremental_feat) runs its steps as jobs starting one after another.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        jobs (list): prepared task options, see prepare_task
+
+    Returns:
+        run_error (int): 0 if all FEAT runs succeeded. A task whose FEAT run (or any of its steps) failed is marked
+            with job["feat-failed"], the others are unaffected.
+    """
+    scheduler = JobScheduler(
+        gear_options.get("n_cpus") or 1,
+        gear_options.get("mem_gb") or set_mem_gb(None),
+        dry_run=gear_options["dry-run"]
     )
 
-    if not gear_options["dry-run"]:
+    for job in jobs:
+        mem_gb = estimate_feat_mem_gb(gear_options, job)
+        previous = []
+        for stage, command in job.get("stages") or [("", job["command"])]:
+            name = job["task-name"] + (":" + stage if stage else "")
+            scheduler.submit(
+                name,
+                command,
+                cpus=1,
+                mem_gb=mem_gb,
+                cwd=gear_options["work-dir"],
+                shell=True,
+                after=previous
+            )
+            previous = [name]
 
-        # move result feat directory to outputs
-        featdir = searchfiles(os.path.join(gear_options["work-dir"], "*.feat"))
+    results = scheduler.run()
+    log.info("FEAT summary:\n%s", format_summary(results))
 
-        # Create output directory
-        output_analysis_id_dir = os.path.join(gear_options["destination-id"], "sub-" + app_options["sid"], "ses-" + app_options["sesid"])
-        Path(os.path.join(gear_options["work-dir"], output_analysis_id_dir)).mkdir(parents=True, exist_ok=True)
+    failures = [result.name for result in results if result.returncode != 0]
+    failed_tasks = {name.split(":")[0] for name in failures}
+    for job in jobs:
+        job["feat-failed"] = job["task-name"] in failed_tasks
 
-        log.info("Using output path %s", os.path.join(output_analysis_id_dir, os.path.basename(featdir[0])))
+    if failures:
+        log.error("FEAT has failed for task(s): %s", ", ".join(failures))
+        return 1
 
-        shutil.copytree(featdir[0], os.path.join(gear_options["work-dir"], output_analysis_id_dir, os.path.basename(featdir[0])),dirs_exist_ok=True)
+    return 0
 
-        # flatten html to single file
-        flathtml(os.path.join(featdir[0], "report.html"))
 
-        # make copies of design.fsf and html outside featdir before zipping
-        inpath = os.path.join(featdir[0], "index.html")
-        outpath = os.path.join(featdir[0], "report.html.zip")
-        with ZipFile(outpath, "w", compression=ZIP_DEFLATED) as zf:
-            zf.write(inpath, os.path.basename(inpath))
+def estimate_feat_mem_gb(gear_options: dict, app_options: dict) -> float:
+    """
+    Estimate the peak memory of a FEAT run from the size of its functional series. film_gls holds the series as
+    float32 along with its residuals and prewhitened copy, so about FEAT_MEM_FACTOR times the float32 series size.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
 
-        shutil.copy(os.path.join(featdir[0], "report.html.zip"), os.path.join(gear_options["output-dir"], "report.html.zip"))
-        shutil.copy(os.path.join(featdir[0], "design.fsf"), os.path.join(gear_options["output-dir"], "design.fsf"))
+    Returns:
+        mem_gb (float): estimated memory in GiB
+    """
+    header = read_header(app_options["func_file"], vfs=get_vfs(gear_options))
+    float32_bytes = int(np.prod(header.shape, dtype=np.int64)) * 4
 
-        cmd = "zip -r " + os.path.join(gear_options["output-dir"], os.path.basename(featdir[0])) + ".zip " + gear_options["destination-id"]
-        execute_shell(cmd, dryrun=gear_options["dry-run"], cwd=gear_options["work-dir"])
+    return FEAT_MEM_FACTOR * float32_bytes / GB
 
-        cmd = "chmod -R a+rwx " + os.path.join(gear_options["output-dir"])
-        execute_shell(cmd, dryrun=gear_options["dry-run"], cwd=gear_options["output-dir"])
 
+def locate_feat_dir(gear_options: dict, app_options: dict) -> str:
+    """
+    Find the .feat directory written for a design. FEAT appends "+" to the name if the directory already exists,
+    so the most recent of those is returned.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        featdir (str): path to the .feat directory, empty if none was found
+    """
+    if app_options.get("feat_dir"):
+        base = app_options["feat_dir"][:-len(".feat")]
+        candidates = [path for path in searchfiles(base + "*.feat")
+                      if re.fullmatch(re.escape(base) + r"\+*\.feat", path)]
     else:
-        shutil.copy(app_options["design_file"], os.path.join(gear_options["output-dir"], "design.fsf"))
+        candidates = searchfiles(os.path.join(gear_options["work-dir"], "*.feat"))
 
-    return run_error
+    return max(candidates, key=len) if candidates else ""
+
+
+def package_outputs(gear_options: dict, app_options: dict) -> int:
+    """
+    Flatten the report of one task and stream its FEAT results into a zip in output-dir, under the sub-*/ses-*
+    output layout. The design file and the zipped flattened report are written to output-dir in the same pass.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        run_error (int): 0 on success
+    """
+    # move result feat directory to outputs
+    featdir = locate_feat_dir(gear_options, app_options)
+    if not featdir:
+        log.error("No FEAT output directory found for task %s", app_options["task-name"])
+        return 1
+
+    # flatten html to single file (already done if restored from the cache)
+    if not os.path.exists(os.path.join(featdir, "index.html")):
+        flathtml(os.path.join(featdir, "report.html"))
+
+    # archive layout <destination-id>/sub-*/ses-*/<name>.feat
+    arcprefix = "/".join([gear_options["destination-id"], "sub-" + app_options["sid"], "ses-" + app_options["sesid"],
+                          os.path.basename(featdir)])
+    feat_zip = os.path.join(gear_options["output-dir"], os.path.basename(featdir) + ".zip")
+    log.info("Using output path %s", arcprefix)
+
+    # design.fsf and the flattened report are written out from the same read as the .feat tree is zipped
+    prefix = app_options.get("output_prefix", "")
+    design_out = os.path.join(gear_options["output-dir"], prefix + "design.fsf")
+    report_out = os.path.join(gear_options["output-dir"], prefix + "report.html.zip")
+    compresslevel = gear_options.get("zip-compression-level")
+    with ExitStack() as stack:
+        tee = {}
+        if os.path.exists(os.path.join(featdir, "design.fsf")):
+            tee["design.fsf"] = [stack.enter_context(open(design_out, "wb"))]
+        else:
+            log.error("No design.fsf found in %s", featdir)
+
+        if os.path.exists(os.path.join(featdir, "index.html")):
+            report_zip = stack.enter_context(ParallelZipWriter(report_out, compresslevel=compresslevel))
+            tee["index.html"] = [stack.enter_context(report_zip.open("index.html"))]
+        else:
+            log.error("No flattened report (index.html) found in %s", featdir)
+
+        zip_tree(featdir, feat_zip, arcprefix, compresslevel=compresslevel, tee=tee, n_workers=gear_options["n_cpus"])
+
+    for filename in [design_out, report_out]:
+        if os.path.exists(filename):
+            os.chmod(filename, MEMBER_MODE)
+
+    return 0
+
+
+def get_feat_cache(gear_options: dict) -> Union[FeatCache, None]:
+    """Return the FEAT result cache, or None if no cache-dir is configured."""
+    if not gear_options.get("cache-dir"):
+        return None
+    if gear_options.get("feat_cache") is None:
+        gear_options["feat_cache"] = FeatCache(gear_options["cache-dir"], gear_options.get("cache-max-gb") or 50)
+    return gear_options["feat_cache"]
+
+
+def feat_cache_parts(gear_options: dict, app_options: dict) -> dict:
+    """
+    Describe everything the FEAT outputs of a task depend on: the input archives (by their member listing), the
+    events file, the rendered design file, the confound options and the FSL version.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        parts (dict): description to build the cache key from, see utils.feat_cache.cache_key
+    """
+    # the design refers to files in the work directory, which may differ between runs
+    with open(app_options["design_file"]) as fp:
+        design = fp.read().replace(str(gear_options["work-dir"]), "<work-dir>")
+
+    fslversion = os.path.join(os.environ.get("FSLDIR", ""), "etc", "fslversion")
+    if os.path.exists(fslversion):
+        with open(fslversion) as fp:
+            fslversion = fp.read().strip()
+    else:
+        fslversion = "unknown"
+
+    archives = ["hcpstruct_zipfile", "hcpfunc_zipfile", "icafix_functional_zip"]
+
+    return {
+        "inputs": {name: hash_zip_listing(gear_options[name]) for name in archives if gear_options.get(name)},
+        "event_files": hash_file(gear_options["event_files"]) if gear_options.get("event_files") else None,
+        "design": design,
+        "task-name": app_options["task-name"],
+        "motion-confound": app_options["motion-confound"],
+        "dummy-scans": app_options["dummy-scans"],
+        "motion-squares": app_options.get("motion-squares"),
+        "extra-confounds": app_options.get("extra-confounds"),
+        "fd-threshold": app_options.get("fd-threshold"),
+        "dvars-spikes": app_options.get("dvars-spikes"),
+        "fslversion": fslversion,
+    }
+
+
+def restore_cached_feat(gear_options: dict, app_options: dict) -> bool:
+    """
+    Look up the FEAT outputs of a task in the cache and restore its .feat directory on a hit.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        hit (bool): True if FEAT does not need to run for this task
+    """
+    cache = get_feat_cache(gear_options)
+    if cache is None or not app_options.get("feat_dir"):
+        return False
+
+    app_options["cache_parts"] = feat_cache_parts(gear_options, app_options)
+    app_options["cache_key"] = cache_key(app_options["cache_parts"])
+
+    if gear_options["dry-run"]:
+        hit = cache.lookup(app_options["cache_key"]) is not None
+        log.info("FEAT cache %s for task %s", "hit" if hit else "miss", app_options["task-name"])
+        return False
+
+    hit = cache.restore(app_options["cache_key"], app_options["feat_dir"])
+    log.info("FEAT cache %s for task %s", "hit" if hit else "miss", app_options["task-name"])
+    return hit
+
+
+def store_cached_feat(gear_options: dict, app_options: dict):
+    """Store the .feat directory of a finished task in the cache, if enabled."""
+    cache = get_feat_cache(gear_options)
+    featdir = locate_feat_dir(gear_options, app_options)
+    if cache is None or "cache_key" not in app_options or not featdir:
+        return
+
+    try:
+        cache.store(app_options["cache_key"], featdir, parts=app_options["cache_parts"])
+    except OSError as exc:
+        log.warning("Unable to cache FEAT outputs of task %s: %s", app_options["task-name"], exc)
+
+
+def find_prior_featdirs(gear_options: dict, app_options: dict) -> List[Tuple[str, dict]]:
+    """
+    Find .feat directories of earlier runs this task could build on: cached runs with identical inputs (see
+    feat_cache_parts), and the .feat directories of the previous-feat input.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        prior (list): (featdir, FsfDesign) of each candidate
+    """
+    prior = []
+
+    cache = get_feat_cache(gear_options)
+    if cache is not None and "cache_parts" in app_options:
+        parts = {key: value for key, value in app_options["cache_parts"].items() if key != "design"}
+        for key, cached_parts, featdir in cache.entries():
+            if {k: v for k, v in cached_parts.items() if k != "design"} == parts:
+                design = cached_parts.get("design", "").replace("<work-dir>", str(gear_options["work-dir"]))
+                prior.append((featdir, FsfDesign.from_text(design)))
+
+    if gear_options.get("previous_feat_zipfile"):
+        if "previous_featdirs" not in gear_options:
+            dest = os.path.join(gear_options["work-dir"], "previous-feat")
+            extract_archives([str(gear_options["previous_feat_zipfile"])], dest)
+            gear_options["previous_featdirs"] = sorted(
+                os.path.dirname(path) for path in glob.glob(os.path.join(dest, "**", "*.feat", "design.fsf"), recursive=True)
+            )
+        prior.extend((featdir, FsfDesign.read(os.path.join(featdir, "design.fsf")))
+                     for featdir in gear_options["previous_featdirs"])
+
+    return prior
+
+
+def plan_incremental_feat(gear_options: dict, app_options: dict) -> bool:
+    """
+    Compare the rendered design file with those of earlier runs. If one differs only in its contrast and threshold
+    settings, reuse its model fit (stats/pe*, res4d, ...) and rerun only contrast estimation and post-stats, see
+    generate_incremental_commands.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        incremental (bool): True if app_options["stages"] were set to an incremental run
+    """
+    if not app_options.get("feat_dir"):
+        return False
+
+    design = FsfDesign.read(app_options["design_file"])
+    digests = None
+    for featdir, prior_design in find_prior_featdirs(gear_options, app_options):
+        changed = prior_design.diff(design)
+        if any(not CONTRAST_SETTINGS.match(key) for key in changed):
+            log.debug("Cannot reuse %s, model settings differ: %s", featdir, changed)
+            continue
+        if not all(os.path.exists(os.path.join(featdir, "stats", name)) for name in REUSED_STATS):
+            log.debug("Cannot reuse %s, model fit outputs are missing", featdir)
+            continue
+        # the design names its inputs by path, which stays the same from run to run while their content may not
+        if digests is None:
+            digests = model_input_digests(gear_options, design)
+        if read_model_inputs(featdir) != digests:
+            log.info("Cannot reuse %s, its functional data, EV or confound files differ or were not recorded",
+                     featdir)
+            continue
+
+        log.info("Reusing the model fit of %s for task %s, changed settings: %s",
+                 featdir, app_options["task-name"], ", ".join(changed) or "none")
+        app_options["stages"] = generate_incremental_commands(gear_options, app_options, featdir)
+        return True
+
+    return False
+
+
+def model_input_digests(gear_options: dict, design: FsfDesign) -> dict:
+    """
+    Hash the files a design fits its model from: the functional input, the custom EV files and the confound EVs.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        design (FsfDesign): rendered design
+
+    Returns:
+        digests (dict): SHA-256 digest by design setting, None for a file that does not exist
+    """
+    paths = {"feat_files(1)": design.feat_files.get(1)}
+    for number in design.ev_titles():
+        if design.fmri.get(f"shape{number}") in (2, 3):
+            paths[f"fmri(custom{number})"] = design.custom.get(number)
+    if design.confoundevs:
+        paths["confoundev_files(1)"] = design.confoundev_files.get(1)
+
+    vfs = get_vfs(gear_options)
+    digests = {}
+    for key, path in paths.items():
+        # FEAT accepts images without their extension
+        candidates = [str(path) + extension for extension in ["", ".nii.gz", ".nii"]] if path else []
+        found = [name for name in candidates if vfs.is_virtual(name) or os.path.isfile(name)]
+        digests[key] = hash_file(found[0], opener=vfs.open) if found else None
+
+    return digests
+
+
+def read_model_inputs(featdir: str) -> dict:
+    """Return the model input digests recorded in a .feat directory, or None if there are none."""
+    try:
+        with open(os.path.join(featdir, MODEL_INPUTS_FILE)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def record_model_inputs(gear_options: dict, app_options: dict):
+    """Record the model input digests of a finished task in its .feat directory, so later runs can reuse its fit."""
+    featdir = locate_feat_dir(gear_options, app_options)
+    if not featdir:
+        return
+    digests = model_input_digests(gear_options, FsfDesign.read(app_options["design_file"]))
+    with open(os.path.join(featdir, MODEL_INPUTS_FILE), "w") as fp:
+        json.dump(digests, fp, indent=2, sort_keys=True)
+
+
+def generate_incremental_commands(gear_options: dict, app_options: dict, prior_featdir: str) -> List[Tuple[str, List[str]]]:
+    """
+    Set up the .feat directory from an earlier run with the same model, and build the commands that redo contrast
+    estimation and post-stats for the new design: feat_model, contrast_mgr, then FEAT's post-stats and report.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+        prior_featdir (str): .feat directory of the earlier run
+
+    Returns:
+        stages (list): (stage name, command) in the order they must run
+    """
+    # chosen by prepare_task, not created yet
+    featdir = app_options["feat_dir"]
+
+    if not gear_options["dry-run"]:
+        shutil.copytree(prior_featdir, featdir, symlinks=True)
+        for pattern in STALE_POSTSTATS:
+            for path in glob.glob(os.path.join(featdir, pattern)):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        shutil.copy(app_options["design_file"], os.path.join(featdir, "design.fsf"))
+
+    design = FsfDesign.read(app_options["design_file"])
+    in_featdir = ["cd", featdir, "&&"]
+
+    feat_model = in_featdir + ["feat_model", "design"]
+    if os.path.exists(os.path.join(prior_featdir, "confoundevs.txt")):
+        feat_model.append("confoundevs.txt")
+
+    contrast_mgr = in_featdir + ["contrast_mgr"]
+    if design.fmri.get("nftests_real", 0) > 0:
+        contrast_mgr += ["-f", "design.fts"]
+    contrast_mgr += ["stats", "design.con"]
+
+    common = [gear_options["feat"]["common_command"], os.path.join(featdir, "design.fsf"), "-D", featdir]
+
+    return [
+        ("model", feat_model),
+        ("contrasts", contrast_mgr),
+        ("poststats", common + ["-I", "1", "-poststats", "1"]),
+        ("stop", common + ["-stop"]),
+    ]
 
 
 def generate_confounds_file(gear_options: dict, app_options: dict):
@@ -157,55 +625,101 @@ def generate_confounds_file(gear_options: dict, app_options: dict):
 
     log.info("Building confounds file...")
 
-    if app_options["motion-confound"]:
-        motion_path = searchfiles(os.path.join(app_options["funcpath"], "Movement_Regressors.txt"))
-        log.info("Selected file for movement confounds: %s", str(motion_path))
-
-        app_options["confounds_file"] = motion_path[0]
-
-    if app_options["dummy-scans"] > 0:
+    motion_file = None
+    if app_options["motion-confound"] or (app_options.get("fd-threshold") or 0) > 0:
+        motion_path = searchfiles(os.path.join(app_options["funcpath"], "Movement_Regressors.txt"),
+                                  index=gear_options.get("path_index"))
+        if not motion_path:
+            log.error("Unable to locate Movement_Regressors.txt in %s", app_options["funcpath"])
+        else:
+            log.info("Selected file for movement confounds: %s", str(motion_path))
+            motion_file = motion_path[0]
+
+    extra_files = []
+    for name in [name for name in re.split(r"[,\s]+", app_options.get("extra-confounds") or "") if name]:
+        extra_path = searchfiles(os.path.join(app_options["funcpath"], name), index=gear_options.get("path_index"))
+        if not extra_path:
+            log.error("Unable to locate extra confounds file %s in %s", name, app_options["funcpath"])
+        else:
+            extra_files.append(extra_path[0])
 
+    dummy_scans = app_options["dummy-scans"] or 0
+    if dummy_scans > 0:
         # replace initial non-steady volumes with white noise
         app_options = replace_vols(gear_options, app_options)
 
+    # motion outlier (FD/DVARS) spikes
+    spike_volumes = find_motion_outliers(gear_options, app_options, motion_file, dummy_scans)
+
+    # the movement regressors may only be needed for framewise displacement
+    if not app_options["motion-confound"]:
+        motion_file = None
+
+    if motion_file and not (dummy_scans or extra_files or spike_volumes or app_options.get("motion-squares")):
+        # HCP movement regressors (parameters and derivatives) are used as they are
+        app_options["confounds_file"] = motion_file
+
+    elif motion_file or extra_files or spike_volumes or dummy_scans > 0:
         # get volume count from functional path
-        cmd = "fslnvols " + app_options["func_file"]
-        log.debug("\n %s", cmd)
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        nvols = int(stdout.strip("\n"))
-        dummy_scans = app_options["dummy-scans"]
-
-        arr = np.zeros([nvols, dummy_scans])
-
-        for idx in range(0, dummy_scans):
-            arr[idx][idx] = 1
-
-        pd.DataFrame(arr).to_csv(os.path.join(app_options["funcpath"], 'dummyvols-confounds.txt'), sep=" ", index=False,
-                                 header=False)
-
-        if app_options["motion-confound"]:
-            cmd = 'paste -d " " ' + os.path.join(app_options["funcpath"], 'dummyvols-confounds.txt') + ' ' + \
-                  motion_path[0] + ' > ' + os.path.join(app_options["funcpath"], 'movement-dummyvols-confounds.txt')
-            log.debug("\n %s", cmd)
-            terminal = sp.Popen(
-                cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
+        nvols = read_header(app_options["func_file"], vfs=get_vfs(gear_options)).nvols
+        try:
+            app_options["confounds_file"] = confounds_file(
+                app_options["funcpath"],
+                nvols,
+                motion_file=motion_file,
+                dummy_scans=dummy_scans,
+                squares=bool(app_options.get("motion-squares")),
+                extra_files=extra_files,
+                spike_volumes=spike_volumes,
             )
-            stdout, stderr = terminal.communicate()
-            log.debug("\n %s", stdout)
-            log.debug("\n %s", stderr)
+        except ValueError as exc:
+            log.error("Unable to build confounds file: %s", exc)
 
-            app_options["confounds_file"] = os.path.join(app_options["funcpath"], 'movement-dummyvols-confounds.txt')
+    return app_options
 
-        else:
-            app_options["confounds_file"] = os.path.join(app_options["funcpath"], 'dummyvols-confounds.txt')
 
-    return app_options
+def find_motion_outliers(gear_options: dict, app_options: dict, motion_file: str, dummy_scans: int) -> List[int]:
+    """
+    Find motion outlier volumes, as fsl_motion_outliers would, from config options "fd-threshold" (framewise
+    displacement in mm above which a volume is an outlier, 0 to disable) and "dvars-spikes" (DVARS above the boxplot
+    upper fence). Dummy scans are not considered.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+        motion_file (str): HCP Movement_Regressors.txt, or None
+        dummy_scans (int): number of initial dummy volumes
+
+    Returns:
+        volumes (list): outlier volume indices, sorted
+    """
+    volumes = set()
+
+    fd_threshold = app_options.get("fd-threshold") or 0
+    if fd_threshold > 0:
+        if not motion_file:
+            log.error("Framewise displacement spikes need Movement_Regressors.txt")
+        else:
+            fd = framewise_displacement(read_regressors(motion_file))
+            fd_outliers = dummy_scans + np.flatnonzero(fd[dummy_scans:] > fd_threshold)
+            log.info("%d volume(s) with framewise displacement above %g mm", len(fd_outliers), fd_threshold)
+            volumes.update(fd_outliers.tolist())
+
+    if app_options.get("dvars-spikes"):
+        vfs = get_vfs(gear_options)
+        header = read_header(app_options["func_file"], vfs=vfs)
+        max_bytes = int((gear_options.get("mem_gb") or set_mem_gb(0)) * GB)
+        values = dvars(app_options["func_file"], block_length(header, max_bytes), vfs=vfs, start=dummy_scans)
+        # the first volume after the dummy scans has no DVARS
+        nonfinite = int(np.sum(~np.isfinite(values[dummy_scans + 1:])))
+        if nonfinite and nonfinite == len(values[dummy_scans + 1:]):
+            log.error("DVARS is not finite for any volume of %s, no DVARS spikes added", app_options["func_file"])
+        elif nonfinite:
+            log.warning("DVARS is not finite for %d volume(s), they are not considered outliers", nonfinite)
+        dvars_outliers = boxplot_outliers(values, start=dummy_scans + 1)
+        log.info("%d volume(s) with DVARS outliers", len(dvars_outliers))
+        volumes.update(dvars_outliers.tolist())
+
+    return sorted(volumes)
 
 
 def generate_input_files(gear_options: dict, app_options: dict):
@@ -220,14 +734,22 @@ def generate_input_files(gear_options: dict, app_options: dict):
     Returns:
         app_options (dict): updated options for the app, from config.json
     """
+    vfs = get_vfs(gear_options)
+    index = gear_options.get("path_index")
     if app_options["icafix"]:
-        funcfile = searchfiles(os.path.join(app_options["funcpath"], "*clean.nii.gz"))
-        app_options["func_file"] = funcfile[0]
+        funcfile = searchfiles(os.path.join(app_options["funcpath"], "*clean.nii.gz"), vfs=vfs, index=index)
     else:
-        funcfile = searchfiles(os.path.join(app_options["funcpath"], "*_bold.nii.gz"))
-        app_options["func_file"] = funcfile[0]
+        funcfile = searchfiles(os.path.join(app_options["funcpath"], "*_bold.nii.gz"), vfs=vfs, index=index)
+
+    if not funcfile:
+        log.error("Unable to locate preprocessed functional file in %s", app_options["funcpath"])
+        funcfile = [""]
+    app_options["func_file"] = funcfile[0]
 
-    highresfile = searchfiles(os.path.join(app_options["structpath"], "T1w_restore_brain.nii.gz"))
+    highresfile = searchfiles(os.path.join(app_options["structpath"], "T1w_restore_brain.nii.gz"), vfs=vfs, index=index)
+    if not highresfile:
+        log.error("Unable to locate T1w_restore_brain.nii.gz in %s", app_options["structpath"])
+        highresfile = [""]
     app_options["highres_file"] = highresfile[0]
 
     return app_options
@@ -236,8 +758,9 @@ def generate_input_files(gear_options: dict, app_options: dict):
 def generate_event_files(gear_options: dict, app_options: dict):
     """
     Method used for all fsl-feat gear methods. Event file will be passed as (1) BIDS format, (2) 3-column custom format,
-     (3) 1-entry per volume format. Check first if events are pasted as zip (do nothing except unzip). If tsv BIDS
-     formatted, convert to 3-column custom format with standard naming convention.
+     (3) 1-entry per volume format, or a zip of these. The format of each file is detected from its content, zip
+     members are read in place, and all events are collected in one EV table (see events.read_events). EV files are
+     only written for the EVs the design uses, see generate_design_file.
 
     Args:
         gear_options (dict): options for the gear, from config.json
@@ -247,29 +770,13 @@ def generate_event_files(gear_options: dict, app_options: dict):
         app_options (dict): updated options for the app, from config.json
     """
 
-    # for now, assume evs are bids format tsvs.... update this!!!
-
-    outpath = os.path.join(app_options["funcpath"], "events")
-    os.makedirs(outpath, exist_ok=True)
-
-    evformat = "bids"
-    if evformat == "bids":
-        df = pd.read_csv(gear_options["event_files"], sep="\t")
-
-        groups = df["trial_type"].unique()
-
-        for g in groups:
-            ev = df[df["trial_type"] == g]
-            ev1 = ev.copy()
-            ev1.loc[:, "weight"] = pd.Series([1 for x in range(len(df.index))])
-
-            ev1 = ev1.drop(columns=["trial_type"])
+    try:
+        app_options["ev_table"] = read_events(gear_options["event_files"], task=app_options["task-name"])
+    except ValueError as exc:
+        log.error("Unable to read event files %s: %s", gear_options["event_files"], exc)
+        app_options["ev_table"] = pd.DataFrame(columns=EV_COLUMNS)
 
-            filename = os.path.join(outpath,
-                                    os.path.basename(gear_options["event_files"]).replace(".tsv", "-" + g + ".txt"))
-            ev1.to_csv(filename, sep=" ", index=False, header=False)
-
-    app_options["event_dir"] = outpath
+    app_options["event_dir"] = os.path.join(app_options["funcpath"], "events")
 
     return app_options
 
@@ -287,114 +794,179 @@ def generate_design_file(gear_options: dict, app_options: dict):
         app_options (dict): updated options for the app, from config.json
     """
 
-    design_file = os.path.join(gear_options["work-dir"], os.path.basename(gear_options["FSF_TEMPLATE"]))
+    fsf_template = app_options.get("fsf_template") or gear_options["FSF_TEMPLATE"]
+    design_file = os.path.join(gear_options["work-dir"], app_options.get("output_prefix", "") + os.path.basename(fsf_template))
     app_options["design_file"] = design_file
 
-    shutil.copy(gear_options["FSF_TEMPLATE"], design_file)
+    template = FsfDesign.read(fsf_template)
 
-    # add sed replace in template file for:
-    # 1. output name
-    if app_options["output-name"]:
-        replace_line(design_file, r'set fmri\(outputdir\)', 'set fmri(outputdir) "' + os.path.join(gear_options["work-dir"], os.path.basename(app_options["output-name"])) + '"')
+    # 1. output name (one per task in batch mode)
+    output_name = app_options["output-name"]
+    if app_options.get("batch"):
+        if not output_name:
+            output_name = os.path.basename(template.outputdir) or "feat"
+        output_name = re.sub(r"\.feat$", "", os.path.basename(output_name)) + "_" + app_options["task-name"]
 
-    # 2. func path
-    replace_line(design_file, r'set feat_files\(1\)', 'set feat_files(1) "' + app_options["func_file"] + '"')
+    outputdir = template.outputdir
+    if output_name:
+        outputdir = os.path.join(gear_options["work-dir"], os.path.basename(output_name))
 
-    # 3. total func length??
-    cmd = "fslnvols " + app_options["func_file"]
-    log.debug("\n %s", cmd)
-    terminal = sp.Popen(
-        cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-    )
-    stdout, stderr = terminal.communicate()
-    nvols = stdout.strip("\n")
-    replace_line(design_file, r'set fmri\(npts\)', 'set fmri(npts) ' + nvols)
+    if outputdir:
+        # relative output directories are created in the directory feat runs in
+        featdir = os.path.join(gear_options["work-dir"], outputdir)
+        app_options["feat_dir"] = featdir if featdir.endswith(".feat") else featdir + ".feat"
+
+    # 2. total func length (header only, read in place if not extracted)
+    nvols = read_header(app_options["func_file"], vfs=get_vfs(gear_options)).nvols
 
     # TODO check registration consistency
 
-    # 4. highres/standard -- don't use highres for HCPPipeline models!
-    stdname = locate_by_pattern(design_file, r'set fmri\(regstandard\) "(.*)"')
-    stdname = os.path.join(os.environ["FSLDIR"], "data", "standard", os.path.basename(stdname[0]))
-    replace_line(design_file, r'set fmri\(regstandard\) ', 'set fmri(regstandard) "' + stdname + '"')
+    # 3. highres/standard -- don't use highres for HCPPipeline models!
+    stdname = os.path.basename(template.fmri.get("regstandard", ""))
+    stdname = os.path.join(os.environ["FSLDIR"], "data", "standard", stdname)
 
-    # check confounds parser consistency...
-    confound_yn = locate_by_pattern(design_file, r'set fmri\(confoundevs\) (.*)')
-    if not confound_yn[0] and "confounds_file" in app_options:
-        log.critical("Error: confounds file selected in gear options, but not set in FSF TEMPLATE")
-    elif confound_yn[0] and "confounds_file" not in app_options:
-        log.critical("Error: confounds file was not selected in gear options, but is set in FSF TEMPLATE")
+    # 4. events - look up events by event name in design file, write only those used
+    ev_files = {}
+    ev_kinds = {}
+    for num, evname in template.ev_titles().items():
+        log.info("Located explanatory variable %s: %s", num, evname)
 
-    # 5. if confounds: confounds path
-    if "confounds_file" in app_options:
-        replace_line(design_file, r'set confoundev_files\(1\)',
-                     'set confoundev_files(1) "' + app_options["confounds_file"] + '"')
+        rows = find_ev(app_options["ev_table"], evname)
+        if rows.empty:
+            log.error("Problem locating event files programatically... check event names and re-run.")
+        else:
+            ev_files[num] = write_ev(rows, app_options["event_dir"])
+            ev_kinds[num] = rows["kind"].iloc[0]
+            log.info("Found match... EV %s: %s", evname, ev_files[num])
+
+    if ev_files:
+        app_options["ev_files"] = list(ev_files.values())
+
+    # all settings are changed in memory and the design written once, including func path and confounds path
+    design, errors = render_design(
+        template,
+        app_options["func_file"],
+        nvols,
+        ev_files=ev_files,
+        confounds_file=app_options.get("confounds_file"),
+        outputdir=outputdir,
+        regstandard=stdname,
+    )
 
-    # 6. events - find events by event name in desgin file
+    # custom EV shape follows the event file format
+    for num, kind in ev_kinds.items():
+        shape = EV_SHAPES[kind]
+        if design.fmri.get(f"shape{num}") in EV_SHAPES.values() and design.fmri.get(f"shape{num}") != shape:
+            log.info("Setting EV %s shape to %d for its %s event file", num, shape, kind)
+            design.fmri[f"shape{num}"] = shape
 
-    # locate all evtitle calls in template
-    ev_numbers = locate_by_pattern(design_file, r'set fmri\(evtitle(\d+)')
+    # check consistency, e.g. the confounds file and the EV timing files
+    for error in errors:
+        log.critical("Error: %s", error)
 
-    # for each ev, return name, find file pattern, it checks pass replace filename
-    allfiles = []
-    for num in ev_numbers:
-        name = locate_by_pattern(design_file, r'set fmri\(evtitle' + num + '\) "(.*)"')
-        evname = name[0]
+    design.write(design_file)
 
-        log.info("Located explanatory variable %s: %s", num, evname)
+    return app_options
 
-        evfiles = searchfiles(os.path.join(app_options["event_dir"], "*" + evname + "*"))
 
-        if len(evfiles) > 1 or evfiles[0] == '':
-            log.error("Problem locating event files programatically... check event names and re-run.")
-        else:
-            log.info("Found match... EV %s: %s", evname, evfiles[0])
-            replace_line(design_file, r'set fmri\(custom' + num + '\)',
-                         'set fmri(custom' + num + ') "' + evfiles[0] + '"')
-            allfiles.append(evfiles[0])
+def replace_vols(gear_options: dict, app_options: dict):
+    """
+    Replace the initial non-steady state ("dummy") volumes of the functional series with white noise about the
+    temporal mean of the remaining volumes. The series is processed in-process; a single "*_withnoise.nii.gz" image
+    is written next to the input. If the series does not fit in gear_options["mem_gb"], it is streamed in blocks of
+    volumes instead of being loaded at once.
+
+    This reproduces the former fslroi / fslmaths -Tmean / -sub / fslmerge / -add pipeline: dummy volumes are
+    mean + N(0, 1) noise, all other volumes keep their values. Output is float32; retained volumes match the input
+    to within float32 rounding (relative error below 1e-6), where the FSL pipeline also rounded through x - mean + mean.
+    The noise is seeded from the content of the input, so a rerun on the same series writes the same image and can
+    reuse an earlier model fit (see plan_incremental_feat).
+
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        app_options (dict): options for the app, from config.json
+
+    Returns:
+        app_options (dict): updated options for the app, from config.json
+    """
+    vfs = get_vfs(gear_options)
+    dummy_scans = app_options["dummy-scans"]
+    final_output = re.sub(r"\.nii(\.gz)?$", "_withnoise.nii.gz", app_options["func_file"])
+
+    log.info("Replacing %d dummy volumes with noise: %s", dummy_scans, final_output)
 
-    if allfiles:
-        app_options["ev_files"] = allfiles
+    header = read_header(app_options["func_file"], vfs=vfs)
+    max_bytes = int((gear_options.get("mem_gb") or set_mem_gb(0)) * GB)
+    img = vfs.load(app_options["func_file"])
+    seed = int(hash_file(app_options["func_file"], opener=vfs.open), 16) + dummy_scans
+
+    # raw data plus its float32 copy
+    if header.nbytes + header.nbytes * 32 // header.bitpix <= max_bytes:
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        fill_dummy_volumes(data, dummy_scans, rng=np.random.default_rng(seed))
+
+        out = nib.Nifti1Image(data, img.affine, img.header)
+        out.set_data_dtype(np.float32)
+        nib.save(out, final_output)
+    else:
+        block_vols = block_length(header, max_bytes)
+        log.info("Series (%.1f GiB) exceeds mem_gb, streaming %d volumes at a time", header.nbytes / GB, block_vols)
+
+        tmean = temporal_mean(app_options["func_file"], block_vols, vfs=vfs, start=dummy_scans)
+        rng = np.random.default_rng(seed)
+        with NiftiStreamWriter(final_output, img.header, header.shape) as writer:
+            for t0 in range(0, dummy_scans, block_vols):
+                writer.write(dummy_noise(tmean, min(block_vols, dummy_scans - t0), rng))
+            for t0, t1, block in iter_volume_blocks(app_options["func_file"], block_vols, vfs=vfs, start=dummy_scans):
+                writer.write(block)
+
+    log.info("Peak RSS after replacing dummy volumes: %.1f MiB", peak_rss_mb())
+
+    app_options["func_file"] = final_output
 
     return app_options
 
 
-def replace_vols(gear_options: dict, app_options: dict):
-    with tempfile.TemporaryDirectory(dir=gear_options["work-dir"]) as tmpdir:
-        # 1. create a noise image
-        img = nib.load(app_options["func_file"])
-        noise = np.random.randn(img.shape[0], img.shape[1], img.shape[2], app_options["dummy-scans"])
-        nim = nib.Nifti1Image(noise.astype('f'), img.affine, img.header)
-        noise_fname = os.path.join(tmpdir, 'noise.nii.gz')
-        nib.save(nim, noise_fname)
+def fill_dummy_volumes(data: np.ndarray, dummy_scans: int, rng=None) -> np.ndarray:
+    """
+    Overwrite the first `dummy_scans` volumes of a 4D float32 array, in place, with the temporal mean of the
+    remaining volumes plus standard normal noise.
+    Args:
+        data (np.ndarray): 4D series, modified in place
+        dummy_scans (int): number of leading volumes to replace
+        rng (np.random.Generator): random generator, a fresh one if not given
 
-        # 2. from orginal image, create a trimmed series
-        trim_fname = os.path.join(tmpdir, 'trimmed.nii.gz')
-        cmd = "fslroi " + app_options["func_file"] + " " + trim_fname + " " + str(app_options["dummy-scans"]) + " -1"
-        execute_shell(cmd, gear_options["dry-run"])
+    Returns:
+        data (np.ndarray): the same array
+    """
+    rng = rng or np.random.default_rng()
 
-        # 3. using trimmed file, compute temporal mean
-        tmean_fname = os.path.join(tmpdir, Path(app_options["func_file"]).name.replace(".nii.gz", "_meanfunc.nii.gz"))
-        cmd = "fslmaths " + trim_fname + " -Tmean " + tmean_fname
-        execute_shell(cmd, gear_options["dry-run"])
+    # accumulate in float64 so the mean of long series does not lose precision
+    tmean = data[..., dummy_scans:].mean(axis=-1, dtype=np.float64).astype(np.float32)
 
-        # 4 remove temporal mean from trimmed datset
-        demeaned_fname = os.path.join(tmpdir, 'trimmed_zerocenter.nii.gz')
-        cmd = "fslmaths " + trim_fname + " -sub " + tmean_fname + " " + demeaned_fname + " -odt float"
-        execute_shell(cmd, gear_options["dry-run"])
+    data[..., :dummy_scans] = dummy_noise(tmean, dummy_scans, rng)
 
-        # 5. concatenate adjusted noise model and trimmed timeseries
-        output_zerocenter = os.path.join(tmpdir, Path(app_options["func_file"]).name.replace(".nii.gz", "_withnoise.nii.gz"))
-        cmd = "fslmerge -t " + output_zerocenter + " " + noise_fname + " " + demeaned_fname
-        execute_shell(cmd, gear_options["dry-run"])
+    return data
 
-        # 6. add temporal mean back to adjusted dataset
-        final_output = app_options["func_file"].replace(".nii.gz", "_withnoise.nii.gz")
-        cmd = "fslmaths " + output_zerocenter + " -add " + tmean_fname + " " + final_output
-        execute_shell(cmd, gear_options["dry-run"])
 
-        app_options["func_file"] = app_options["func_file"].replace(".nii.gz", "_withnoise.nii.gz")
+def dummy_noise(tmean: np.ndarray, n_vols: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Draw `n_vols` noise volumes about a temporal mean, one volume at a time, so the same generator gives the same
+    volumes whether they are drawn at once or in blocks.
+    Args:
+        tmean (np.ndarray): 3D float32 temporal mean
+        n_vols (int): number of volumes
+        rng (np.random.Generator): random generator
 
-        return app_options
+    Returns:
+        noise (np.ndarray): 4D float32 array, (*tmean.shape, n_vols)
+    """
+    noise = np.empty(tmean.shape + (n_vols,), dtype=np.float32)
+    for t in range(n_vols):
+        noise[..., t] = rng.standard_normal(tmean.shape, dtype=np.float32)
+        noise[..., t] += tmean
+
+    return noise
 
 
 def generate_command(
@@ -420,108 +992,33 @@ def generate_command(
     return cmd
 
 
-def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
-    log.info("\n %s", cmd)
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd,
-            shell=True,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True,
-            cwd=cwd
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        return stdout
-
-
-def searchfiles(path, dryrun=False) -> list[str]:
-    cmd = "ls -d " + path
-
-    log.debug("\n %s", cmd)
-
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        files = stdout.strip("\n").split("\n")
-        return files
+def get_vfs(gear_options: dict) -> ZipVirtualFS:
+    """Return the virtual filesystem serving unextracted archive members."""
+    if gear_options.get("vfs") is None:
+        gear_options["vfs"] = ZipVirtualFS()
+    return gear_options["vfs"]
 
 
-def sed_inplace(filename, pattern, repl):
+def searchfiles(path, dryrun=False, vfs=None, index=None) -> List[str]:
     """
-    Perform the pure-Python equivalent of in-place `sed` substitution: e.g.,
-    `sed -i -e 's/'${pattern}'/'${repl}' "${filename}"`.
-    """
-    # For efficiency, precompile the passed regular expression.
-    pattern_compiled = re.compile(pattern)
-
-    # For portability, NamedTemporaryFile() defaults to mode "w+b" (i.e., binary
-    # writing with updating). This is usually a good thing. In this case,
-    # however, binary writing imposes non-trivial encoding constraints trivially
-    # resolved by switching to text writing. Let's do that.
-    with tempfile.NamedTemporaryFile(dir=os.getcwd(), mode='w', delete=False) as tmp_file:
-        with open(filename) as src_file:
-            for line in src_file:
-                tmp_file.write(pattern_compiled.sub(repl, line))
-
-    # Overwrite the original file with the munged temporary file in a
-    # manner preserving file attributes (e.g., permissions).
-    shutil.copystat(filename, tmp_file.name)
-    shutil.move(tmp_file.name, filename)
-
-
-def locate_by_pattern(filename, pattern):
-    """
-    Locates all instances that meet pattern and returns value from file.
+    Find all paths matching a shell-style glob pattern, in-process.
     Args:
-        filename: text file
-        pattern: regex
+        path: glob pattern, "**" matches any number of directories
+        dryrun: kept for compatibility, searching has no side effects
+        vfs (ZipVirtualFS): also match stored archive members that were not extracted
+        index (PathIndex): answer from a prebuilt index rather than the filesystem
 
     Returns:
-
+        files (list): sorted matching paths, empty if nothing matches
     """
-    # For efficiency, precompile the passed regular expression.
-    pattern_compiled = re.compile(pattern)
-    arr = []
-    with open(filename) as src_file:
-        for line in src_file:
-            num = re.findall(pattern_compiled, line)
-            if num:
-                arr.append(num[0])
-
-    return arr
-
-
-def replace_line(filename, pattern, repl):
-    """
-        Perform the pure-Python equivalent of in-place `sed` substitution: e.g.,
-        `sed -i -e 's/'${pattern}'/'${repl}' "${filename}"`.
-        """
-    # For efficiency, precompile the passed regular expression.
-    pattern_compiled = re.compile(pattern)
-
-    # For portability, NamedTemporaryFile() defaults to mode "w+b" (i.e., binary
-    # writing with updating). This is usually a good thing. In this case,
-    # however, binary writing imposes non-trivial encoding constraints trivially
-    # resolved by switching to text writing. Let's do that.
-    with tempfile.NamedTemporaryFile(dir=os.getcwd(), mode='w', delete=False) as tmp_file:
-        with open(filename) as src_file:
-            for line in src_file:
-                if re.findall(pattern_compiled, line):
-                    tmp_file.write(repl)
-                else:
-                    tmp_file.write(line)
+    if index is not None:
+        files = index.glob(path)
+    else:
+        files = glob.glob(path, recursive=True)
+        if vfs is not None:
+            files += vfs.glob(path)
+        files = sorted(set(files))
 
-    # Overwrite the original file with the munged temporary file in a
-    # manner preserving file attributes (e.g., permissions).
-    shutil.copystat(filename, tmp_file.name)
-    shutil.move(tmp_file.name, filename)
+    log.debug("Searched %s, found %d match(es): %s", path, len(files), files)
 
+    return files
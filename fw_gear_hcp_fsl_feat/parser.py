@@ -1,13 +1,17 @@
 """Parser module to parse gear config.json."""
 from typing import Tuple
-from zipfile import ZipFile
 from flywheel_gear_toolkit import GearToolkitContext
 import os
 import logging
 import glob
+import re
 import subprocess as sp
 from pathlib import Path
 from fw_gear_hcp_fsl_feat.main import searchfiles
+from utils.hcp_zip import extract_archives, hcp_manifest
+from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
+from utils.path_index import PathIndex
+from utils.zip_vfs import ZipVirtualFS
 
 log = logging.getLogger(__name__)
 
@@ -31,10 +35,18 @@ def parse_config(
         "client": gear_context.client,
         "environ": os.environ,
         "debug": gear_context.config.get("debug"),
+        "n_cpus": set_n_cpus(gear_context.config.get("n_cpus")),
+        "mem_gb": set_mem_gb(gear_context.config.get("mem_gb")),
         "hcpfunc_zipfile": gear_context.get_input_path("functional_zip"),
         "hcpstruct_zipfile": gear_context.get_input_path("structural_zip"),
         "event_files": gear_context.get_input_path("event-files"),
-        "FSF_TEMPLATE": gear_context.get_input_path("FSF_TEMPLATE")
+        "FSF_TEMPLATE": gear_context.get_input_path("FSF_TEMPLATE"),
+        "fsf_templates_zipfile": gear_context.get_input_path("fsf-templates"),
+        "previous_feat_zipfile": gear_context.get_input_path("previous-feat"),
+        "cache-dir": gear_context.config.get("cache-dir"),
+        "cache-max-gb": gear_context.config.get("cache-max-gb"),
+        "zip-compression-level": gear_context.config.get("zip-compression-level"),
+        "vfs": ZipVirtualFS()
     }
 
     # set the output dir name for the BIDS app:
@@ -47,10 +59,17 @@ def parse_config(
         "task-name",
         "output-name",
         "motion-confound",
-        "dummy-scans"
+        "dummy-scans",
+        "motion-squares",
+        "extra-confounds",
+        "fd-threshold",
+        "dvars-spikes"
     ]
     app_options = {key: gear_context.config.get(key) for key in app_options_keys}
 
+    # several tasks may be analyzed from one session (batch mode)
+    app_options["tasks"] = parse_task_names(app_options["task-name"])
+
     work_dir = gear_options["work-dir"]
     if work_dir:
         app_options["work-dir"] = work_dir
@@ -74,23 +93,50 @@ def parse_config(
         "params": ""
     }
 
-    # unzip HCPpipeline files
-    unzip_hcp(gear_options, gear_options["hcpstruct_zipfile"])
-    unzip_hcp(gear_options, gear_options["hcpfunc_zipfile"])
+    # unzip only the HCPpipeline files needed for this task
+    gear_options["unzip_patterns"] = hcp_manifest(
+        app_options["tasks"],
+        icafix=app_options["icafix"],
+        motion_confound=app_options["motion-confound"] or (app_options["fd-threshold"] or 0) > 0,
+        extra_files=[name for name in re.split(r"[,\s]+", app_options["extra-confounds"] or "") if name]
+    )
 
+    hcp_zipfiles = [gear_options["hcpstruct_zipfile"], gear_options["hcpfunc_zipfile"]]
     if app_options["icafix"]:
-        unzip_hcp(gear_options, gear_options["icafix_functional_zip"])
+        hcp_zipfiles.append(gear_options["icafix_functional_zip"])
+
+    unzip_hcp(gear_options, hcp_zipfiles)
 
-    funcpath = searchfiles(os.path.join(gear_options["work-dir"], "**", "MNINonLinear", "Results", "*"+app_options["task-name"]+"*"))
+    # index the extracted tree (and members served in place) once for all lookups
+    gear_options["path_index"] = PathIndex()
+    gear_options["path_index"].add_tree(gear_options["work-dir"])
+    gear_options["path_index"].update(gear_options["vfs"].paths())
 
-    if len(funcpath) > 1:
-        log.error("Task name not unique")
+    app_options["funcpaths"] = {}
+    for task in app_options["tasks"]:
+        funcpath = searchfiles(os.path.join(gear_options["work-dir"], "**", "MNINonLinear", "Results", "*"+task+"*"), index=gear_options["path_index"])
 
-    app_options["funcpath"] = funcpath[0]
+        if not funcpath:
+            log.error("No HCP Results directory found for task %s", task)
+            funcpath = [""]
+        elif len(funcpath) > 1:
+            log.error("Task name %s not unique", task)
 
-    structpath = searchfiles(os.path.join(gear_options["work-dir"], "**", "MNINonLinear", "T1w_restore_brain.nii.gz"))
+        app_options["funcpaths"][task] = funcpath[0]
+
+    app_options["funcpath"] = app_options["funcpaths"][app_options["tasks"][0]]
+
+    # select the fsf template for each task
+    app_options["fsf_templates"] = map_fsf_templates(
+        gear_options, app_options["tasks"], gear_context.config.get("fsf-template-map")
+    )
 
-    if len(structpath) > 1:
+    structpath = searchfiles(os.path.join(gear_options["work-dir"], "**", "MNINonLinear", "T1w_restore_brain.nii.gz"), index=gear_options["path_index"])
+
+    if not structpath:
+        log.error("No qualified structural image (T1w_restore_brain.nii.gz) present.")
+        structpath = [""]
+    elif len(structpath) > 1:
         log.error("More than one qualified structural image present... Not sure what to do.")
 
     app_options["structpath"] = os.path.dirname(structpath[0])
@@ -105,19 +151,99 @@ def parse_config(
     return gear_options, app_options
 
 
-def unzip_hcp(gear_options, zip_filename):
+def parse_task_names(task_name):
+    """
+    Split the task-name config option into task names, separated by commas or whitespace.
+    Args:
+        task_name (str): task-name config option
+
+    Returns:
+        tasks (list): task names, in the order given, without duplicates
+    """
+    tasks = [task for task in re.split(r"[,\s]+", task_name or "") if task]
+    if not tasks:
+        log.error("No task-name given.")
+        return [task_name or ""]
+
+    return list(dict.fromkeys(tasks))
+
+
+def map_fsf_templates(gear_options, tasks, template_map=None):
+    """
+    Select the FSF template for each task. Templates named in template_map ("TASK=FILE.fsf;...") are taken from the
+    fsf-templates archive, other tasks use the single archived template containing the task name, or FSF_TEMPLATE.
+    Args:
+        gear_options (dict): options for the gear, from config.json
+        tasks (list): task names
+        template_map (str): fsf-template-map config option
+
+    Returns:
+        fsf_templates (dict): path of the FSF template for each task
+    """
+    bundle = {}
+    if gear_options.get("fsf_templates_zipfile"):
+        dest = os.path.join(gear_options["work-dir"], "fsf_templates")
+        extract_archives([str(gear_options["fsf_templates_zipfile"])], dest, patterns=["*.fsf"])
+        bundle = {os.path.basename(path): path for path in glob.glob(os.path.join(dest, "**", "*.fsf"), recursive=True)}
+
+    mapping = {}
+    for entry in re.split(r"[;,]", template_map or ""):
+        if not entry.strip():
+            continue
+        task, _, filename = entry.partition("=")
+        mapping[task.strip()] = filename.strip()
+
+    fsf_templates = {}
+    for task in tasks:
+        if task in mapping:
+            if os.path.basename(mapping[task]) not in bundle:
+                log.error("FSF template %s for task %s not found in fsf-templates", mapping[task], task)
+                continue
+            fsf_templates[task] = bundle[os.path.basename(mapping[task])]
+        else:
+            matches = [path for name, path in bundle.items() if task in name]
+            if len(matches) == 1:
+                fsf_templates[task] = matches[0]
+            elif gear_options["FSF_TEMPLATE"]:
+                fsf_templates[task] = gear_options["FSF_TEMPLATE"]
+            else:
+                log.error("No FSF template found for task %s", task)
+                continue
+
+        log.info("Using FSF template for task %s: %s", task, fsf_templates[task])
+
+    unknown = set(mapping) - set(tasks)
+    if unknown:
+        log.warning("fsf-template-map lists tasks that are not analyzed: %s", ", ".join(sorted(unknown)))
+
+    return fsf_templates
+
+
+def unzip_hcp(gear_options, zip_filenames):
     """
     unzip_hcp unzips the contents of zipped gear output into the working
-    directory.  All of the files extracted are tracked from the
-    above process_hcp_zip.
+    directory.  Only members matching gear_options["unzip_patterns"] are
+    extracted, if set; otherwise the whole archive is extracted. Members of
+    all archives are extracted in parallel using gear_options["n_cpus"]
+    processes. Stored NIfTI members are not extracted but served in place
+    through gear_options["vfs"].
     Args:
         gear_options: The gear context object
             containing the 'gear_dict' dictionary attribute with key/value,
             'gear-dry-run': boolean to enact a dry run for debugging
-        zip_filename (string): The file to be unzipped
+        zip_filenames (string or list): The file(s) to be unzipped
     """
-    hcp_zip = ZipFile(zip_filename, "r")
-    log.info("Unzipping hcp outputs, %s", zip_filename)
-
-    hcp_zip.extractall(gear_options["work-dir"])
-    log.info(f'Unzipped the file to {gear_options["work-dir"]}')
+    if isinstance(zip_filenames, (str, Path)):
+        zip_filenames = [zip_filenames]
+    zip_filenames = [str(zip_filename) for zip_filename in zip_filenames]
+
+    log.info("Unzipping hcp outputs, %s", ", ".join(zip_filenames))
+
+    extract_archives(
+        zip_filenames,
+        gear_options["work-dir"],
+        patterns=gear_options.get("unzip_patterns"),
+        n_workers=gear_options.get("n_cpus", 1),
+        vfs=gear_options.get("vfs")
+    )
+    log.info(f'Unzipped the file(s) to {gear_options["work-dir"]}')
@@ -0,0 +1,34 @@
+"""Shared fixtures. The gear modules are imported from the repository root."""
+
+import os
+import struct
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_nifti(path, data, slope=None, inter=None):
+    """Save `data` as an uncompressed NIfTI-1 image, then set scl_slope/scl_inter in the file as given.
+
+    nibabel rewrites the scaling fields on save, so they are patched in place afterwards.
+    """
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_xyzt_units("mm", "sec")
+    img.header["pixdim"][4] = 2.0
+    nib.save(img, str(path))
+    if slope is not None or inter is not None:
+        with open(path, "r+b") as fp:
+            fp.seek(112)
+            fp.write(struct.pack("<ff", np.nan if slope is None else slope, 0.0 if inter is None else inter))
+    return str(path)
+
+
+@pytest.fixture
+def series():
+    """A small int16 4D series, (4, 3, 2, 10)."""
+    rng = np.random.default_rng(0)
+    return rng.integers(-100, 1000, size=(4, 3, 2, 10)).astype(np.int16)
@@ -0,0 +1,89 @@
+import logging
+import os
+import shutil
+import zipfile
+
+import pandas as pd
+
+from fw_gear_hcp_fsl_feat.events import EV_COLUMNS
+from fw_gear_hcp_fsl_feat.main import generate_design_file, package_outputs
+from fw_gear_hcp_fsl_feat.parser import map_fsf_templates, parse_task_names
+from tests.conftest import write_nifti
+from utils.zip_vfs import ZipVirtualFS
+
+TEMPLATE = """set fmri(level) 1
+set fmri(outputdir) "glm"
+set fmri(npts) 10
+set fmri(regstandard) "/usr/local/fsl/data/standard/MNI152_T1_2mm_brain"
+set fmri(confoundevs) 0
+set feat_files(1) ""
+set fmri(evs_orig) 0
+"""
+
+
+def test_parse_task_names():
+    assert parse_task_names("MOTOR") == ["MOTOR"]
+    assert parse_task_names("MOTOR, LANGUAGE\tWM,,MOTOR") == ["MOTOR", "LANGUAGE", "WM"]
+
+
+def test_map_fsf_templates(tmp_path, caplog):
+    bundle = str(tmp_path / "templates.zip")
+    with zipfile.ZipFile(bundle, "w") as zf:
+        for name in ["motor_glm.fsf", "language.fsf", "wm_0back.fsf", "wm_2back.fsf"]:
+            zf.writestr("templates/" + name, TEMPLATE)
+    gear_options = {"fsf_templates_zipfile": bundle, "work-dir": str(tmp_path / "work"), "FSF_TEMPLATE": "default.fsf"}
+    dest = str(tmp_path / "work" / "fsf_templates" / "templates")
+
+    with caplog.at_level(logging.INFO):
+        templates = map_fsf_templates(gear_options, ["motor", "language", "wm", "gambling"],
+                                      "motor=motor_glm.fsf; language=missing.fsf; relational=wm_0back.fsf")
+
+    assert templates == {
+        # mapped explicitly
+        "motor": os.path.join(dest, "motor_glm.fsf"),
+        # the single template containing the task name, or the default one
+        "wm": "default.fsf",
+        "gambling": "default.fsf",
+    }
+    errors = [record.getMessage() for record in caplog.records if record.levelno >= logging.ERROR]
+    assert errors == ["FSF template missing.fsf for task language not found in fsf-templates"]
+    warnings = [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+    assert warnings == ["fsf-template-map lists tasks that are not analyzed: relational"]
+
+
+def test_tasks_of_a_batch_keep_their_outputs_apart(tmp_path, monkeypatch, series):
+    monkeypatch.setenv("FSLDIR", "/usr/local/fsl")
+    (tmp_path / "work").mkdir()
+    (tmp_path / "output").mkdir()
+    template = tmp_path / "glm.fsf"
+    template.write_text(TEMPLATE)
+    gear_options = {"work-dir": str(tmp_path / "work"), "output-dir": str(tmp_path / "output"),
+                    "destination-id": "dest", "n_cpus": 1, "FSF_TEMPLATE": str(template), "vfs": ZipVirtualFS()}
+
+    for task in ["motor", "language"]:
+        # as prepared by prepare_task
+        app_options = {"task-name": task, "batch": True, "output_prefix": task + "_", "output-name": "",
+                       "fsf_template": str(template), "func_file": write_nifti(tmp_path / (task + ".nii"), series),
+                       "ev_table": pd.DataFrame(columns=EV_COLUMNS), "event_dir": str(tmp_path / "events"),
+                       "sid": "01", "sesid": "A"}
+        generate_design_file(gear_options, app_options)
+
+        assert app_options["design_file"] == str(tmp_path / "work" / (task + "_glm.fsf"))
+        assert app_options["feat_dir"] == str(tmp_path / "work" / ("glm_" + task + ".feat"))
+
+        # stand-in for the FEAT run
+        os.mkdir(app_options["feat_dir"])
+        shutil.copy(app_options["design_file"], os.path.join(app_options["feat_dir"], "design.fsf"))
+        with open(os.path.join(app_options["feat_dir"], "index.html"), "w") as fp:
+            fp.write("<html>" + task + "</html>")
+
+        assert package_outputs(gear_options, app_options) == 0
+
+    assert sorted(os.listdir(str(tmp_path / "output"))) == [
+        "glm_language.feat.zip", "glm_motor.feat.zip",
+        "language_design.fsf", "language_report.html.zip",
+        "motor_design.fsf", "motor_report.html.zip",
+    ]
+    for task in ["motor", "language"]:
+        with zipfile.ZipFile(str(tmp_path / "output" / (task + "_report.html.zip"))) as zf:
+            assert zf.read("index.html") == ("<html>" + task + "</html>").encode()
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from fw_gear_hcp_fsl_feat.confounds import (
+    boxplot_outliers,
+    build_confounds,
+    confounds_file,
+    dvars,
+    framewise_displacement,
+    motion_regressors,
+    read_regressors,
+)
+from tests.conftest import write_nifti
+
+
+def test_framewise_displacement():
+    motion = np.zeros((3, 6))
+    motion[1] = [1, -1, 0, 0, 0, 0]
+    motion[2] = [1, -1, 0, np.rad2deg(0.01), 0, 0]
+
+    fd = framewise_displacement(motion)
+
+    np.testing.assert_allclose(fd, [0.0, 2.0, 50 * 0.01])
+    radians = motion.copy()
+    radians[:, 3:] = np.deg2rad(radians[:, 3:])
+    np.testing.assert_allclose(framewise_displacement(radians, degrees=False), fd)
+
+
+def test_motion_regressors_derivatives_and_squares():
+    motion = np.arange(18, dtype=float).reshape(3, 6)
+
+    regressors = motion_regressors(motion, squares=True)
+
+    assert regressors.shape == (3, 24)
+    np.testing.assert_array_equal(regressors[:, 6:12], [[0] * 6, [6] * 6, [6] * 6])
+    np.testing.assert_array_equal(regressors[:, 12:], regressors[:, :12] ** 2)
+
+
+def test_build_confounds_column_order():
+    nvols = 6
+    motion = np.ones((nvols, 12))
+    extra = [np.full((nvols, 2), 7.0)]
+
+    confounds = build_confounds(nvols, motion=motion, dummy_scans=2, extra=extra, spike_volumes=[4, 1, 4])
+
+    # 2 dummy spikes, 12 motion, 2 extra, 1 outlier spike (volume 1 is a dummy scan)
+    assert confounds.shape == (nvols, 17)
+    np.testing.assert_array_equal(confounds[:, :2], np.eye(nvols, 2))
+    np.testing.assert_array_equal(confounds[:, 2:14], motion)
+    np.testing.assert_array_equal(confounds[:, 14:16], 7.0)
+    np.testing.assert_array_equal(confounds[:, 16], [0, 0, 0, 0, 1, 0])
+
+
+def test_build_confounds_row_mismatch():
+    with pytest.raises(ValueError):
+        build_confounds(5, motion=np.zeros((4, 12)))
+
+
+def test_confounds_file_round_trip_and_reuse(tmp_path):
+    motion_file = tmp_path / "Movement_Regressors.txt"
+    np.savetxt(motion_file, np.random.default_rng(0).normal(size=(5, 12)))
+
+    filename = confounds_file(str(tmp_path), 5, motion_file=str(motion_file), dummy_scans=1)
+
+    np.testing.assert_allclose(read_regressors(filename), build_confounds(5, read_regressors(str(motion_file)), 1))
+    assert confounds_file(str(tmp_path), 5, motion_file=str(motion_file), dummy_scans=1) == filename
+    assert confounds_file(str(tmp_path), 5, motion_file=str(motion_file), dummy_scans=2) != filename
+
+
+def test_boxplot_outliers():
+    values = np.array([0.0, 1, 1, 1, 1, 1.1, 0.9, 10])
+
+    np.testing.assert_array_equal(boxplot_outliers(values, start=1), [7])
+
+
+def test_boxplot_outliers_ignores_non_finite():
+    values = np.array([0.0, 1, 1, np.nan, 1, 1.1, 0.9, 10, np.inf])
+
+    np.testing.assert_array_equal(boxplot_outliers(values, start=1), [7])
+    assert len(boxplot_outliers(np.full(5, np.nan))) == 0
+
+
+def direct_dvars(data, start=0):
+    mask = data[..., start] != 0
+    diffs = np.diff(data[mask][:, start:], axis=1)
+    return np.concatenate([np.zeros(start + 1), np.sqrt(np.mean(diffs ** 2, axis=0))])
+
+
+@pytest.mark.parametrize("block_vols", [1, 3, 10])
+def test_dvars_matches_direct_computation(tmp_path, series, block_vols):
+    path = write_nifti(tmp_path / "bold.nii", series)
+
+    np.testing.assert_allclose(dvars(path, block_vols, start=2), direct_dvars(series.astype(float), start=2),
+                               rtol=1e-5)
+
+
+def test_dvars_nan_slope_is_finite(tmp_path, series):
+    path = write_nifti(tmp_path / "bold.nii", series, slope=np.nan, inter=np.nan)
+
+    values = dvars(path, 4)
+
+    assert np.all(np.isfinite(values))
+    np.testing.assert_allclose(values, direct_dvars(series.astype(float)), rtol=1e-5)
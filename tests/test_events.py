@@ -0,0 +1,85 @@
+import zipfile
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fw_gear_hcp_fsl_feat.events import EV_COLUMNS, bids_to_evs, find_ev, read_events, sniff_format, write_ev
+
+BIDS = "onset\tduration\ttrial_type\tmodulation\n0\t1.5\trf\t1\n3\t1.5\tlf\tn/a\n6\t1.5\trf\t2\nn/a\t1\tlf\t1\n"
+
+
+@pytest.mark.parametrize(
+    "name, text, expected",
+    [
+        ("sub-01_task-motor_events.tsv", BIDS, "bids"),
+        ("lf.txt", "\n0 1.5 1\n3 1.5 1\n", "3col"),
+        ("lf.txt", "1.5e1\t2\t-1\n", "3col"),
+        ("reg.txt", "0.5\n1\n", "1entry"),
+    ],
+)
+def test_sniff_format(name, text, expected):
+    assert sniff_format(name, text) == expected
+
+
+def test_sniff_format_unknown():
+    with pytest.raises(ValueError):
+        sniff_format("notes.txt", "some notes\n")
+
+
+def test_bids_to_evs():
+    evs = bids_to_evs(pd.read_csv(StringIO(BIDS), sep="\t"))
+
+    assert list(evs) == ["rf", "lf"]
+    np.testing.assert_array_equal(evs["rf"], [[0, 1.5, 1], [6, 1.5, 2]])
+    # modulation n/a defaults to 1, onset n/a is dropped
+    np.testing.assert_array_equal(evs["lf"], [[3, 1.5, 1]])
+
+
+def test_read_events_tsv(tmp_path):
+    path = tmp_path / "sub-01_task-motor_events.tsv"
+    path.write_text(BIDS)
+
+    table = read_events(str(path))
+
+    assert list(table.columns) == EV_COLUMNS
+    assert list(table["ev"].unique()) == ["rf", "lf"]
+    assert set(table["kind"]) == {"3col"}
+    assert set(table["source"]) == {path.name}
+
+
+def test_read_events_zip_selects_task_members(tmp_path):
+    path = tmp_path / "events.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("ev/task-motor_events.tsv", BIDS)
+        archive.writestr("ev/motor_cue.txt", "0 1 1\n10 1 1\n")
+        archive.writestr("ev/motor_drift.txt", "0.1\n0.2\n0.3\n")
+        archive.writestr("ev/task-lang_events.tsv", BIDS.replace("rf", "story"))
+        archive.writestr("ev/.hidden.txt", "garbage")
+
+    table = read_events(str(path), task="motor")
+
+    assert set(table["ev"]) == {"rf", "lf", "motor_cue", "motor_drift"}
+    drift = table[table["ev"] == "motor_drift"]
+    assert set(drift["kind"]) == {"1entry"}
+    np.testing.assert_array_equal(drift["weight"], [0.1, 0.2, 0.3])
+    assert drift["onset"].isna().all()
+
+
+def test_find_and_write_ev(tmp_path):
+    path = tmp_path / "task-motor_events.tsv"
+    path.write_text(BIDS)
+    (tmp_path / "cue.txt").write_text("0 1 1\n")
+    table = pd.concat([read_events(str(path)), read_events(str(tmp_path / "cue.txt"))], ignore_index=True)
+
+    assert len(find_ev(table, "missing")) == 0
+    # "f" matches both lf and rf
+    assert len(find_ev(table, "f")) == 0
+
+    filename = write_ev(find_ev(table, "rf"), str(tmp_path / "out"))
+    assert filename.endswith("task-motor_events-rf.txt")
+    np.testing.assert_array_equal(np.loadtxt(filename, ndmin=2), [[0, 1.5, 1], [6, 1.5, 2]])
+
+    # an events file holding only its own EV is named after it
+    assert write_ev(find_ev(table, "cue"), str(tmp_path / "out")).endswith("/cue.txt")
@@ -0,0 +1,86 @@
+import os
+import zipfile
+
+import pytest
+
+from utils.feat_cache import FeatCache, cache_key, hash_file, hash_zip_listing
+
+
+@pytest.fixture
+def featdir(tmp_path):
+    path = tmp_path / "glm.feat"
+    (path / "stats").mkdir(parents=True)
+    (path / "stats" / "zstat1.nii.gz").write_bytes(b"z" * 1000)
+    (path / "design.fsf").write_text("set fmri(npts) 10\n")
+    return str(path)
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / "events.tsv"
+    path.write_text("onset\tduration\n")
+
+    assert hash_file(str(path)) == hash_file(str(path), opener=lambda name: open(name, "rb"))
+    digest = hash_file(str(path))
+    path.write_text("onset\tduration\n1\t2\n")
+    assert hash_file(str(path)) != digest
+
+
+def test_hash_zip_listing_follows_members(tmp_path):
+    path = str(tmp_path / "hcp.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("b.txt", "b")
+        zf.writestr("a.txt", "a")
+    digest = hash_zip_listing(path)
+
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("a.txt", "a")
+        zf.writestr("b.txt", "b")
+    # member order does not matter, member content does
+    assert hash_zip_listing(path) == digest
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("a.txt", "a")
+        zf.writestr("b.txt", "c")
+    assert hash_zip_listing(path) != digest
+
+
+def test_cache_key_is_order_independent():
+    assert cache_key({"design": "abc", "inputs": [1, 2]}) == cache_key({"inputs": [1, 2], "design": "abc"})
+    assert cache_key({"design": "abc"}) != cache_key({"design": "abd"})
+
+
+def test_store_lookup_restore(tmp_path, featdir):
+    cache = FeatCache(str(tmp_path / "cache"), max_gb=1)
+    assert cache.lookup("k1") is None
+    assert not cache.restore("k1", str(tmp_path / "out.feat"))
+
+    cache.store("k1", featdir, parts={"design": "abc"})
+
+    assert cache.lookup("k1") == str(tmp_path / "cache" / "k1" / "glm.feat")
+    assert list(cache.entries()) == [("k1", {"design": "abc"}, cache.lookup("k1"))]
+    assert cache.restore("k1", str(tmp_path / "out.feat"))
+    assert (tmp_path / "out.feat" / "stats" / "zstat1.nii.gz").read_bytes() == b"z" * 1000
+    # no partial entries are left behind
+    assert os.listdir(str(tmp_path / "cache")) == ["k1"]
+
+
+def test_evicts_least_recently_used(tmp_path, featdir):
+    # room for two entries of about 1 kB
+    cache = FeatCache(str(tmp_path / "cache"), max_gb=2500 / 1024 ** 3)
+    cache.store("k1", featdir)
+    cache.store("k2", featdir)
+    os.utime(str(tmp_path / "cache" / "k1"), (1, 1))
+    os.utime(str(tmp_path / "cache" / "k2"), (2, 2))
+    # a hit makes k1 the most recently used
+    cache.lookup("k1")
+
+    cache.store("k3", featdir)
+
+    assert sorted(os.listdir(str(tmp_path / "cache"))) == ["k1", "k3"]
+
+
+def test_entry_larger_than_cache_is_not_stored(tmp_path, featdir):
+    cache = FeatCache(str(tmp_path / "cache"), max_gb=100 / 1024 ** 3)
+
+    cache.store("k1", featdir)
+
+    assert cache.lookup("k1") is None
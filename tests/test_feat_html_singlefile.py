@@ -0,0 +1,74 @@
+"""The flattened report is compared with the output of the original (baseline) flattener for the same report,
+tests/data/feat_report*_index.html. The baseline repeats pages linked from several places and orders them
+differently, so sections are compared by page rather than by position."""
+
+import os
+import re
+import shutil
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+from utils.feat_html_singlefile import main
+
+DATA = Path(__file__).parent / "data"
+
+
+def sections(path):
+    """(id, content) of the sections of a flattened report, content as text without whitespace, links and images."""
+    soup = BeautifulSoup(Path(path).read_text(), "html.parser")
+    return [
+        (
+            div.get("id"),
+            (
+                "".join(div.get_text().split()),
+                tuple(a.get("href") for a in div.find_all("a")),
+                tuple("".join(img["src"].split()) for img in div.find_all("img")),
+            ),
+        )
+        for div in soup.body.find_all("div", recursive=False)
+    ]
+
+
+def remove_home_links(featdir):
+    for html_file in Path(featdir).rglob("*.html"):
+        html_file.write_text(re.sub(r'<a href="(\.\./)?report\.html">[^<]*</a> ?', "", html_file.read_text()))
+
+
+@pytest.fixture
+def featdir(tmp_path):
+    featdir = tmp_path / "model.feat"
+    shutil.copytree(DATA / "feat_report", featdir)
+    return featdir
+
+
+@pytest.mark.parametrize("home_links, expected", [(True, "feat_report_index.html"),
+                                                  (False, "feat_report_nohome_index.html")])
+def test_flattened_report_matches_baseline(featdir, home_links, expected):
+    if not home_links:
+        remove_home_links(featdir)
+    cwd = os.getcwd()
+
+    main(featdir / "report.html")
+
+    assert os.getcwd() == cwd
+    flat = sections(featdir / "index.html")
+    baseline = sections(DATA / expected)
+
+    ids = [section_id for section_id, _ in flat]
+    assert ids[0] == "summary"
+    assert len(ids) == len(set(ids)), "each page is emitted once"
+    assert set(ids) == {section_id for section_id, _ in baseline}
+    for section_id, content in flat:
+        assert content in [other for other_id, other in baseline if other_id == section_id], section_id
+
+
+def test_summary_is_not_repeated(featdir):
+    remove_home_links(featdir)
+
+    main(featdir / "report.html")
+
+    soup = BeautifulSoup((featdir / "index.html").read_text(), "html.parser")
+    assert len(soup.find_all("table")) == 1
+    assert soup.find(id="report.html") is None
@@ -0,0 +1,133 @@
+import os
+import stat
+
+from fw_gear_hcp_fsl_feat.fsf import FsfDesign, format_value, parse_value, render_design, render_designs
+
+TEMPLATE = """
+# FEAT version number
+set fmri(version) 6.00
+
+# Analysis level
+set fmri(level) 1
+set fmri(analysis)  7
+set fmri(outputdir) ""
+set fmri(npts) 100
+set fmri(tr) 0.720000
+set fmri(regstandard) "/usr/local/fsl/data/standard/MNI152_T1_2mm_brain"
+set fmri(confoundevs) 0
+set fmri(multiple) 1
+set feat_files(1) ""
+set fmri(evs_orig) 2
+set fmri(evtitle1) "lf"
+set fmri(shape1) 3
+set fmri(custom1) "dummy"
+set fmri(evtitle2) "rf"
+set fmri(shape2) 3
+set fmri(custom2) "dummy"
+"""
+
+
+def test_parse_and_format_value():
+    assert parse_value('"a b"') == "a b"
+    assert parse_value("7") == 7
+    assert parse_value("0.720000") == 0.72
+    assert parse_value("1e-3") == 0.001
+    assert parse_value("{a b}") == "{a b}"
+    assert format_value("a b") == '"a b"'
+    assert format_value(7) == "7"
+    assert format_value(True) == "1"
+
+
+def test_round_trip_keeps_text():
+    design = FsfDesign.from_text(TEMPLATE)
+
+    assert design.to_text() == TEMPLATE
+    # unchanged lines, including comments and spacing, are written as read
+    design.npts = 300
+    text = design.to_text()
+    assert "set fmri(analysis)  7\n" in text
+    assert "# Analysis level\n" in text
+    assert FsfDesign.from_text(text).npts == 300
+
+
+def test_settings():
+    design = FsfDesign.from_text(TEMPLATE)
+
+    assert design["fmri(tr)"] == 0.72
+    assert design.raw("fmri(tr)") == "0.720000"
+    assert design.get("fmri(missing)", 5) == 5
+    assert design.fmri["level"] == 1
+    assert design.custom[1] == "dummy"
+    assert 2 in design.custom and 3 not in design.custom
+    assert design.ev_titles() == {1: "lf", 2: "rf"}
+    assert not design.confoundevs and not design.registration
+
+    design.feat_files[1] = "/data/bold"
+    design["fmri(new)"] = "x"
+    assert design.to_text().endswith('set fmri(new) "x"\n')
+    assert list(design)[-1] == "fmri(new)"
+    assert design.feat_files[1] == "/data/bold"
+
+
+def test_copy_and_diff():
+    template = FsfDesign.from_text(TEMPLATE)
+    design = template.copy()
+    design.outputdir = "glm"
+    design.npts = 300
+    design["fmri(new)"] = 1
+
+    assert template.npts == 100
+    assert design.diff(template) == ["fmri(npts)", "fmri(new)"]
+    assert design.diff(template, ignore=()) == ["fmri(outputdir)", "fmri(npts)", "fmri(new)"]
+
+
+def test_validate():
+    design = FsfDesign.from_text(TEMPLATE)
+    design.custom[2] = ""
+
+    errors = design.validate(nvols=300, confounds_file="confounds.txt")
+
+    assert errors == [
+        "fmri(npts) is 100, but the functional input has 300 volumes",
+        "confounds file selected in gear options, but not set in FSF TEMPLATE",
+        "feat_files(1) is not set",
+        "fmri(custom2) is not set for EV 2 (rf)",
+    ]
+
+
+def test_render_design():
+    template = FsfDesign.from_text(TEMPLATE)
+
+    design, errors = render_design(template, "/data/bold", 300, ev_files={1: "lf.txt", "rf": "rf.txt", "lh": "lh.txt"},
+                                   outputdir="glm")
+
+    assert errors == ["No EV titled lh in the template"]
+    assert design.npts == 300
+    assert design.feat_files[1] == "/data/bold"
+    assert design.outputdir == "glm"
+    assert (design.custom[1], design.custom[2]) == ("lf.txt", "rf.txt")
+    assert template.npts == 100 and template.feat_files[1] == ""
+
+
+def test_render_designs_writes_valid_rows(tmp_path):
+    template = tmp_path / "template.fsf"
+    template.write_text(TEMPLATE)
+    rows = [
+        {"name": "sub-01", "func_file": "/data/sub-01", "npts": 300, "ev_lf": "lf1.txt", "ev_rf": "rf1.txt"},
+        {"name": "sub-02", "func_file": "/data/sub-02", "npts": 310, "ev_lf": "lf2.txt", "ev_rf": ""},
+        {"name": "sub-03", "npts": 310},
+    ]
+
+    results = render_designs(str(template), rows, out_dir=str(tmp_path / "designs"))
+
+    assert [result.name for result in results] == ["sub-01", "sub-02", "sub-03"]
+    assert results[0].errors == []
+    assert results[0].path == str(tmp_path / "designs" / "sub-01.fsf")
+    assert FsfDesign.read(results[0].path).diff(results[0].design) == []
+    # permissions as for a file created with open()
+    (tmp_path / "plain.txt").touch()
+    assert stat.S_IMODE(os.stat(results[0].path).st_mode) == stat.S_IMODE(os.stat(tmp_path / "plain.txt").st_mode)
+    # the empty "rf" cell leaves the template's file
+    assert results[1].errors == [] and results[1].design.custom[2] == "dummy"
+    assert results[2].path is None and results[2].errors[0].startswith("Invalid bindings")
+    assert sorted(os.listdir(tmp_path / "designs")) == ["sub-01.fsf", "sub-02.fsf"]
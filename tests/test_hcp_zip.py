@@ -0,0 +1,93 @@
+import os
+import zipfile
+
+import pytest
+
+from utils.hcp_zip import extract_archives, extract_member, hcp_manifest, match_members
+
+MEMBERS = {
+    "100/MNINonLinear/T1w_restore_brain.nii.gz": b"t1w",
+    "100/MNINonLinear/T1w_restore.nii.gz": b"unused",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL_bold.nii.gz": b"bold",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL_hp2000_clean.nii.gz": b"clean",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_RL/Movement_Regressors.txt": b"0 0 0 0 0 0\n",
+    "100/MNINonLinear/Results/tfMRI_LANGUAGE_RL/tfMRI_LANGUAGE_RL_bold.nii.gz": b"lang",
+}
+
+
+def write_zip(path, members, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(str(path), "w", compression) as zf:
+        zf.writestr("100/MNINonLinear/", "")
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return str(path)
+
+
+def test_hcp_manifest():
+    assert hcp_manifest("MOTOR", motion_confound=True, extra_files=["confounds.txt"]) == [
+        "MNINonLinear/T1w_restore_brain.nii.gz",
+        "MNINonLinear/Results/*MOTOR*/*_bold.nii.gz",
+        "MNINonLinear/Results/*MOTOR*/Movement_Regressors.txt",
+        "MNINonLinear/Results/*MOTOR*/confounds.txt",
+    ]
+    assert hcp_manifest(["MOTOR"], icafix=True)[1] == "MNINonLinear/Results/*MOTOR*/*clean.nii.gz"
+
+
+def test_match_members(tmp_path):
+    with zipfile.ZipFile(write_zip(tmp_path / "hcp.zip", MEMBERS)) as zf:
+        infolist = zf.infolist()
+
+    selected, skipped = match_members(infolist, hcp_manifest("MOTOR", motion_confound=True))
+
+    assert sorted(info.filename for info in selected) == [
+        "100/MNINonLinear/Results/tfMRI_MOTOR_RL/Movement_Regressors.txt",
+        "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL_bold.nii.gz",
+        "100/MNINonLinear/T1w_restore_brain.nii.gz",
+    ]
+    # directories are neither selected nor skipped
+    assert len(selected) + len(skipped) == len(MEMBERS)
+    assert len(match_members(infolist, None)[0]) == len(MEMBERS)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_extract_archives(tmp_path, n_workers):
+    structural = write_zip(tmp_path / "struct.zip", {"100/MNINonLinear/T1w_restore_brain.nii.gz": b"old"})
+    functional = write_zip(tmp_path / "func.zip", MEMBERS)
+    dest = tmp_path / "work"
+
+    extracted, skipped = extract_archives([structural, functional], str(dest), hcp_manifest("MOTOR"),
+                                          n_workers=n_workers)
+
+    files = sorted(os.path.relpath(os.path.join(dirpath, name), str(dest))
+                   for dirpath, _, names in os.walk(str(dest)) for name in names)
+    assert files == [
+        "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL_bold.nii.gz",
+        "100/MNINonLinear/T1w_restore_brain.nii.gz",
+    ]
+    # the member of the last archive wins
+    assert (dest / "100/MNINonLinear/T1w_restore_brain.nii.gz").read_bytes() == b"t1w"
+    assert extracted == len(b"bold") + len(b"t1w")
+    assert skipped == sum(len(data) for data in MEMBERS.values()) - extracted
+
+
+def test_extract_member_stays_in_dest(tmp_path):
+    archive = write_zip(tmp_path / "evil.zip", {"../outside.txt": b"x"})
+
+    with pytest.raises(ValueError):
+        extract_member(archive, "../outside.txt", str(tmp_path / "work"))
+    assert not (tmp_path / "outside.txt").exists()
+
+
+def test_extract_archives_reads_replaced_archive(tmp_path):
+    archive = tmp_path / "func.zip"
+    write_zip(archive, {"100/a.txt": b"old"})
+    extract_archives([str(archive)], str(tmp_path / "work"))
+    open_files = len(os.listdir("/proc/self/fd"))
+
+    archive.unlink()
+    write_zip(archive, {"100/a.txt": b"new"})
+    extract_archives([str(archive)], str(tmp_path / "work"))
+
+    assert (tmp_path / "work" / "100" / "a.txt").read_bytes() == b"new"
+    # archives are closed once extracted
+    assert len(os.listdir("/proc/self/fd")) <= open_files
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from fw_gear_hcp_fsl_feat.fsf import FsfDesign
+from fw_gear_hcp_fsl_feat.main import MODEL_INPUTS_FILE, model_input_digests, read_model_inputs, replace_vols
+from tests.conftest import write_nifti
+from utils.zip_vfs import ZipVirtualFS
+
+DESIGN = """set fmri(outputdir) "{tmp}/glm"
+set feat_files(1) "{tmp}/bold"
+set fmri(confoundevs) 1
+set confoundev_files(1) "{tmp}/confounds.txt"
+set fmri(evtitle1) "lf"
+set fmri(shape1) 3
+set fmri(custom1) "{tmp}/lf.txt"
+set fmri(evtitle2) "rf"
+set fmri(shape2) 0
+"""
+
+
+def test_model_input_digests_follow_content_not_paths(tmp_path):
+    (tmp_path / "bold.nii.gz").write_bytes(b"bold")
+    (tmp_path / "confounds.txt").write_text("1 2\n")
+    (tmp_path / "lf.txt").write_text("0 1 1\n")
+    design = FsfDesign.from_text(DESIGN.format(tmp=tmp_path))
+    gear_options = {"vfs": ZipVirtualFS()}
+
+    digests = model_input_digests(gear_options, design)
+
+    # the functional input is found without its extension, EV 2 has no file
+    assert set(digests) == {"feat_files(1)", "confoundev_files(1)", "fmri(custom1)"}
+    assert all(digests.values())
+
+    (tmp_path / "lf.txt").write_text("0 2 1\n")
+    changed = model_input_digests(gear_options, design)
+    assert changed["fmri(custom1)"] != digests["fmri(custom1)"]
+    assert changed["feat_files(1)"] == digests["feat_files(1)"]
+
+
+def test_read_model_inputs(tmp_path):
+    assert read_model_inputs(str(tmp_path)) is None
+
+    (tmp_path / MODEL_INPUTS_FILE).write_text(json.dumps({"feat_files(1)": "abc"}))
+    assert read_model_inputs(str(tmp_path)) == {"feat_files(1)": "abc"}
+
+
+@pytest.mark.parametrize("mem_gb", [1, 1e-6])
+def test_dummy_volume_noise_is_reproducible(tmp_path, series, mem_gb):
+    # a rerun on the same series must be able to reuse the model fit of the first run
+    write_nifti(tmp_path / "bold.nii", series)
+    design = FsfDesign.from_text(DESIGN.format(tmp=tmp_path).replace("/bold", "/bold_withnoise"))
+    gear_options = {"vfs": ZipVirtualFS(), "mem_gb": mem_gb}
+
+    digests = []
+    for _ in range(2):
+        replace_vols(gear_options, {"dummy-scans": 3, "func_file": str(tmp_path / "bold.nii")})
+        digests.append(model_input_digests(gear_options, design))
+
+    assert digests[0]["feat_files(1)"] is not None
+    assert digests[0] == digests[1]
@@ -0,0 +1,97 @@
+import gzip
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils.nifti_header import parse_header, read_header
+
+
+def save(path, data, image_class=nib.Nifti1Image, affine=None, units=("mm", "sec"), tr=0.72):
+    if affine is None:
+        affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        affine[:3, 3] = [-90, -126, -72]
+    img = image_class(data, affine)
+    img.header.set_xyzt_units(*units)
+    img.header["pixdim"][4] = tr
+    nib.save(img, str(path))
+    return str(path)
+
+
+@pytest.mark.parametrize("image_class", [nib.Nifti1Image, nib.Nifti2Image])
+@pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+def test_read_header_matches_nibabel(tmp_path, series, image_class, suffix):
+    path = save(tmp_path / ("bold" + suffix), series, image_class)
+
+    header = read_header(path)
+    img = nib.load(path)
+
+    assert header.version == (1 if image_class is nib.Nifti1Image else 2)
+    assert header.shape == img.shape
+    assert header.nvols == 10
+    assert header.zooms == pytest.approx(img.header.get_zooms())
+    assert header.tr == pytest.approx(0.72)
+    assert header.bitpix == 16
+    assert header.nbytes == series.nbytes
+    assert header.vox_offset == img.dataobj.offset
+    np.testing.assert_allclose(header.affine, img.affine)
+
+
+def test_qform_affine_and_milliseconds(tmp_path, series):
+    affine = np.array([[0, -2.0, 0, 10], [2.0, 0, 0, -20], [0, 0, 2.5, 30], [0, 0, 0, 1]])
+    img = nib.Nifti1Image(series, affine)
+    img.set_sform(None, code=0)
+    img.set_qform(affine, code=1)
+    img.header.set_xyzt_units("mm", "msec")
+    img.header["pixdim"][4] = 720
+    path = str(tmp_path / "bold.nii")
+    nib.save(img, path)
+
+    header = read_header(path)
+
+    np.testing.assert_allclose(header.affine, affine, atol=1e-6)
+    assert header.tr == pytest.approx(0.72)
+
+
+def test_3d_image_has_one_volume(tmp_path, series):
+    header = read_header(save(tmp_path / "T1w.nii.gz", series[..., 0]))
+
+    assert header.shape == (4, 3, 2)
+    assert header.nvols == 1
+    assert header.tr == 0.0
+
+
+def test_big_endian(tmp_path, series):
+    path = str(tmp_path / "bold.nii")
+    nib.save(nib.Nifti1Image(series, np.eye(4), nib.Nifti1Header().as_byteswapped(">")), path)
+
+    header = read_header(path)
+
+    assert header.endianness == ">"
+    assert header.nvols == 10
+
+
+def test_cache_follows_file_changes(tmp_path, series):
+    path = save(tmp_path / "bold.nii.gz", series)
+    assert read_header(path).nvols == 10
+
+    save(tmp_path / "bold.nii.gz", series[..., :4])
+    # a new mtime or size invalidates the cached header
+    os.utime(path, ns=(0, 0))
+
+    assert read_header(path).nvols == 4
+
+
+def test_parse_header_rejects_other_data(tmp_path):
+    with pytest.raises(ValueError):
+        parse_header(b"PK\x03\x04" + bytes(344))
+    with pytest.raises(ValueError):
+        parse_header(b"")
+
+    path = tmp_path / "bold.nii.gz"
+    save(path, np.zeros((2, 2, 2, 2), np.int16))
+    with gzip.open(str(path)) as fp:
+        data = fp.read(348)
+    with pytest.raises(ValueError):
+        parse_header(data[:200])
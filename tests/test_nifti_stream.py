@@ -0,0 +1,75 @@
+import gzip
+from types import SimpleNamespace
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from tests.conftest import write_nifti
+from utils.nifti_stream import NiftiStreamWriter, data_scaling, iter_volume_blocks, temporal_mean
+
+
+def read_blocks(path, block_vols, start=0):
+    blocks = list(iter_volume_blocks(path, block_vols, start=start))
+    return np.concatenate([block for _, _, block in blocks], axis=-1), [(t0, t1) for t0, t1, _ in blocks]
+
+
+@pytest.mark.parametrize(
+    "slope, inter, expected",
+    [
+        (1.0, 0.0, None),
+        (np.nan, 0.0, None),
+        (np.nan, 7.0, None),
+        (0.0, 5.0, None),
+        (np.inf, 0.0, None),
+        (2.0, 1.0, (2.0, 1.0)),
+        (1.0, 3.0, (1.0, 3.0)),
+        (2.0, np.nan, (2.0, 0.0)),
+    ],
+)
+def test_data_scaling(slope, inter, expected):
+    assert data_scaling(SimpleNamespace(scl_slope=slope, scl_inter=inter)) == expected
+
+
+@pytest.mark.parametrize("slope, inter", [(np.nan, 0.0), (np.nan, 7.0), (0.0, 5.0), (2.0, 1.0), (0.5, -3.0)])
+def test_iter_volume_blocks_matches_nibabel(tmp_path, series, slope, inter):
+    path = write_nifti(tmp_path / f"scaled-{slope}-{inter}.nii", series, slope=slope, inter=inter)
+
+    data, ranges = read_blocks(path, 3)
+
+    assert ranges == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert np.all(np.isfinite(data))
+    np.testing.assert_allclose(data, nib.load(path).get_fdata(), rtol=1e-6)
+
+
+def test_iter_volume_blocks_nan_slope_is_unscaled(tmp_path, series):
+    path = write_nifti(tmp_path / "nan-slope.nii", series, slope=np.nan, inter=np.nan)
+
+    data, _ = read_blocks(path, 4)
+
+    np.testing.assert_array_equal(data, series.astype(np.float32))
+
+
+def test_iter_volume_blocks_start_and_gzip(tmp_path, series):
+    path = write_nifti(tmp_path / "series.nii", series)
+    gz_path = str(tmp_path / "series.nii.gz")
+    with open(path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+        dst.write(src.read())
+
+    data, ranges = read_blocks(gz_path, 4, start=3)
+
+    assert ranges == [(3, 7), (7, 10)]
+    np.testing.assert_array_equal(data, series[..., 3:].astype(np.float32))
+    np.testing.assert_allclose(temporal_mean(gz_path, 4, start=3), series[..., 3:].mean(axis=-1), rtol=1e-6)
+
+
+def test_stream_writer_round_trip(tmp_path, series):
+    path = write_nifti(tmp_path / "in.nii", series, slope=2.0, inter=1.0)
+    out = str(tmp_path / "out.nii.gz")
+    img = nib.load(path)
+
+    with NiftiStreamWriter(out, img.header, img.shape) as writer:
+        for _, _, block in iter_volume_blocks(path, 3):
+            writer.write(block)
+
+    np.testing.assert_allclose(nib.load(out).get_fdata(), img.get_fdata(), rtol=1e-6)
@@ -0,0 +1,98 @@
+import glob
+import os
+import zipfile
+
+import pytest
+
+from utils.path_index import PathIndex, glob_to_regex
+
+FILES = [
+    "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL.nii.gz",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_RL/Movement_Regressors.txt",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_LR/tfMRI_MOTOR_LR.nii.gz",
+    "100/MNINonLinear/Results/tfMRI_LANGUAGE_RL/.hidden.txt",
+    "100/MNINonLinear/T1w.nii.gz",
+    "100/release-notes/a[1].txt",
+]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name in FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    return tmp_path
+
+
+@pytest.mark.parametrize("pattern", [
+    "100/MNINonLinear/Results/*/*.nii.gz",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_??",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_[LR]L",
+    "100/MNINonLinear/Results/tfMRI_MOTOR_[!L]*",
+    "100/MNINonLinear/Results/*/*.txt",
+    "100/MNINonLinear/Results/*/.*",
+    "100/**/*.nii.gz",
+    "100/*/T1w.nii.gz",
+    "100/release-notes/a[[]1].txt",
+    "100/MNINonLinear/T1w.nii.gz",
+    "100/MNINonLinear/missing.nii.gz",
+    "*/MNINonLinear",
+])
+def test_glob_matches_glob_module(tree, pattern):
+    index = PathIndex()
+    index.add_tree(str(tree))
+
+    expected = sorted(path.rstrip("/") for path in glob.glob(os.path.join(str(tree), pattern), recursive=True))
+    assert index.glob(os.path.join(str(tree), pattern)) == expected
+
+
+def test_glob_to_regex():
+    assert glob_to_regex("/a/*.txt").match("/a/b.txt")
+    assert not glob_to_regex("/a/*.txt").match("/a/b/c.txt")
+    assert not glob_to_regex("/a/*").match("/a/.b")
+    assert glob_to_regex("/a/.*").match("/a/.b")
+    assert glob_to_regex("/a/**/c").match("/a/c")
+    assert glob_to_regex("/a/**/c").match("/a/b/b/c")
+    assert glob_to_regex("/a/[!b]").match("/a/c")
+    assert not glob_to_regex("/a/[!b]").match("/a/b")
+    assert glob_to_regex("/a/[^b]").match("/a/^")
+    assert not glob_to_regex("/a/[^b]").match("/a/c")
+    # a trailing "**" matches everything below the directory, not the directory itself
+    assert glob_to_regex("/a/**").match("/a/b/c")
+    assert not glob_to_regex("/a/**").match("/a")
+
+
+def test_add_adds_parents(tmp_path):
+    index = PathIndex([str(tmp_path / "a" / "b.txt")])
+
+    assert str(tmp_path / "a" / "b.txt") in index
+    assert str(tmp_path / "a") in index
+    assert index.glob(str(tmp_path / "*")) == [str(tmp_path / "a")]
+
+
+def test_add_archive(tmp_path):
+    archive = tmp_path / "hcp.zip"
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.writestr("100/MNINonLinear/", "")
+        zf.writestr("100/MNINonLinear/T1w.nii.gz", "")
+    index = PathIndex()
+
+    index.add_archive(str(archive), str(tmp_path / "work"))
+
+    assert index.glob(str(tmp_path / "work" / "*" / "*" / "*.nii.gz")) == [
+        str(tmp_path / "work" / "100" / "MNINonLinear" / "T1w.nii.gz")
+    ]
+    assert str(tmp_path / "work" / "100") in index
+
+
+def test_search(tree):
+    index = PathIndex()
+    index.add_tree(str(tree))
+
+    results = os.path.join(str(tree), "100", "MNINonLinear", "Results")
+    assert index.search(r"MOTOR_(RL|LR)$", root=results) == [
+        os.path.join(results, "tfMRI_MOTOR_LR"),
+        os.path.join(results, "tfMRI_MOTOR_RL"),
+    ]
+    assert index.search(r"MOTOR", root=os.path.join(str(tree), "100", "release-notes")) == []
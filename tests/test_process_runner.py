@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import sys
+import time
+
+import pytest
+
+from utils import process_runner
+from utils.process_runner import ProcessRunner, format_command, run_command, run_process
+
+
+def test_format_command():
+    assert format_command(["feat", "design.fsf"]) == ["feat", "design.fsf"]
+    assert format_command(["feat", "design.fsf"], shell=True) == "feat design.fsf"
+    assert format_command("feat design.fsf") == "feat design.fsf"
+
+
+def test_large_output_on_both_streams_does_not_block():
+    # far more than a pipe buffer on each stream, written alternately
+    script = "import sys\nfor i in range(20000):\n    print('x' * 50)\n    print('y' * 50, file=sys.stderr)\n"
+
+    result = run_command([sys.executable, "-c", script], capture=True, log_output=False, timeout=60)
+
+    assert result.returncode == 0
+    assert not result.timed_out
+    assert result.stdout.count("\n") == result.stderr.count("\n") == 20000
+    assert result.max_rss_gb > 0
+
+
+def test_output_is_logged_by_line(caplog):
+    with caplog.at_level(logging.INFO, logger=process_runner.__name__):
+        result = run_command(["printf", "a\\nb"], name="motor")
+
+    assert result.stdout is None
+    assert [record.getMessage() for record in caplog.records] == ["[motor] a", "[motor] b"]
+
+
+def test_return_code_and_shell():
+    assert run_command(["exit", "4"], shell=True).returncode == 4
+    assert run_command("echo $((6 * 7))", shell=True, capture=True).stdout == "42\n"
+
+
+def test_timeout_stops_process_group():
+    start = time.monotonic()
+
+    result = run_command("sleep 30 & sleep 30; wait", shell=True, timeout=0.5)
+
+    assert result.timed_out
+    assert result.returncode < 0
+    assert time.monotonic() - start < 10
+
+
+def test_missing_program():
+    with pytest.raises(OSError):
+        run_command(["/no/such/program"])
+
+
+def test_runner_limits_concurrency():
+    runner = ProcessRunner(max_concurrent=2)
+    commands = {name: ["sleep", "0.3"] for name in ["a", "b", "c", "d"]}
+
+    start = time.monotonic()
+    results = asyncio.run(runner.run_all(commands))
+    duration = time.monotonic() - start
+
+    assert [result.name for result in results] == ["a", "b", "c", "d"]
+    assert all(result.returncode == 0 for result in results)
+    # two at a time: two rounds
+    assert 0.6 <= duration < 3
+
+
+def test_cancel_stops_process():
+    async def cancel_soon():
+        task = asyncio.ensure_future(run_process(["sleep", "30"]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(cancel_soon())
+    assert time.monotonic() - start < 10
+
+
+def test_stop_does_not_signal_reaped_process(monkeypatch):
+    signalled = []
+    monkeypatch.setattr(process_runner.os, "killpg", lambda pid, sig: signalled.append((pid, sig)))
+
+    async def stop_reaped():
+        waiter = asyncio.get_running_loop().create_future()
+        waiter.set_result((12345, 0, None))
+        await process_runner._stop(12345, waiter)
+
+    asyncio.run(stop_reaped())
+    assert signalled == []
+
+
+def test_without_pidfd(monkeypatch):
+    # waits in a thread instead
+    monkeypatch.delattr(process_runner.os, "pidfd_open", raising=False)
+
+    assert run_command(["exit", "3"], shell=True).returncode == 3
+    result = run_command("sleep 30", shell=True, timeout=0.5)
+    assert result.timed_out and result.returncode < 0
@@ -0,0 +1,64 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from fw_gear_hcp_fsl_feat.main import fill_dummy_volumes, replace_vols
+from tests.conftest import write_nifti
+from utils.zip_vfs import ZipVirtualFS
+
+DUMMY_SCANS = 20
+
+
+@pytest.fixture
+def long_series():
+    """An int16 4D series with enough dummy volume voxels to check the noise statistics, (8, 8, 8, 60)."""
+    rng = np.random.default_rng(1)
+    return rng.integers(-100, 1000, size=(8, 8, 8, 60)).astype(np.int16)
+
+
+# in memory, and streamed a volume at a time
+@pytest.mark.parametrize("mem_gb", [1, 1e-6])
+def test_replace_vols(tmp_path, long_series, mem_gb):
+    path = write_nifti(tmp_path / "bold.nii", long_series, slope=2.0, inter=10.0)
+    scaled = long_series.astype(np.float32) * 2 + 10
+    app_options = {"dummy-scans": DUMMY_SCANS, "func_file": path}
+
+    replace_vols({"vfs": ZipVirtualFS(), "mem_gb": mem_gb}, app_options)
+
+    assert app_options["func_file"] == str(tmp_path / "bold_withnoise.nii.gz")
+    img = nib.load(app_options["func_file"])
+    assert img.get_data_dtype() == np.float32
+    assert img.shape == long_series.shape
+    data = img.get_fdata(dtype=np.float32)
+
+    # retained volumes keep their scaled values exactly
+    np.testing.assert_array_equal(data[..., DUMMY_SCANS:], scaled[..., DUMMY_SCANS:])
+
+    # dummy volumes are the temporal mean of the retained volumes plus standard normal noise
+    tmean = scaled[..., DUMMY_SCANS:].mean(axis=-1, dtype=np.float64)
+    noise = data[..., :DUMMY_SCANS] - tmean[..., np.newaxis]
+    assert abs(noise.mean()) < 0.05
+    assert abs(noise.std() - 1) < 0.05
+
+
+def test_in_memory_and_streamed_outputs_match(tmp_path, series):
+    path = write_nifti(tmp_path / "bold.nii", series)
+    outputs = []
+    for mem_gb in [1, 1e-6]:
+        app_options = replace_vols({"vfs": ZipVirtualFS(), "mem_gb": mem_gb}, {"dummy-scans": 3, "func_file": path})
+        outputs.append(nib.load(app_options["func_file"]).get_fdata(dtype=np.float32))
+
+    np.testing.assert_allclose(outputs[0], outputs[1], rtol=1e-6)
+
+
+def test_fill_dummy_volumes(series):
+    data = series.astype(np.float32)
+    retained = data[..., 2:].copy()
+
+    assert fill_dummy_volumes(data, 2, rng=np.random.default_rng(0)) is data
+
+    np.testing.assert_array_equal(data[..., 2:], retained)
+    assert not np.array_equal(data[..., :2], series[..., :2])
+    # the same generator gives the same noise
+    again = fill_dummy_volumes(series.astype(np.float32), 2, rng=np.random.default_rng(0))
+    np.testing.assert_array_equal(again, data)
@@ -0,0 +1,83 @@
+import pytest
+
+from utils.scheduler import JobScheduler, format_summary
+
+
+def test_results_in_submission_order():
+    scheduler = JobScheduler(n_cpus=2, mem_gb=1)
+    scheduler.submit("slow", ["sleep", "0.2"])
+    scheduler.submit("fail", ["exit", "3"], shell=True)
+    scheduler.submit("ok", ["true"])
+
+    results = scheduler.run()
+
+    assert [(result.name, result.returncode) for result in results] == [("slow", 0), ("fail", 3), ("ok", 0)]
+    assert results[0].duration >= 0.2
+
+
+def test_failed_dependency_skips_later_stages():
+    scheduler = JobScheduler(n_cpus=4, mem_gb=1)
+    scheduler.submit("motor:init", ["true"])
+    scheduler.submit("motor:stats", ["exit", "1"], shell=True, after=["motor:init"])
+    scheduler.submit("motor:poststats", ["true"], after=["motor:stats"])
+    scheduler.submit("motor:stop", ["true"], after=["motor:poststats"])
+    scheduler.submit("lang", ["true"])
+
+    results = {result.name: result.returncode for result in scheduler.run()}
+
+    assert results == {"motor:init": 0, "motor:stats": 1, "motor:poststats": None, "motor:stop": None, "lang": 0}
+
+
+def test_memory_budget_admission_order(tmp_path):
+    order = tmp_path / "order"
+    scheduler = JobScheduler(n_cpus=4, mem_gb=0.003)
+    for name, mem_gb in [("a", 0.002), ("b", 0.002), ("c", 0.001)]:
+        scheduler.submit(name, ["echo", name, ">>", str(order), "&&", "sleep", "0.3"], shell=True, mem_gb=mem_gb)
+
+    scheduler.run()
+
+    # b does not fit next to a, and is overtaken by c, which does
+    assert order.read_text().split()[-1] == "b"
+
+
+def test_oversized_job_runs_alone():
+    scheduler = JobScheduler(n_cpus=1, mem_gb=0.001)
+    scheduler.submit("big", ["true"], cpus=4, mem_gb=10)
+
+    assert scheduler.run()[0].returncode == 0
+
+
+def test_missing_program(tmp_path):
+    scheduler = JobScheduler(n_cpus=1, mem_gb=1)
+    scheduler.submit("missing", [str(tmp_path / "no-such-program")])
+
+    assert scheduler.run()[0].returncode == 127
+
+
+def test_submit_errors():
+    scheduler = JobScheduler(n_cpus=1, mem_gb=1)
+    scheduler.submit("a", ["true"])
+    with pytest.raises(ValueError):
+        scheduler.submit("a", ["true"])
+    with pytest.raises(ValueError):
+        scheduler.submit("b", ["true"], after=["c"])
+
+
+def test_dry_run_starts_nothing(tmp_path):
+    scheduler = JobScheduler(n_cpus=1, mem_gb=1, dry_run=True)
+    scheduler.submit("motor", ["touch", str(tmp_path / "ran")])
+
+    assert [result.returncode for result in scheduler.run()] == [0]
+    assert not (tmp_path / "ran").exists()
+
+
+def test_format_summary():
+    scheduler = JobScheduler(n_cpus=1, mem_gb=1)
+    scheduler.submit("motor:stats", ["exit", "2"], shell=True, mem_gb=0.5)
+    scheduler.submit("motor:stop", ["true"], after=["motor:stats"])
+
+    lines = format_summary(scheduler.run()).splitlines()
+
+    assert lines[0].split()[:3] == ["job", "return", "code"]
+    assert lines[1].split()[:2] == ["motor:stats", "2"]
+    assert lines[2].split()[:2] == ["motor:stop", "skipped"]
@@ -0,0 +1,34 @@
+import os
+import zipfile
+
+from utils.zip_htmls import zip_htmls
+
+
+def test_zip_htmls(tmp_path, monkeypatch):
+    # zip_htmls changes directory, so return to a known one afterwards
+    monkeypatch.chdir(str(tmp_path))
+    report = tmp_path / "glm.feat"
+    (report / "stats").mkdir(parents=True)
+    (report / "stats" / "zstat1.png").write_bytes(b"png")
+    (report / "design.png").write_bytes(b"png")
+    (report / "index.html").write_text('<a href="report_stats.html">stats</a> <a href="design.png">design</a>')
+    (report / "report_stats.html").write_text(
+        '<a href="stats/zstat1.png">zstat1</a> <a href="stats/missing.png">missing</a>'
+        ' <a href="https://fsl.fmrib.ox.ac.uk">FSL</a>'
+    )
+    output = tmp_path / "output"
+    output.mkdir()
+
+    zip_htmls(str(output), "dest", str(report))
+
+    assert sorted(os.listdir(str(output))) == ["index_dest.html.zip", "report_stats_dest.html.zip"]
+    with zipfile.ZipFile(str(output / "index_dest.html.zip")) as zf:
+        assert zf.namelist() == ["index.html", "report_stats.html", "design.png"]
+    # each page is stored as index.html, with the files it links to at their relative paths
+    with zipfile.ZipFile(str(output / "report_stats_dest.html.zip")) as zf:
+        assert zf.namelist() == ["index.html", "stats/zstat1.png"]
+        assert b"zstat1" in zf.read("index.html")
+
+    # the html files are left as they were
+    assert sorted(os.listdir(str(report))) == ["design.png", "index.html", "report_stats.html", "stats"]
+    assert os.getcwd() == str(tmp_path)
@@ -0,0 +1,105 @@
+import io
+import os
+import stat
+import zipfile
+
+import numpy as np
+import pytest
+
+from utils import zip_stream
+from utils.zip_stream import ParallelZipWriter, compress_type, zip_tree
+
+
+@pytest.fixture
+def payload():
+    # compressible, but not trivially: repeated noise
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 16, 50000, dtype=np.uint8).tobytes() * 8
+
+
+def test_compress_type():
+    assert compress_type("model.feat/stats/zstat1.nii.gz") == zipfile.ZIP_STORED
+    assert compress_type("model.feat/rendered_thresh_zstat1.PNG") == zipfile.ZIP_STORED
+    assert compress_type("model.feat/report_log.html") == zipfile.ZIP_DEFLATED
+    assert compress_type("model.feat/report_log.html", compresslevel=0) == zipfile.ZIP_STORED
+
+
+def test_chunked_members_read_back(tmp_path, monkeypatch, payload):
+    # several chunks per member, deflated on different threads
+    monkeypatch.setattr(zip_stream, "CHUNK_SIZE", 64 * 1024)
+    archive = str(tmp_path / "out.zip")
+
+    with ParallelZipWriter(archive, n_workers=4) as writer:
+        writer.writestr("a/design.fsf", payload)
+        writer.writestr("a/empty.txt", b"")
+        writer.writestr("a/filtered_func_data.nii.gz", payload[:1000])
+        writer.writestr("a/näme.txt", b"x")
+
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["a/design.fsf", "a/empty.txt", "a/filtered_func_data.nii.gz", "a/näme.txt"]
+        assert zf.read("a/design.fsf") == payload
+        assert zf.read("a/empty.txt") == b""
+        assert zf.read("a/näme.txt") == b"x"
+        infos = {info.filename: info for info in zf.infolist()}
+    assert infos["a/design.fsf"].compress_type == zipfile.ZIP_DEFLATED
+    assert infos["a/design.fsf"].compress_size < len(payload)
+    assert infos["a/filtered_func_data.nii.gz"].compress_type == zipfile.ZIP_STORED
+    assert stat.S_IMODE(infos["a/design.fsf"].external_attr >> 16) == 0o777
+
+
+def test_compresslevel_0_stores(tmp_path, payload):
+    archive = str(tmp_path / "out.zip")
+
+    with ParallelZipWriter(archive, compresslevel=0) as writer:
+        writer.writestr("design.fsf", payload)
+
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.getinfo("design.fsf").compress_type == zipfile.ZIP_STORED
+        assert zf.read("design.fsf") == payload
+
+
+def test_one_member_at_a_time(tmp_path):
+    with ParallelZipWriter(str(tmp_path / "out.zip")) as writer:
+        writer.open("a.txt")
+        with pytest.raises(ValueError):
+            writer.open("b.txt")
+
+
+def test_error_discards_archive(tmp_path):
+    archive = tmp_path / "out.zip"
+
+    with pytest.raises(RuntimeError):
+        with ParallelZipWriter(str(archive)) as writer:
+            writer.writestr("a.txt", b"a")
+            raise RuntimeError
+
+    assert not archive.exists()
+
+
+def test_zip_tree(tmp_path, payload):
+    src = tmp_path / "glm.feat"
+    (src / "stats").mkdir(parents=True)
+    (src / "design.fsf").write_bytes(payload)
+    (src / "stats" / "zstat1.nii.gz").write_bytes(b"zstat")
+    (src / "logs").mkdir()
+    copy = io.BytesIO()
+    archive = str(tmp_path / "out" / "glm.zip")
+    os.makedirs(os.path.dirname(archive))
+
+    nfiles, nbytes = zip_tree(str(src), archive, arcprefix="dest/sub-01/glm.feat/", tee={"design.fsf": [copy]})
+
+    assert (nfiles, nbytes) == (2, len(payload) + 5)
+    assert copy.getvalue() == payload
+    assert os.listdir(os.path.dirname(archive)) == ["glm.zip"]
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [
+            "dest/sub-01/glm.feat/",
+            "dest/sub-01/glm.feat/design.fsf",
+            "dest/sub-01/glm.feat/logs/",
+            "dest/sub-01/glm.feat/stats/",
+            "dest/sub-01/glm.feat/stats/zstat1.nii.gz",
+        ]
+        assert zf.getinfo("dest/sub-01/glm.feat/stats/").is_dir()
+        assert zf.read("dest/sub-01/glm.feat/design.fsf") == payload
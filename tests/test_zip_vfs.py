@@ -0,0 +1,129 @@
+import gzip
+import io
+import os
+import stat
+import zipfile
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils.hcp_zip import extract_archives
+from utils.nifti_header import read_header
+from utils.zip_vfs import ZipRangeFile, ZipVirtualFS, atomic_write, member_range
+
+BOLD = "100/MNINonLinear/Results/tfMRI_MOTOR_RL/tfMRI_MOTOR_RL_bold.nii.gz"
+
+
+@pytest.fixture
+def bold_gz(tmp_path, series):
+    img = nib.Nifti1Image(series, np.eye(4))
+    path = str(tmp_path / "bold.nii.gz")
+    nib.save(img, path)
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+@pytest.fixture
+def archive(tmp_path, bold_gz):
+    path = str(tmp_path / "func.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        # a leading member and an extra field move the stored member's data
+        zf.writestr("100/readme.txt", "x" * 1000)
+        info = zipfile.ZipInfo(BOLD)
+        info.extra = b"\xfe\xca\x04\x00abcd"
+        zf.writestr(info, bold_gz, compress_type=zipfile.ZIP_STORED)
+        zf.writestr("100/MNINonLinear/Results/tfMRI_MOTOR_RL/Movement_Regressors.txt", "0 " * 600)
+    return path
+
+
+def test_member_range(archive, bold_gz):
+    with zipfile.ZipFile(archive) as zf:
+        member = member_range(archive, zf.getinfo(BOLD))
+        with pytest.raises(ValueError):
+            member_range(archive, zf.getinfo("100/readme.txt"))
+
+    with open(archive, "rb") as fp:
+        fp.seek(member.offset)
+        assert fp.read(member.length) == bold_gz
+
+
+def test_range_file_reads_and_seeks(archive, bold_gz):
+    with zipfile.ZipFile(archive) as zf:
+        member = member_range(archive, zf.getinfo(BOLD))
+    fd = os.open(archive, os.O_RDONLY)
+    try:
+        fp = ZipRangeFile(fd, member)
+        assert fp.read(10) == bold_gz[:10]
+        fp.seek(-5, io.SEEK_END)
+        assert fp.read() == bold_gz[-5:]
+        assert fp.read() == b""
+        fp.seek(3)
+        fp.seek(4, io.SEEK_CUR)
+        assert fp.read(3) == bold_gz[7:10]
+        with pytest.raises(ValueError):
+            fp.seek(-1)
+    finally:
+        os.close(fd)
+
+
+def test_stored_members_are_served_in_place(tmp_path, archive, series, bold_gz):
+    vfs = ZipVirtualFS()
+    dest = tmp_path / "work"
+
+    extract_archives([archive], str(dest), patterns=["*.nii.gz", "*.txt"], vfs=vfs)
+
+    path = str(dest / BOLD)
+    assert vfs.paths() == [path]
+    assert vfs.nbytes == len(bold_gz)
+    assert not os.path.exists(path) and os.path.isdir(os.path.dirname(path))
+    assert os.path.exists(str(dest / "100/readme.txt"))
+    assert vfs.glob(str(dest / "*/*/Results/*/*_bold.nii.gz")) == [path]
+
+    with vfs.open(path) as fp, gzip.GzipFile(fileobj=fp) as gz:
+        assert gz.read(4) == b"\x5c\x01\x00\x00"
+    np.testing.assert_array_equal(vfs.load(path).get_fdata(), series)
+    assert read_header(path, vfs=vfs).nvols == 10
+
+    assert vfs.materialize(path) == path
+    assert not vfs.is_virtual(path)
+    with open(path, "rb") as fp:
+        assert fp.read() == bold_gz
+    vfs.close()
+
+
+def test_later_compressed_member_replaces_virtual_one(tmp_path, archive):
+    deflated = str(tmp_path / "func2.zip")
+    with zipfile.ZipFile(deflated, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(BOLD, b"newer")
+    vfs = ZipVirtualFS()
+    dest = tmp_path / "work"
+
+    extract_archives([archive, deflated], str(dest), patterns=["*_bold.nii.gz"], vfs=vfs)
+
+    assert vfs.paths() == []
+    assert (dest / BOLD).read_bytes() == b"newer"
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / "design.fsf"
+    path.write_text("old")
+    (tmp_path / "plain.txt").touch()
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path), "w") as fp:
+            fp.write("partial")
+            raise RuntimeError
+    assert path.read_text() == "old"
+    assert sorted(os.listdir(str(tmp_path))) == ["design.fsf", "plain.txt"]
+
+    with atomic_write(str(path), "w") as fp:
+        fp.write("new")
+    assert path.read_text() == "new"
+    # permissions as for a file created with open(), unless given
+    assert stat.S_IMODE(path.stat().st_mode) == stat.S_IMODE((tmp_path / "plain.txt").stat().st_mode)
+
+    out = atomic_write(str(tmp_path / "out.zip"), perms=0o751)
+    out.file.write(b"PK")
+    out.commit()
+    assert stat.S_IMODE((tmp_path / "out.zip").stat().st_mode) == 0o751
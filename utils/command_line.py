@@ -13,8 +13,8 @@ Examples:
     ["ls", "-l", "-a", "-h"]
     >>> exec_command(command)
 
-will both build a command-line list and execute it with the subprocess
-Popen command. Providing `stdout`, `stderr`, and raising an `exception` on
+will both build a command-line list and execute it, see
+`process_runner.run_process`. Providing `stdout`, `stderr`, and raising an `exception` on
 non-zero exit from the command.
 
     >>> command = ["du"]
@@ -33,7 +33,8 @@ built from gear configuration options.
 """
 
 import logging
-import subprocess as sp
+
+from utils.process_runner import run_command
 
 log = logging.getLogger(__name__)
 
@@ -117,6 +118,7 @@ def exec_command(
     stdout_msg=None,
     cont_output=False,
     cwd=None,
+    timeout=None,
 ):
     """
     An abstraction to execute prepared shell commands using the subprocess module.
@@ -134,8 +136,11 @@ def exec_command(
         stdout_msg (string, optional): A string to notify the user where the
             stdout/stderr has been redirected to. Defaults to None.
         cont_output (bool, optional): Used to provide continuous output of
-            stdout without waiting until the completion of the shell command.
-            Defaults to False.
+            stdout and stderr without waiting until the completion of the shell
+            command. Defaults to False.
+        cwd (str, optional): working directory of the command.
+        timeout (float, optional): seconds after which the command is stopped,
+            and fails. Defaults to None, no limit.
     Returns:
         stdout, stderr, returncode
     Raises:
@@ -152,46 +157,34 @@ def exec_command(
 
     log.info("Executing command: \n %s \n\n", " ".join(command))
     if not dry_run:
-        # The "shell" parameter is needed for bash output redirects
-        # (e.g. >,>>,&>)
-        if shell:
-            run_command = " ".join(command)
-        else:
-            run_command = command
-
-        result = sp.Popen(
-            run_command,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True,
-            env=environ,
-            shell=shell,
-            cwd=cwd,
-        )
-
         # log that we are using an alternate stdout message
         if stdout_msg is not None:
             log.info(stdout_msg)
 
         # if continuous stdout is desired... and we are not redirecting output
-        if cont_output and not (shell and (">" in command)) and (stdout_msg is None):
-            while True:
-                stdout = result.stdout.readline()
-                if stdout == "" and result.poll() is not None:
-                    break
-                if stdout:
-                    print(stdout.rstrip())
-
-            returncode = result.poll()
-            stderr = "".join(result.stderr.readlines())
-        else:
-            stdout, stderr = result.communicate()
+        stream = cont_output and not (shell and (">" in command)) and (stdout_msg is None)
+
+        # The "shell" parameter is needed for bash output redirects
+        # (e.g. >,>>,&>). stdout and stderr are drained concurrently, so
+        # neither pipe can fill up and block the command.
+        result = run_command(
+            command,
+            env=environ,
+            shell=shell,
+            cwd=cwd,
+            timeout=timeout,
+            capture=True,
+            log_output=stream,
+        )
+        stdout, stderr, returncode = result.stdout, result.stderr, result.returncode
 
-            returncode = result.returncode
-            if stdout_msg is None:
-                log.info(stdout)
+        if not stream and stdout_msg is None:
+            log.info(stdout)
 
-        log.info("Command return code: %s", returncode)
+        log.info(
+            "Command return code: %s (%.1f s, cpu %.1f s user %.1f s sys, max rss %.2f GiB)",
+            returncode, result.duration, result.user_s, result.sys_s, result.max_rss_gb
+        )
 
         if returncode != 0:
             log.error(stderr)
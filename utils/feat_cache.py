@@ -0,0 +1,203 @@
+"""Content addressed cache of FEAT output directories.
+
+A FEAT run is fully determined by its inputs, its rendered design file and the
+FSL version. `cache_key` hashes a description of those into a key, and
+`FeatCache` keeps one `.feat` directory per key under a cache root. Entries are
+written under a temporary name and renamed into place, so a partially stored
+entry is never found. The cache is bounded in size; whenever an entry is
+stored, the least recently used entries are evicted until it fits.
+
+Large input archives are not read in full: `hash_zip_listing` hashes the zip
+central directory (member names, sizes and CRC-32s), which changes whenever a
+member does.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from zipfile import ZipFile
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+HASH_BUFSIZE = 1024 ** 2
+
+KEY_FILE = "cache-key.json"
+
+
+def hash_file(path, opener=None):
+    """Return the SHA-256 hex digest of a file's content.
+
+    `opener` opens the path for binary reading instead of `open`, e.g.
+    `ZipVirtualFS.open` for a file still in its archive.
+    """
+    digest = hashlib.sha256()
+    with (opener(path) if opener is not None else open(path, "rb")) as fp:
+        for chunk in iter(lambda: fp.read(HASH_BUFSIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_zip_listing(path):
+    """Return the SHA-256 hex digest of a zip archive's member listing.
+
+    Args:
+        path (str): path to the zip archive
+
+    Returns:
+        str: digest of the names, sizes and CRC-32s of all members
+    """
+    digest = hashlib.sha256()
+    with ZipFile(path, "r") as archive:
+        for info in sorted(archive.infolist(), key=lambda info: info.filename):
+            digest.update(f"{info.filename}\0{info.file_size}\0{info.CRC:08x}\n".encode())
+    return digest.hexdigest()
+
+
+def cache_key(parts):
+    """Hash a description of a FEAT run into a cache key.
+
+    Args:
+        parts (dict): JSON serializable description of everything the outputs
+            depend on, e.g. input digests, design file and FSL version
+
+    Returns:
+        str: hex digest
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def tree_size(path):
+    """Return the total size in bytes of the files below `path`."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            filepath = os.path.join(dirpath, name)
+            if not os.path.islink(filepath):
+                total += os.path.getsize(filepath)
+    return total
+
+
+class FeatCache:
+    """Size bounded, least recently used cache of `.feat` directories."""
+
+    def __init__(self, root, max_gb):
+        """
+        Args:
+            root (str): cache directory, created if needed
+            max_gb (float): maximum total size of the cache in GiB
+        """
+        self.root = str(root)
+        self.max_bytes = int(float(max_gb) * GB)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """Return the cached `.feat` directory for `key`, or None on a miss.
+
+        A hit marks the entry as recently used.
+        """
+        entry = self._entry(key)
+        featdirs = [name for name in os.listdir(entry) if name.endswith(".feat")] if os.path.isdir(entry) else []
+        if not featdirs:
+            return None
+
+        os.utime(entry)
+        return os.path.join(entry, featdirs[0])
+
+    def entries(self):
+        """Yield (key, parts, featdir) for every complete cache entry.
+
+        `parts` is the description the key was made from, see `store`.
+        """
+        for key in sorted(os.listdir(self.root)):
+            entry = self._entry(key)
+            if key.startswith(".") or not os.path.isfile(os.path.join(entry, KEY_FILE)):
+                continue
+            featdirs = [name for name in os.listdir(entry) if name.endswith(".feat")]
+            if not featdirs:
+                continue
+            with open(os.path.join(entry, KEY_FILE)) as fp:
+                parts = json.load(fp)
+            yield key, parts, os.path.join(entry, featdirs[0])
+
+    def restore(self, key, featdir):
+        """Copy the cached `.feat` directory for `key` to `featdir`.
+
+        Returns:
+            bool: True on a hit, False if nothing is cached for `key`
+        """
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+
+        start = time.monotonic()
+        shutil.copytree(cached, featdir, symlinks=True, dirs_exist_ok=True)
+        log.info("Restored %s from cache entry %s in %.1f s", featdir, key, time.monotonic() - start)
+        return True
+
+    def store(self, key, featdir, parts=None):
+        """Store a copy of `featdir` for `key` and evict old entries if needed.
+
+        Args:
+            key (str): cache key, see `cache_key`
+            featdir (str): `.feat` directory to store
+            parts (dict, optional): description the key was made from, saved
+                alongside the entry for reference
+        """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+
+        size = tree_size(featdir)
+        if size > self.max_bytes:
+            log.warning("Not caching %s: %.1f GiB exceeds the cache size", featdir, size / GB)
+            return
+
+        tmp_entry = tempfile.mkdtemp(prefix="." + key + ".", suffix=".part", dir=self.root)
+        try:
+            shutil.copytree(featdir, os.path.join(tmp_entry, os.path.basename(featdir)), symlinks=True)
+            with open(os.path.join(tmp_entry, KEY_FILE), "w") as fp:
+                json.dump(parts or {}, fp, indent=2, sort_keys=True)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+            # stored concurrently by another run
+            return
+
+        log.info("Cached %s (%.1f GiB) as %s", featdir, size / GB, key)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its maximum size.
+
+        Returns:
+            int: number of entries removed
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and not name.startswith("."):
+                entries.append((os.stat(path).st_mtime, tree_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            log.info("Evicting cache entry %s (%.1f GiB)", os.path.basename(path), size / GB)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        return removed
@@ -5,12 +5,24 @@ import pandas as pd
 from bs4 import BeautifulSoup
 import base64
 import argparse
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
+from utils.zip_vfs import atomic_write
+
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
 
+# lxml parses several times faster than the pure python parser; it comes with prov, a dependency of flywheel-bids
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
 
 def parser(context):
     
@@ -54,16 +66,23 @@ def parser(context):
     context.update(args_dict)
     
 
-def update_hyperlinks(obj):
-    # takes old hyperlink format and changes it to within page references
+# linked pages embedded in the flattened report: those linked from report.html (depth 1) and their links (depth 2)
+MAX_DEPTH = 2
+
+# pages whose links are not followed
+LEAF_PAGES = ["firstlevel", "reg"]
+
+
+def update_hyperlinks(obj, base="."):
+    # takes old hyperlink format and changes it to within page references, links are relative to base
     
     filelist=[]; reftext=[]
     
     for a in obj.find_all('a'):
-        if ".html" in a['href']:
+        if ".html" in a.get('href', '') and not a['href'].startswith("#"):
             
             # generate a list of all referenced files (they need to be added to the document later)
-            filelist.append(str(Path(a['href']).resolve()))
+            filelist.append(str(Path(base, a['href']).resolve()))
             reftext.append(a.string)
             
             # update reference method
@@ -79,9 +98,48 @@ def url_can_be_converted_to_data(tag):
     return tag.name.lower() == "img" and tag.has_attr('src') and not re.match('^data:', tag['src'])
 
 
-def update_image_refs(obj,parentPath,htmlpath):
+class ImageEncoder:
+    """Base64 encode images on a thread pool. Each image is read and encoded once, however many pages refer to it."""
+
+    def __init__(self, max_workers=None):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(path):
+        with open(path, "rb") as image_file:
+            return "data:image/png;base64, " + base64.b64encode(image_file.read()).decode('utf-8')
+
+    def submit(self, path):
+        "start encoding an image, unless it was already, and return its future data uri"
+        key = os.path.realpath(path)
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self._pool.submit(self._encode, key)
+            return self._futures[key]
+
+    def encode_all(self, refs):
+        "set the src of each (img, path) pair to the image data uri, encoding the images concurrently"
+        futures = [(img, self.submit(path)) for img, path in refs]
+        for img, future in futures:
+            img['src'] = future.result()
+
+    def close(self):
+        self._pool.shutdown()
+        self._futures.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def update_image_refs(obj,parentPath,htmlpath,encoder=None):
     "update all image references to be local paths"
     
+    refs = []
     for a in obj.find_all('a'):
         for img in a.find_all('img'):
             if img.has_attr("src") and any(ele in img["src"] for ele in [".png",".svg",".jpeg"]):
@@ -91,27 +149,129 @@ def update_image_refs(obj,parentPath,htmlpath):
                 else:
                     path=os.path.join(htmlpath,img["src"])
                     
-                with open(path, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read())
-                
-                img['src'] = "data:image/png;base64, " + encoded_string.decode('utf-8')
+                refs.append((img, path))
+
+    if encoder is None:
+        with ImageEncoder() as encoder:
+            encoder.encode_all(refs)
+    else:
+        encoder.encode_all(refs)
             
 
-def cleanup_image_refs(html):
+def cleanup_image_refs(html,encoder=None):
     "update any remaining image links"
+    refs = []
     for link in html.findAll(url_can_be_converted_to_data):
         if "tsplot" in link['src']:
-            with open(os.path.join("tsplot",link['src'].replace("file:","")), "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read())
-
-            link['src'] = "data:image/png;base64, " + encoded_string.decode('utf-8')
+            refs.append((link, os.path.join("tsplot",link['src'].replace("file:",""))))
         else:
-            with open(link['src'].replace("file:",""), "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read())
+            refs.append((link, link['src'].replace("file:","")))
 
-            link['src'] = "data:image/png;base64, " + encoded_string.decode('utf-8')
+    if encoder is None:
+        with ImageEncoder() as encoder:
+            encoder.encode_all(refs)
+    else:
+        encoder.encode_all(refs)
             
         
+def read_page(path):
+    "parse an html page, None if it is missing or has no body"
+    if not os.path.isfile(path):
+        log.warning("Linked page %s not found", path)
+        return None
+
+    with open(path) as inf:
+        txt = inf.read()
+    ihtml = BeautifulSoup(txt, PARSER)
+
+    if not ihtml.find_all('body'):
+        return None
+
+    return ihtml
+
+
+def crawl(featfile):
+    """Traverse the report link graph breadth first from report.html, each page once, in the order pages are first
+    linked. Links are followed to MAX_DEPTH, except from LEAF_PAGES. Each page is parsed when it is reached, and its
+    links are rewritten to within page references. Parsing holds the GIL, so it is not spread over threads; the
+    images of the pages are encoded concurrently instead, see ImageEncoder.
+
+    Yields (path, depth, ref, ihtml): the page, its depth (0 for report.html), the text of the first link to it and the
+    parsed page. report.html is yielded at depth 0 for its summary, and again, like any other page, where it is linked.
+    """
+    featdir = Path(featfile).parent.resolve()
+    root = str(Path(featfile).resolve())
+
+    visited = set()
+    level = [(root, None)]
+    for depth in range(MAX_DEPTH + 1):
+        next_level = []
+        for path, ref in level:
+            ihtml = read_page(path)
+            if ihtml is None:
+                continue
+
+            links = update_hyperlinks(ihtml, Path(path).parent)
+
+            leaf = depth > 0 and any(name in os.path.relpath(path, featdir) for name in LEAF_PAGES)
+            if depth < MAX_DEPTH and not leaf:
+                for link, text in zip(links["files"], links["refs"]):
+                    if link not in visited:
+                        visited.add(link)
+                        # links without text (e.g. around an image) have no reference text
+                        next_level.append((link, str(text) if isinstance(text, str) else None))
+
+            yield path, depth, ref, ihtml
+
+        level = next_level
+
+
+class SectionWriter:
+    """Write the flattened report one section at a time, in the order they are added, inside the body of the base
+    document. Sections are freed once written, so only one sub-report is held in memory."""
+
+    PLACEHOLDER = "@@feat-report-sections@@"
+
+    def __init__(self, path, base, encoder=None):
+        self.path = str(path)
+        self.encoder = encoder
+
+        # split the base document around the start of its body
+        contents = list(base.body.contents)
+        base.body.clear()
+        base.body.append(self.PLACEHOLDER)
+        for child in contents:
+            base.body.append(child)
+        self._head, self._tail = base.decode(formatter="html").split(self.PLACEHOLDER, 1)
+
+        self._out = atomic_write(self.path, "w")
+        self._fp = self._out.file
+        self._fp.write(self._head)
+
+    def write(self, section):
+        "inline the remaining images of a section, write it and free it"
+        cleanup_image_refs(section, self.encoder)
+        self._fp.write(section.decode(formatter="html"))
+        self._fp.write("\n")
+        section.decompose()
+
+    def close(self):
+        self._fp.write(self._tail)
+        self._out.commit()
+
+    def abort(self):
+        self._out.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 def execute_cmd(cmd, dryrun=False):
     log.info("\n %s", cmd)
     if not dryrun:
@@ -126,7 +286,7 @@ def execute_cmd(cmd, dryrun=False):
     
     
 def main(featfile):
-    featfile = Path(featfile)
+    featfile = Path(featfile).resolve()
     
     cwd=os.getcwd()
     os.chdir(featfile.parent)
@@ -137,111 +297,58 @@ def main(featfile):
     # load the base file...
     with open(data) as inf:
         txt = inf.read()
-    soup = BeautifulSoup(txt, 'html.parser')
-    
-    # load the main report file...
-    with open(featfile) as inf:
-        txt = inf.read()
-    html1 = BeautifulSoup(txt, 'html.parser')
-    
-    df = update_hyperlinks(html1)
-    files = df["files"]
-    
-    # add inital report "table" to base, then look through all subsequent files
-    new_div = soup.new_tag("div",id="summary")
-    new_return_link=soup.new_tag("a",href="#summary")
-    new_return_link.string = "Return to Top"
-    
-    # add new contents inside division
-    new_div.insert(0, html1.table)
-    soup.body.insert(0, new_div)
-    
-    # ----- End Base Header ----- #
-    
-    allfiles = []; allrefs=[];
-    for idx, f in enumerate(files):
-        # load the main report file...
-        htmlpath=Path(os.path.join(featfile.parent,f))
-        
-        with open(htmlpath) as inf:
-            txt = inf.read()
-        ihtml = BeautifulSoup(txt, 'html.parser')
-        
-        if not ihtml.find_all('body'):
-            continue
-            
-        for tmp in ihtml.body.find_all('object'):
-            tmp.decompose()
-        
-        df = update_hyperlinks(ihtml)
-        df = df.drop_duplicates(subset=['files'])
-        
-        if any(name in f for name in ["firstlevel","reg"]):
-            pass
-        else:
-            log.info(f)
-            allfiles.extend(df['files'])
-            allrefs.extend(df['refs'])
-        
-        update_image_refs(ihtml,featfile.parent,htmlpath.parent)
-        
-        # add inital report "table" to base, then look through all subsequent files
-        new_div = soup.new_tag("div",id=Path(f).name)
-        
-        new_return_link=soup.new_tag("a",href="#summary")
-        new_return_link.string = "Return to Top"
-        
-        # add new contents inside division
-        ihtml.body.insert(0, new_return_link)
-        new_div.insert(0, ihtml.body)
-        soup.body.insert(idx+1, new_div)
-        
-    # ---- Loop through all secondary linked htmls ----- #
-    for idxx, f in enumerate(allfiles):
+    soup = BeautifulSoup(txt, PARSER)
 
-        htmlpath=Path(f)
-        with open(htmlpath) as inf:
-            txt = inf.read()
-        ihtml = BeautifulSoup(txt, 'html.parser')
-        
-        if not ihtml.find_all('body'):
-            continue
-            
-        for tmp in ihtml.body.find_all('object'):
-            tmp.decompose()
-        
-        ifiles, reftext = update_hyperlinks(ihtml)
-        
-        update_image_refs(ihtml,featfile.parent,htmlpath.parent)
-        
-        # add inital report "table" to base, then look through all subsequent files
-        new_div = soup.new_tag("div",id=os.path.relpath(Path(f), start = featfile.parent))
-        new_tag = soup.new_tag("h2")
-        if allrefs[idxx]:
-            new_tag.string = allrefs[idxx]
-        else:
-            new_tag.string = allfiles[idxx]
-        
-        new_return_link=soup.new_tag("a",href="#summary")
-        new_return_link.string = "Return to Top"
-        
-        # add new contents inside division
-        ihtml.body.insert(0, new_return_link)
-        ihtml.body.insert(1, new_tag)
-        new_div.insert(0, ihtml.body)
-        soup.body.insert(idxx+idx+1, new_div)
-    
-        
-    # ---- write output ------ #
-    cleanup_image_refs(soup)
-    
+    # images shared between pages are encoded once
+    encoder = ImageEncoder()
+
+    # sections are written to index.html as they are built
     log.info("Writing html: %s",os.path.join(featfile.parent,"index.html"))
-    html = soup.prettify(formatter="html")
+    writer = SectionWriter(os.path.join(featfile.parent,"index.html"), soup, encoder)
     
-    with open(os.path.join(featfile.parent,"index.html"), "w") as outf:
-        outf.write(str(html))
+    # ---- one section per linked page, in breadth first order ----- #
+    try:
+        for path, depth, ref, ihtml in crawl(featfile):
+            if depth == 0:
+                log.info("Summary: %s", path)
+
+                # add inital report "table" to base, then look through all subsequent files
+                new_div = soup.new_tag("div",id="summary")
+                if ihtml.table is not None:
+                    new_div.insert(0, copy.copy(ihtml.table))
+                writer.write(new_div)
+                continue
+
+            log.info(path)
+
+            for tmp in ihtml.body.find_all('object'):
+                tmp.decompose()
 
-    os.chdir(cwd)
+            update_image_refs(ihtml,featfile.parent,Path(path).parent,encoder)
+
+            # add report contents in a division named after the page, as referenced by the rewritten links
+            new_div = soup.new_tag("div",id=os.path.relpath(path, start=featfile.parent))
+
+            new_return_link=soup.new_tag("a",href="#summary")
+            new_return_link.string = "Return to Top"
+
+            # add new contents inside division
+            ihtml.body.insert(0, new_return_link)
+            if depth > 1:
+                new_tag = soup.new_tag("h2")
+                new_tag.string = ref or os.path.relpath(path, start=featfile.parent)
+                ihtml.body.insert(1, new_tag)
+            new_div.insert(0, ihtml.body)
+            writer.write(new_div)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        encoder.close()
+        os.chdir(cwd)
+
+    # ---- write output ------ #
+    writer.close()
         
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 
 import logging
 import os
+import resource
 
 import psutil
 
@@ -66,3 +67,13 @@ def set_mem_gb(mem_gb):
         log.info("using mem_gb = %d GiB (maximum available)", psutil_mem_gb)
 
     return mem_gb
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process so far, in MiB.
+
+    Returns:
+        peak_rss (float): maximum resident set size in MiB
+    """
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,210 @@
+"""Selective extraction of HCPPipeline output archives.
+
+The HCP structural and functional zips hold far more than a first level FEAT
+analysis reads. Rather than extracting everything, the zip central directory
+is read and only the members matching a small manifest of path patterns are
+written to disk. Members from all input archives are inflated together in a
+bounded process pool, and each file is written under a temporary name and
+renamed into place once complete, so an interrupted run never leaves a
+truncated image behind. Stored (uncompressed) NIfTI members can instead be
+served in place from the archive through a `ZipVirtualFS`.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from pathlib import PurePosixPath
+from zipfile import ZIP_STORED, ZipFile
+
+from utils.zip_vfs import copy_atomic, member_range
+
+log = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+
+def hcp_manifest(task_names, icafix=False, motion_confound=False, extra_files=()):
+    """Build the list of member patterns needed for a FEAT run.
+
+    Patterns are matched from the right hand side of each member path (see
+    `PurePosixPath.match`), so they are independent of the top level folder
+    used inside the archive.
+
+    Args:
+        task_names (list): task names, each used as "*[TASK]*" to select a
+            directory in MNINonLinear/Results
+        icafix (bool, optional): select the ICA-FIX cleaned series instead of
+            the minimally preprocessed series. Defaults to False.
+        motion_confound (bool, optional): also select the movement regressors.
+            Defaults to False.
+        extra_files (list of str, optional): further file names to select in
+            each Results directory, e.g. extra confound regressors
+
+    Returns:
+        patterns (list of str): member patterns to extract
+    """
+    if isinstance(task_names, str):
+        task_names = [task_names]
+
+    patterns = ["MNINonLinear/T1w_restore_brain.nii.gz"]
+
+    for task in task_names:
+        results = "MNINonLinear/Results/*" + task + "*/"
+        if icafix:
+            patterns.append(results + "*clean.nii.gz")
+        else:
+            patterns.append(results + "*_bold.nii.gz")
+
+        if motion_confound:
+            patterns.append(results + "Movement_Regressors.txt")
+
+        patterns.extend(results + name for name in extra_files)
+
+    return patterns
+
+
+def match_members(infolist, patterns):
+    """Split the members of an archive into those needed and those skipped.
+
+    Args:
+        infolist (list of ZipInfo): members from the zip central directory
+        patterns (list of str): member patterns, see `hcp_manifest`. If None,
+            all members are selected.
+
+    Returns:
+        selected (list of ZipInfo): members matching any pattern
+        skipped (list of ZipInfo): all other (non-directory) members
+    """
+    selected = []
+    skipped = []
+    for info in infolist:
+        if info.is_dir():
+            continue
+        member = PurePosixPath(info.filename)
+        if patterns is None or any(member.match(pattern) for pattern in patterns):
+            selected.append(info)
+        else:
+            skipped.append(info)
+
+    return selected, skipped
+
+
+def is_virtual_member(info):
+    """Return True if a member can be read in place rather than extracted."""
+    return info.compress_type == ZIP_STORED and not info.flag_bits & 0x1 and info.filename.endswith(".nii.gz")
+
+
+def extract_member(zip_file, member, dest):
+    """Extract a single archive member atomically.
+
+    The member is streamed into a temporary file next to its final location
+    and renamed into place only after it has been fully written and its CRC
+    checked.
+
+    Args:
+        zip_file (str or ZipFile): path to the zip archive, opened for this
+            member only, or an archive already open
+        member (str): name of the member in the archive
+        dest (str): directory to extract into
+
+    Returns:
+        target (str): path of the extracted file
+    """
+    root = os.path.realpath(dest)
+    target = os.path.realpath(os.path.join(root, member))
+    if not target.startswith(root + os.sep):
+        raise ValueError(f"Refusing to extract {member} outside of {dest}")
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with ExitStack() as stack:
+        if not isinstance(zip_file, ZipFile):
+            zip_file = stack.enter_context(ZipFile(zip_file, "r"))
+        with zip_file.open(member) as src:
+            copy_atomic(src, target)
+
+    return target
+
+
+def extract_archives(zip_filenames, dest, patterns=None, n_workers=1, vfs=None):
+    """Extract the members matching the manifest from one or more archives.
+
+    Members of all archives are pooled and handed out largest first to a pool
+    of `n_workers` processes, so inflating one large series does not hold up
+    the rest.
+
+    Args:
+        zip_filenames (list of str): paths to the zip archives
+        dest (str): directory to extract into
+        patterns (list of str, optional): member patterns, see `hcp_manifest`.
+            Defaults to None, extracting everything.
+        n_workers (int, optional): number of extraction processes. Defaults to 1.
+        vfs (ZipVirtualFS, optional): if given, stored `.nii.gz` members are
+            registered with it instead of being extracted. Defaults to None.
+
+    Returns:
+        extracted_bytes (int): uncompressed size of all extracted members
+        skipped_bytes (int): uncompressed size of all skipped members
+    """
+    jobs = {}
+    skipped_bytes = 0
+    for zip_filename in zip_filenames:
+        with ZipFile(zip_filename, "r") as hcp_zip:
+            selected, skipped = match_members(hcp_zip.infolist(), patterns)
+
+        if not selected:
+            log.warning("No members of %s matched the required files: %s", zip_filename, patterns)
+
+        selected_bytes = sum(info.file_size for info in selected)
+        unused_bytes = sum(info.file_size for info in skipped)
+        log.info(
+            "Selected %d members (%.1f MB), skipped %d members (%.1f MB) from %s",
+            len(selected), selected_bytes / MB, len(skipped), unused_bytes / MB, zip_filename
+        )
+
+        # a member present in several archives is taken from the last one,
+        # as it would have been overwritten when extracting one after another
+        for info in selected:
+            if vfs is not None and is_virtual_member(info):
+                jobs.pop(info.filename, None)
+                vfs.add(os.path.join(dest, info.filename), member_range(zip_filename, info))
+            else:
+                if vfs is not None:
+                    vfs.discard(os.path.join(dest, info.filename))
+                jobs[info.filename] = (info.file_size, zip_filename, info.filename)
+        skipped_bytes += unused_bytes
+
+    jobs = sorted(jobs.values(), reverse=True)
+    extracted_bytes = sum(size for size, _, _ in jobs)
+    n_workers = max(1, min(n_workers or 1, len(jobs)))
+    log.info("Extracting %d members with %d worker(s)", len(jobs), n_workers)
+
+    if n_workers == 1:
+        # each archive is opened once for all of its members
+        with ExitStack() as stack:
+            archives = {}
+            for _, zip_filename, member in jobs:
+                if zip_filename not in archives:
+                    archives[zip_filename] = stack.enter_context(ZipFile(zip_filename, "r"))
+                log.debug("Extracting %s", member)
+                extract_member(archives[zip_filename], member, dest)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(extract_member, zip_filename, member, dest) for _, zip_filename, member in jobs]
+            try:
+                for future in as_completed(futures):
+                    log.debug("Extracted %s", future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    log.info(
+        "Extracted %.1f MB in total, skipped %.1f MB", extracted_bytes / MB, skipped_bytes / MB
+    )
+    if vfs is not None and vfs.paths():
+        log.info(
+            "Serving %d stored member(s) (%.1f MB) in place without extracting", len(vfs.paths()), vfs.nbytes / MB
+        )
+
+    return extracted_bytes, skipped_bytes
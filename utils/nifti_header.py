@@ -0,0 +1,196 @@
+"""Minimal, cached NIfTI-1/NIfTI-2 header reader.
+
+Reading the image dimensions should not require starting an FSL tool or
+decompressing a whole series. `read_header` reads only the first 540 bytes of
+the file (inflating only the start of the gzip stream for `.nii.gz`) and caches
+the result per path, modification time and size.
+"""
+
+import gzip
+import logging
+import os
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+NIFTI1_SIZE = 348
+NIFTI2_SIZE = 540
+
+# (field, offset, format) for the fields we use, see nifti1.h and nifti2.h
+NIFTI1_FIELDS = [
+    ("dim", 40, "8h"),
+    ("datatype", 70, "h"),
+    ("bitpix", 72, "h"),
+    ("pixdim", 76, "8f"),
+    ("vox_offset", 108, "f"),
+    ("scl_slope", 112, "f"),
+    ("scl_inter", 116, "f"),
+    ("xyzt_units", 123, "B"),
+    ("qform_code", 252, "h"),
+    ("sform_code", 254, "h"),
+    ("quatern", 256, "6f"),
+    ("srow", 280, "12f"),
+]
+NIFTI2_FIELDS = [
+    ("datatype", 12, "h"),
+    ("bitpix", 14, "h"),
+    ("dim", 16, "8q"),
+    ("pixdim", 104, "8d"),
+    ("vox_offset", 168, "q"),
+    ("scl_slope", 176, "d"),
+    ("scl_inter", 184, "d"),
+    ("qform_code", 344, "i"),
+    ("sform_code", 348, "i"),
+    ("quatern", 352, "6d"),
+    ("srow", 400, "12d"),
+    ("xyzt_units", 500, "i"),
+]
+
+# seconds per unit for the time bits of xyzt_units
+TIME_UNITS = {8: 1.0, 16: 1e-3, 24: 1e-6}
+
+_NiftiHeader = namedtuple(
+    "NiftiHeader",
+    ["version", "shape", "zooms", "tr", "datatype", "bitpix", "vox_offset", "scl_slope", "scl_inter", "affine",
+     "endianness"],
+)
+
+
+class NiftiHeader(_NiftiHeader):
+    """Fields of a NIfTI header. `tr` is in seconds, `shape` excludes unused dims."""
+
+    __slots__ = ()
+
+    @property
+    def nvols(self):
+        """Number of volumes (1 for a 3D image)."""
+        return self.shape[3] if len(self.shape) > 3 else 1
+
+    @property
+    def nbytes(self):
+        """Size of the uncompressed image data in bytes."""
+        return int(np.prod(self.shape, dtype=np.int64)) * self.bitpix // 8
+
+
+def _quatern_affine(quatern, pixdim):
+    """Build the qform affine from the quaternion parameters."""
+    b, c, d, qx, qy, qz = quatern
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+    ])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * np.array([pixdim[1], pixdim[2], pixdim[3] * qfac])
+    affine[:3, 3] = [qx, qy, qz]
+    return affine
+
+
+def parse_header(data):
+    """Parse the raw bytes of a NIfTI-1 or NIfTI-2 header.
+
+    Args:
+        data (bytes): at least the first 348 (NIfTI-1) or 540 (NIfTI-2) bytes
+            of the file
+
+    Returns:
+        NiftiHeader: the parsed header
+
+    Raises:
+        ValueError: if the data do not start with a NIfTI header
+    """
+    if len(data) < 4:
+        raise ValueError("Not a NIfTI-1 or NIfTI-2 header")
+
+    # sizeof_hdr tells both the version and the byte order
+    for endianness in "<>":
+        (sizeof_hdr,) = struct.unpack_from(endianness + "i", data)
+        if sizeof_hdr in (NIFTI1_SIZE, NIFTI2_SIZE):
+            break
+    else:
+        raise ValueError("Not a NIfTI-1 or NIfTI-2 header")
+
+    if len(data) < sizeof_hdr:
+        raise ValueError("Truncated NIfTI header")
+
+    version, fields = (1, NIFTI1_FIELDS) if sizeof_hdr == NIFTI1_SIZE else (2, NIFTI2_FIELDS)
+
+    hdr = {}
+    for name, offset, fmt in fields:
+        values = struct.unpack_from(endianness + fmt, data, offset)
+        hdr[name] = values if len(values) > 1 else values[0]
+
+    ndim = max(1, min(int(hdr["dim"][0]), 7))
+    shape = tuple(int(n) for n in hdr["dim"][1:ndim + 1])
+    zooms = tuple(float(z) for z in hdr["pixdim"][1:ndim + 1])
+
+    tr = 0.0
+    if ndim > 3:
+        tr = float(hdr["pixdim"][4]) * TIME_UNITS.get(hdr["xyzt_units"] & 0x38, 1.0)
+
+    if hdr["sform_code"] > 0:
+        affine = np.vstack([np.reshape(hdr["srow"], (3, 4)), [0, 0, 0, 1]])
+    elif hdr["qform_code"] > 0:
+        affine = _quatern_affine(hdr["quatern"], hdr["pixdim"])
+    else:
+        affine = np.diag([*(hdr["pixdim"][1:4]), 1.0])
+    # headers are cached and shared, so keep them immutable
+    affine.flags.writeable = False
+
+    return NiftiHeader(
+        version=version,
+        shape=shape,
+        zooms=zooms,
+        tr=tr,
+        datatype=hdr["datatype"],
+        bitpix=hdr["bitpix"],
+        vox_offset=int(hdr["vox_offset"]),
+        scl_slope=float(hdr["scl_slope"]),
+        scl_inter=float(hdr["scl_inter"]),
+        affine=affine,
+        endianness=endianness,
+    )
+
+
+def open_binary(path):
+    """Open a file for binary reading."""
+    return open(path, "rb")
+
+
+@lru_cache(maxsize=256)
+def _cached_header(path, mtime_ns, size, opener):
+    # mtime_ns and size only take part in the cache key
+    with opener(path) as fp:
+        if path.endswith(".gz"):
+            with gzip.GzipFile(fileobj=fp, mode="rb") as gz:
+                data = gz.read(NIFTI2_SIZE)
+        else:
+            data = fp.read(NIFTI2_SIZE)
+    return parse_header(data)
+
+
+def read_header(path, vfs=None):
+    """Read (and cache) the header of a NIfTI file.
+
+    Args:
+        path (str): path to a .nii or .nii.gz file
+        vfs (ZipVirtualFS, optional): read virtual paths from their archive.
+            Defaults to None.
+
+    Returns:
+        NiftiHeader: the parsed header
+    """
+    path = os.path.abspath(str(path))
+    if vfs is not None and vfs.is_virtual(path):
+        member = vfs.member(path)
+        stat = os.stat(member.archive)
+        return _cached_header(path, stat.st_mtime_ns, (member.offset, member.length), vfs.open)
+
+    stat = os.stat(path)
+    return _cached_header(path, stat.st_mtime_ns, stat.st_size, open_binary)
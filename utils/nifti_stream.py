@@ -0,0 +1,208 @@
+"""Memory-bounded streaming of 4D NIfTI series.
+
+NIfTI data are stored x fastest and time slowest, so each volume is one
+contiguous run of bytes. Reading and writing the series in blocks of whole
+volumes therefore keeps both the (gzip) input and output streams strictly
+sequential while holding only one block in memory at a time. The block length
+is chosen from a memory ceiling, e.g. from `set_performance_config.set_mem_gb`.
+"""
+
+import gzip
+import logging
+
+import numpy as np
+
+from utils.nifti_header import open_binary, read_header
+from utils.zip_vfs import atomic_write
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# NIfTI datatype codes supported for streaming
+DATATYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+# gzip level nibabel uses for .nii.gz, favouring speed
+COMPRESSLEVEL = 1
+
+
+def block_length(header, max_bytes, copies=3):
+    """Number of volumes per block so that `copies` float32 blocks fit in `max_bytes`.
+
+    Args:
+        header (NiftiHeader): header of the series, see `read_header`
+        max_bytes (int): memory ceiling for the block buffers in bytes
+        copies (int, optional): number of block sized buffers alive at once
+            (raw data, float32 data and output). Defaults to 3.
+
+    Returns:
+        int: volumes per block, at least 1
+    """
+    volume_bytes = int(np.prod(header.shape[:3], dtype=np.int64)) * max(4, header.bitpix // 8)
+    return int(max(1, min(header.nvols, max_bytes // (volume_bytes * copies))))
+
+
+def data_scaling(header):
+    """Return the (slope, intercept) to apply to the stored data, or None if the data are unscaled.
+
+    As in nibabel, a slope of 0 or a non-finite slope means no scaling, intercept included.
+    """
+    slope, inter = header.scl_slope, header.scl_inter
+    if not np.isfinite(slope) or slope == 0.0:
+        return None
+    if not np.isfinite(inter):
+        inter = 0.0
+    if slope == 1.0 and inter == 0.0:
+        return None
+    return slope, inter
+
+
+def iter_volume_blocks(path, block_vols, vfs=None, start=0):
+    """Read a 4D series sequentially in blocks of whole volumes.
+
+    Scaling (scl_slope/scl_inter, see `data_scaling`) is applied and blocks are returned as float32
+    arrays of shape (x, y, z, n).
+
+    Args:
+        path (str): path to a .nii or .nii.gz file
+        block_vols (int): maximum number of volumes per block
+        vfs (ZipVirtualFS, optional): read virtual paths from their archive
+        start (int, optional): first volume to read. Defaults to 0.
+
+    Yields:
+        (t0, t1, block): volume range [t0, t1) and its data
+    """
+    header = read_header(path, vfs=vfs)
+    if header.datatype not in DATATYPES:
+        raise ValueError(f"Unsupported NIfTI datatype {header.datatype} for streaming: {path}")
+
+    dtype = np.dtype(DATATYPES[header.datatype]).newbyteorder(header.endianness)
+    spatial = header.shape[:3] + (1,) * (3 - len(header.shape[:3]))
+    volume_bytes = int(np.prod(spatial, dtype=np.int64)) * dtype.itemsize
+    scaling = data_scaling(header)
+
+    opener = vfs.open if vfs is not None else open_binary
+    with opener(path) as raw:
+        fp = gzip.GzipFile(fileobj=raw, mode="rb") if str(path).endswith(".gz") else raw
+        try:
+            fp.seek(header.vox_offset + start * volume_bytes)
+            for t0 in range(start, header.nvols, block_vols):
+                t1 = min(t0 + block_vols, header.nvols)
+                buffer = fp.read((t1 - t0) * volume_bytes)
+                if len(buffer) != (t1 - t0) * volume_bytes:
+                    raise ValueError(f"Unexpected end of image data in {path}")
+                block = np.frombuffer(buffer, dtype=dtype).reshape(spatial + (t1 - t0,), order="F")
+                block = block.astype(np.float32)
+                if scaling is not None:
+                    block *= scaling[0]
+                    block += scaling[1]
+                yield t0, t1, block
+        finally:
+            if fp is not raw:
+                fp.close()
+
+
+def temporal_mean(path, block_vols, vfs=None, start=0):
+    """Voxelwise mean over volumes `start` onwards, computed block by block.
+
+    Args:
+        path (str): path to a .nii or .nii.gz file
+        block_vols (int): maximum number of volumes per block
+        vfs (ZipVirtualFS, optional): read virtual paths from their archive
+        start (int, optional): first volume to include. Defaults to 0.
+
+    Returns:
+        np.ndarray: float32 mean volume
+    """
+    total = None
+    count = 0
+    for t0, t1, block in iter_volume_blocks(path, block_vols, vfs=vfs, start=start):
+        block_sum = block.sum(axis=-1, dtype=np.float64)
+        total = block_sum if total is None else total + block_sum
+        count += t1 - t0
+    return (total / count).astype(np.float32)
+
+
+class NiftiStreamWriter:
+    """Write a float32 NIfTI image incrementally, one block of volumes at a time.
+
+    The file is written under a temporary name and renamed into place by
+    `close`, so an interrupted run does not leave a truncated image.
+
+    Example:
+        >>> with NiftiStreamWriter("out.nii.gz", img.header, img.shape) as writer:
+        ...     for t0, t1, block in iter_volume_blocks("in.nii.gz", 16):
+        ...         writer.write(block)
+    """
+
+    def __init__(self, path, header, shape):
+        """
+        Args:
+            path (str): output .nii or .nii.gz path
+            header (nibabel Nifti1Header or Nifti2Header): template header, copied
+            shape (tuple): shape of the full 4D output
+        """
+        self.path = str(path)
+        self.shape = tuple(shape)
+        self._expected = int(np.prod(self.shape, dtype=np.int64))
+        self._written = 0
+
+        hdr = header.copy()
+        hdr.set_data_dtype(np.float32)
+        hdr.set_data_shape(self.shape)
+        hdr.set_slope_inter(1.0, 0.0)
+        offset = hdr.sizeof_hdr + 4 + hdr.extensions.get_sizeondisk()
+        hdr.set_data_offset(offset + (-offset % 16))
+
+        self._out = atomic_write(self.path)
+        self._raw = self._out.file
+        if self.path.endswith(".gz"):
+            self._fp = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=COMPRESSLEVEL)
+        else:
+            self._fp = self._raw
+
+        # header, extension flag and extensions, padded up to vox_offset
+        hdr.write_to(self._fp)
+        self._fp.write(b"\0" * (hdr.get_data_offset() - self._fp.tell()))
+        self._dtype = hdr.get_data_dtype()
+
+    def write(self, block):
+        """Append a block of whole volumes, shape (x, y, z, n)."""
+        data = np.asarray(block, dtype=self._dtype)
+        self._fp.write(data.tobytes(order="F"))
+        self._written += data.size
+
+    def close(self):
+        """Finish the file and move it into place."""
+        if self._fp is not self._raw:
+            self._fp.close()
+        if self._written != self._expected:
+            self._out.abort()
+            raise ValueError(f"Wrote {self._written} of {self._expected} voxels to {self.path}")
+        self._out.commit()
+
+    def abort(self):
+        """Discard the partially written file."""
+        if self._fp is not self._raw:
+            self._fp.close()
+        self._out.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,154 @@
+"""In-process index of paths for glob and regex lookups.
+
+The index is built once, from an extracted directory tree and/or straight from
+zip central directories, and answers shell-style glob patterns without spawning
+a shell. Lookups always return a (possibly empty) sorted list of paths.
+"""
+
+import bisect
+import logging
+import os
+import re
+from zipfile import ZipFile
+
+log = logging.getLogger(__name__)
+
+_WILDCARDS = re.compile(r"[*?\[]")
+
+
+def glob_to_regex(pattern):
+    """Translate a shell glob pattern into a compiled regular expression.
+
+    `*`, `?` and `[...]` never match across "/" and, as in the shell, do not
+    match a leading "." unless the pattern does. A `**` path segment matches
+    zero or more directories.
+
+    Args:
+        pattern (str): glob pattern
+
+    Returns:
+        re.Pattern: expression matching whole paths
+    """
+    segments = pattern.split("/")
+    regex = ""
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            regex += r"(?!\.)[^/]*(?:/(?!\.)[^/]*)*" if last else r"(?:(?!\.)[^/]*/)*"
+            continue
+
+        if segment and not segment.startswith("."):
+            regex += r"(?!\.)"
+
+        j = 0
+        while j < len(segment):
+            char = segment[j]
+            if char == "*":
+                regex += "[^/]*"
+            elif char == "?":
+                regex += "[^/]"
+            elif char == "[" and segment.find("]", j + 2) != -1:
+                end = segment.find("]", j + 2)
+                chars = segment[j + 1:end]
+                negate = chars.startswith("!")
+                if negate:
+                    chars = chars[1:]
+                # "\\" and "[" are literal in a glob set, and so is a leading "^"
+                chars = chars.replace("\\", "\\\\").replace("[", "\\[")
+                if chars.startswith("^"):
+                    chars = "\\" + chars
+                regex += "[" + ("^" if negate else "") + chars + "]"
+                j = end
+            else:
+                regex += re.escape(char)
+            j += 1
+
+        if not last:
+            regex += "/"
+
+    return re.compile(regex + r"\Z")
+
+
+class PathIndex:
+    """Sorted set of absolute paths (files and directories) supporting globbing."""
+
+    def __init__(self, paths=()):
+        self._paths = set()
+        self._sorted = []
+        self.update(paths)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._paths
+
+    def add(self, path):
+        """Add a path and all its parent directories."""
+        path = os.path.abspath(path)
+        while path not in self._paths and path != os.path.dirname(path):
+            self._paths.add(path)
+            path = os.path.dirname(path)
+        self._sorted = None
+
+    def update(self, paths):
+        """Add several paths."""
+        for path in paths:
+            self.add(path)
+
+    def add_tree(self, root):
+        """Add every file and directory below `root`."""
+        count = len(self._paths)
+        for dirpath, dirnames, filenames in os.walk(root):
+            self.add(dirpath)
+            self._paths.update(os.path.join(dirpath, name) for name in dirnames + filenames)
+        self._sorted = None
+        log.debug("Indexed %d paths below %s", len(self._paths) - count, root)
+
+    def add_archive(self, zip_filename, dest):
+        """Add the members of a zip archive, as if extracted into `dest`."""
+        with ZipFile(zip_filename, "r") as archive:
+            names = archive.namelist()
+        self.update(os.path.join(dest, name.rstrip("/")) for name in names)
+
+    def _sorted_paths(self):
+        if self._sorted is None:
+            self._sorted = sorted(self._paths)
+        return self._sorted
+
+    def _candidates(self, prefix):
+        """Return the sorted paths starting with `prefix`."""
+        paths = self._sorted_paths()
+        start = bisect.bisect_left(paths, prefix)
+        end = bisect.bisect_left(paths, prefix + "\U0010ffff")
+        return paths[start:end]
+
+    def glob(self, pattern):
+        """Return the sorted paths matching a shell glob pattern.
+
+        Args:
+            pattern (str): glob pattern; relative patterns are made absolute
+
+        Returns:
+            list of str: matching paths, empty if there are none
+        """
+        pattern = os.path.abspath(pattern)
+        match = _WILDCARDS.search(pattern)
+        if match is None:
+            return [pattern] if pattern in self._paths else []
+
+        # only paths below the literal leading directory can match
+        prefix = pattern[:pattern.rfind("/", 0, match.start()) + 1]
+        regex = glob_to_regex(pattern)
+        return [path for path in self._candidates(prefix) if regex.match(path)]
+
+    def search(self, regex, root="/"):
+        """Return the sorted paths below `root` matching a regular expression.
+
+        Args:
+            regex (str or re.Pattern): expression, applied with `re.search`
+            root (str, optional): only consider paths below this directory
+
+        Returns:
+            list of str: matching paths, empty if there are none
+        """
+        regex = re.compile(regex)
+        root = os.path.join(os.path.abspath(root), "")
+        return [path for path in self._candidates(root) if regex.search(path)]
@@ -0,0 +1,262 @@
+"""Asynchronous execution of command line processes.
+
+`run_process` starts a command and drains its stdout and stderr concurrently,
+so a child writing a lot to either stream never blocks on a full pipe, and
+passes each line to the log as it arrives. A command may be given a timeout,
+and cancelling the coroutine stops it: the process group is sent SIGTERM, and
+SIGKILL if it is still running after a grace period. The child is reaped with
+wait4, which also reports its resource usage, so every result records wall
+time, user and system CPU time and the maximum resident set size.
+
+`ProcessRunner` runs many commands at once, at most `max_concurrent` at a
+time. `run_command` runs a single command from synchronous code.
+
+Example:
+    >>> runner = ProcessRunner(max_concurrent=4)
+    >>> results = asyncio.run(runner.run_all({"motor": ["feat", "motor.fsf"], "lang": ["feat", "lang.fsf"]}))
+    >>> result = run_command(["fslnvols", "filtered_func_data"], capture=True)
+    >>> result.stdout
+    '284\\n'
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess as sp
+import time
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# bytes read from a pipe at a time
+READ_SIZE = 64 * 1024
+
+# seconds between SIGTERM and SIGKILL when stopping a process
+KILL_GRACE = 10.0
+
+# returncode is negative for a process ended by a signal, as for subprocess. stdout and stderr are None unless
+# captured. max_rss_gb is the largest resident set of the process or any descendant it waited for.
+ProcessResult = namedtuple(
+    "ProcessResult",
+    ["name", "returncode", "stdout", "stderr", "duration", "user_s", "sys_s", "max_rss_gb", "timed_out"]
+)
+
+
+def format_command(command, shell=False):
+    """Return the command as passed to Popen: one string for the shell, else a list."""
+    if isinstance(command, str):
+        return command
+    return " ".join(command) if shell else list(command)
+
+
+def exit_code(status):
+    """Convert a wait status to a return code, negative for a signal (os.waitstatus_to_exitcode in Python 3.9)."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def _open_reader(pipe):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=READ_SIZE)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return transport, reader
+
+
+async def _drain(reader, name, lines, log_output):
+    """Read a stream to its end, line by line."""
+
+    def emit(line):
+        text = line.decode(errors="replace")
+        if lines is not None:
+            lines.append(text)
+        if log_output:
+            log.info("[%s] %s", name, text.rstrip())
+
+    pending = b""
+    while True:
+        chunk = await reader.read(READ_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        end = pending.rfind(b"\n") + 1
+        if end:
+            for line in pending[:end].splitlines(keepends=True):
+                emit(line)
+            pending = pending[end:]
+    if pending:
+        emit(pending)
+
+
+async def _wait4(pid):
+    """
+    Wait for a child to exit and reap it: (pid, status, rusage). The child is reaped in the event loop, so once it
+    is reaped the task waiting here is done before any other task runs, see _stop.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # no pidfd (Python < 3.9 or Linux < 5.3): wait in a thread, leaving the child to be reaped here
+        await loop.run_in_executor(None, os.waitid, os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        return os.wait4(pid, 0)
+
+    try:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    return os.wait4(pid, 0)
+
+
+async def _stop(pid, waiter):
+    """
+    Terminate the process group of `pid`, then kill it if it has not exited after KILL_GRACE seconds. Once `waiter`
+    has reaped the child, its pid may belong to another process group, which is not signalled.
+    """
+    for sig, grace in [(signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)]:
+        if waiter.done():
+            return
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), grace)
+            return
+        except asyncio.TimeoutError:
+            log.warning("Process %d did not exit %.0f s after SIGTERM, killing it", pid, grace)
+
+
+async def run_process(command, name=None, cwd=None, env=None, shell=False, timeout=None, capture=False,
+                      log_output=True):
+    """
+    Run a command, draining its stdout and stderr concurrently.
+    Args:
+        command (list or str): command line, a list of arguments or, with shell, a string
+        name (str, optional): prefix of the logged output lines. Defaults to the program name.
+        cwd (str, optional): working directory
+        env (dict, optional): environment. Defaults to the environment of this process.
+        shell (bool, optional): run the command through the shell, which facilitates output redirects
+        timeout (float, optional): seconds after which the process is stopped
+        capture (bool, optional): keep the output in the result
+        log_output (bool, optional): log each output line as it arrives
+
+    Returns:
+        result (ProcessResult): return code, output if captured, and resource usage
+
+    Raises:
+        OSError: if the command cannot be started
+    """
+    run_command = format_command(command, shell)
+    if name is None:
+        name = os.path.basename(run_command.split()[0] if isinstance(run_command, str) else run_command[0])
+
+    start = time.monotonic()
+    # a session of its own, so stopping the process also stops everything it started
+    process = sp.Popen(
+        run_command,
+        stdin=sp.DEVNULL,
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        env=env,
+        shell=shell,
+        cwd=cwd,
+        start_new_session=True,
+    )
+
+    output = {"stdout": [] if capture else None, "stderr": [] if capture else None}
+    transports = []
+    drains = []
+    waiter = asyncio.ensure_future(_wait4(process.pid))
+    timed_out = False
+    try:
+        for pipe, lines in [(process.stdout, output["stdout"]), (process.stderr, output["stderr"])]:
+            transport, reader = await _open_reader(pipe)
+            transports.append(transport)
+            drains.append(asyncio.ensure_future(_drain(reader, name, lines, log_output)))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            log.warning("%s timed out after %.1f s, stopping it", name, timeout)
+            await _stop(process.pid, waiter)
+        await asyncio.gather(*drains)
+    except BaseException:
+        # cancelled or failed: do not leave the process running
+        for drain in drains:
+            drain.cancel()
+        await _stop(process.pid, waiter)
+        raise
+    finally:
+        for transport in transports:
+            transport.close()
+
+    _, status, rusage = waiter.result()
+    process.returncode = exit_code(status)
+    duration = time.monotonic() - start
+    # ru_maxrss is reported in KiB on Linux
+    result = ProcessResult(
+        name,
+        process.returncode,
+        "".join(output["stdout"]) if capture else None,
+        "".join(output["stderr"]) if capture else None,
+        duration,
+        rusage.ru_utime,
+        rusage.ru_stime,
+        rusage.ru_maxrss * 1024 / GB,
+        timed_out,
+    )
+    log.debug(
+        "%s exited with %d after %.1f s, cpu %.1f s user %.1f s sys, max rss %.2f GiB",
+        name, result.returncode, duration, result.user_s, result.sys_s, result.max_rss_gb
+    )
+    return result
+
+
+class ProcessRunner:
+    """Run commands concurrently, at most `max_concurrent` at a time."""
+
+    def __init__(self, max_concurrent=None):
+        """
+        Args:
+            max_concurrent (int, optional): processes running at once. Defaults
+                to the number of cores.
+        """
+        self.max_concurrent = max(1, int(max_concurrent or os.cpu_count() or 1))
+        # created in the running event loop, see _get_semaphore
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def run(self, command, **kwargs):
+        """Run a command once a slot is free, see `run_process` for the arguments."""
+        async with self._get_semaphore():
+            return await run_process(command, **kwargs)
+
+    async def run_all(self, commands, **kwargs):
+        """Run several commands, see `run_process` for the arguments.
+
+        Args:
+            commands (dict): command lines by name
+
+        Returns:
+            results (list of ProcessResult): in the order of `commands`
+        """
+        return await asyncio.gather(*[self.run(command, name=name, **kwargs) for name, command in commands.items()])
+
+
+def run_command(command, **kwargs):
+    """Run a command from synchronous code, see `run_process`."""
+    return asyncio.run(run_process(command, **kwargs))
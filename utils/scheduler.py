@@ -0,0 +1,224 @@
+"""Local scheduler running several command line jobs under a CPU and memory budget.
+
+Jobs are queued with the number of cores and the memory they are expected to
+use, and admitted in submission order as soon as enough of the budget is free.
+A queued job that does not fit may be overtaken by a later one that does, so
+the budget is used as fully as possible. A job larger than the whole budget is
+run on its own rather than never. A job may depend on earlier jobs, and only
+starts once they have all succeeded. Jobs run as asyncio tasks, see
+`process_runner.run_process`: the stdout and stderr of every job are streamed
+to the log as they arrive, each line prefixed with the job name, and the CPU
+time and peak memory of each job are recorded in its result.
+
+Example:
+    >>> scheduler = JobScheduler(n_cpus=4, mem_gb=16)
+    >>> scheduler.submit("motor", ["feat", "motor.fsf"], mem_gb=6)
+    >>> scheduler.submit("lang", ["feat", "lang.fsf"], mem_gb=6)
+    >>> results = scheduler.run()
+    >>> log.info("\n%s", format_summary(results))
+"""
+
+import asyncio
+import logging
+from collections import namedtuple
+
+import psutil
+
+from utils.process_runner import ProcessRunner
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+Job = namedtuple("Job", ["name", "command", "cpus", "mem_gb", "cwd", "environ", "shell", "after", "timeout"])
+
+# returncode is None for a job skipped because a job it depends on failed. cpu_s (user and system) and max_rss_gb
+# are the resources the job actually used, 0 if it did not run.
+JobResult = namedtuple(
+    "JobResult", ["name", "returncode", "duration", "cpus", "mem_gb", "cpu_s", "max_rss_gb"], defaults=(0.0, 0.0)
+)
+
+
+class JobScheduler:
+    """Run queued command line jobs concurrently within a CPU and memory budget."""
+
+    def __init__(self, n_cpus, mem_gb, dry_run=False):
+        """
+        Args:
+            n_cpus (int): cores available to all jobs together, see
+                `set_performance_config.set_n_cpus`
+            mem_gb (float): memory (GiB) available to all jobs together, see
+                `set_performance_config.set_mem_gb`
+            dry_run (bool, optional): only log the commands. Defaults to False.
+        """
+        self.n_cpus = max(1, int(n_cpus or 1))
+        self.mem_gb = float(mem_gb or 0)
+        self.dry_run = dry_run
+        self._queue = []
+        self._names = []
+        # running jobs and their tasks, by job name
+        self._running = {}
+        self._results = []
+        self._runner = ProcessRunner(max_concurrent=self.n_cpus)
+
+    def submit(self, name, command, cpus=1, mem_gb=0.0, cwd=None, environ=None, shell=False, after=(), timeout=None):
+        """Queue a job.
+
+        Args:
+            name (str): job name, used to prefix its output and in the summary
+            command (list): command line, as for `command_line.exec_command`
+            cpus (int, optional): cores the job uses. Defaults to 1.
+            mem_gb (float, optional): memory (GiB) the job is expected to use.
+                Defaults to 0.
+            cwd (str, optional): working directory of the job
+            environ (dict, optional): environment of the job. Defaults to the
+                environment of this process.
+            shell (bool, optional): run the command through the shell
+            after (list of str, optional): names of jobs that must succeed
+                before this job starts
+            timeout (float, optional): seconds after which the job is stopped,
+                and fails
+
+        Raises:
+            ValueError: if a job of the same name was already submitted, or a
+                job it depends on was not
+        """
+        if name in self._names:
+            raise ValueError(f"A job named {name} was already submitted")
+        unknown = [dependency for dependency in after if dependency not in self._names]
+        if unknown:
+            raise ValueError(f"Job {name} depends on jobs not submitted before it: {unknown}")
+        self._names.append(name)
+        self._queue.append(
+            Job(name, list(command), max(1, int(cpus)), float(mem_gb), cwd, environ, shell, tuple(after), timeout)
+        )
+
+    def _fits(self, job):
+        """Return True if the job can start now without exceeding the budget."""
+        if not self._running:
+            # nothing else is running, so even an oversized job may go
+            return True
+
+        cpus = sum(running.cpus for running, _ in self._running.values())
+        mem_gb = sum(running.mem_gb for running, _ in self._running.values())
+        available_gb = psutil.virtual_memory().available / GB
+
+        return (
+            cpus + job.cpus <= self.n_cpus
+            and mem_gb + job.mem_gb <= self.mem_gb
+            and job.mem_gb <= available_gb
+        )
+
+    def _admit(self):
+        """Start every queued job that is ready and fits, in submission order."""
+        returncodes = {result.name: result.returncode for result in self._results}
+        for job in list(self._queue):
+            if any(returncodes.get(dependency, 0) != 0 for dependency in job.after if dependency in returncodes):
+                log.warning("Skipping %s, as a job it depends on has failed", job.name)
+                self._queue.remove(job)
+                self._results.append(JobResult(job.name, None, 0.0, job.cpus, job.mem_gb))
+                returncodes[job.name] = None
+            elif all(dependency in returncodes for dependency in job.after) and self._fits(job):
+                self._queue.remove(job)
+                self._start(job)
+                returncodes = {result.name: result.returncode for result in self._results}
+
+    def _start(self, job):
+        log.info(
+            "Starting %s (%d cpu(s), %.1f GiB), %d running, %d queued",
+            job.name, job.cpus, job.mem_gb, len(self._running) + 1, len(self._queue)
+        )
+        log.info("[%s] %s", job.name, " ".join(job.command))
+
+        task = asyncio.ensure_future(
+            self._runner.run(
+                job.command, name=job.name, cwd=job.cwd, env=job.environ, shell=job.shell, timeout=job.timeout
+            )
+        )
+        self._running[job.name] = (job, task)
+
+    def _finish(self, job, task):
+        """Record the result of a job whose task is done."""
+        del self._running[job.name]
+        try:
+            result = task.result()
+        except OSError as exc:
+            log.error("Unable to start %s: %s", job.name, exc)
+            self._results.append(JobResult(job.name, 127, 0.0, job.cpus, job.mem_gb))
+            return
+
+        if result.timed_out:
+            log.error("%s timed out after %.1f s", job.name, result.duration)
+        elif result.returncode != 0:
+            log.error("%s failed with return code %d after %.1f s", job.name, result.returncode, result.duration)
+        else:
+            log.info(
+                "%s finished in %.1f s, cpu %.1f s, max rss %.2f GiB",
+                job.name, result.duration, result.user_s + result.sys_s, result.max_rss_gb
+            )
+
+        self._results.append(
+            JobResult(
+                job.name, result.returncode, result.duration, job.cpus, job.mem_gb, result.user_s + result.sys_s,
+                result.max_rss_gb
+            )
+        )
+
+    async def _run(self):
+        try:
+            while self._queue or self._running:
+                self._admit()
+                if self._running:
+                    tasks = {task: job for job, task in self._running.values()}
+                    done, _ = await asyncio.wait(list(tasks), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        self._finish(tasks[task], task)
+        except BaseException:
+            # do not leave orphaned jobs behind when interrupted, cancelling a job stops its process
+            tasks = [task for _, task in self._running.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def run(self):
+        """Run all queued jobs and wait for them to finish.
+
+        Returns:
+            results (list of JobResult): one per job, in submission order
+        """
+        if self.dry_run:
+            for job in self._queue:
+                log.info("[%s] %s", job.name, " ".join(job.command))
+            log.info("Dry run mode set.")
+            self._results = [JobResult(job.name, 0, 0.0, job.cpus, job.mem_gb) for job in self._queue]
+            self._queue = []
+            return self._results
+
+        asyncio.run(self._run())
+
+        return sorted(self._results, key=lambda result: self._names.index(result.name))
+
+
+def format_summary(results):
+    """Format job results as a table of return codes, durations and resource use.
+
+    Args:
+        results (list of JobResult): results from `JobScheduler.run`
+
+    Returns:
+        str: the summary table
+    """
+    width = max([len("job")] + [len(result.name) for result in results])
+    lines = [
+        f"{'job':<{width}}  {'return code':>11}  {'duration (s)':>12}  {'cpus':>4}  {'mem (GiB)':>9}  "
+        f"{'cpu (s)':>9}  {'max rss (GiB)':>13}"
+    ]
+    for result in results:
+        lines.append(
+            f"{result.name:<{width}}  {'skipped' if result.returncode is None else result.returncode:>11}  "
+            f"{result.duration:>12.1f}  "
+            f"{result.cpus:>4}  {result.mem_gb:>9.1f}  "
+            f"{result.cpu_s:>9.1f}  {result.max_rss_gb:>13.2f}"
+        )
+    return "\n".join(lines)
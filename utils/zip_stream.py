@@ -0,0 +1,379 @@
+"""Stream directory trees into zip archives in one pass over the files.
+
+`ParallelZipWriter` writes a zip archive whose members are deflated
+concurrently: each member is cut into chunks that are compressed on a thread
+pool (zlib releases the GIL), as pigz does, and the compressed chunks are
+written out in order. Payloads that are compressed already (`.nii.gz`, `.png`,
+...) are stored rather than deflated again.
+
+`zip_tree` writes each file of a tree straight into such an archive under an
+archive prefix, so no staging copy of the tree is needed, and sets the member
+permissions as it goes. Files can be "teed": their content is also written to
+other sinks (files, or members of other archives) from the same read, e.g. to
+copy a few files out of the tree while it is zipped.
+"""
+
+import collections
+import logging
+import os
+import stat
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+from utils.zip_vfs import atomic_write
+
+log = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+
+COPY_BUFSIZE = 1024 ** 2
+
+# uncompressed size of the chunks deflated concurrently
+CHUNK_SIZE = 1024 ** 2
+
+# deflate window, the dictionary each chunk is primed with from the previous one
+WINDOW_SIZE = 32 * 1024
+
+# zlib default, as "zip"
+DEFAULT_COMPRESSLEVEL = 6
+
+# permissions of archive members and written archives, as after "chmod -R a+rwx"
+MEMBER_MODE = 0o777
+
+# payloads that do not compress further, stored as they are
+STORED_SUFFIXES = (".gz", ".png", ".jpg", ".jpeg", ".zip")
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+
+def compress_type(name, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """ZIP_STORED for already compressed payloads (or compresslevel 0), else ZIP_DEFLATED."""
+    if compresslevel == 0 or name.lower().endswith(STORED_SUFFIXES):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def dos_date_time(timestamp):
+    """Return the MS-DOS (date, time) of a timestamp, as stored in zip headers."""
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    return (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+
+def _deflate(data, compresslevel, zdict, last):
+    """Deflate one chunk as a raw deflate stream that can be concatenated with the next chunk's."""
+    if zdict:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _Member:
+    """Header fields of one archive member."""
+
+    def __init__(self, arcname, method, mtime, mode, is_dir, zip64):
+        self.arcname = arcname
+        self.name = arcname.encode("utf-8")
+        self.flags = 0x800 if not arcname.isascii() else 0
+        self.method = method
+        self.date, self.time = dos_date_time(mtime)
+        self.external_attr = ((stat.S_IFDIR | mode) << 16 | 0x10) if is_dir else (stat.S_IFREG | mode) << 16
+        self.zip64 = zip64
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.offset = 0
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+    def local_header(self):
+        extra = b""
+        sizes = (self.compress_size, self.file_size)
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, self.file_size, self.compress_size)
+            sizes = (ZIP32_LIMIT, ZIP32_LIMIT)
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, self.version, self.flags, self.method, self.time, self.date, self.crc,
+            sizes[0], sizes[1], len(self.name), len(extra)
+        ) + self.name + extra
+
+    def central_header(self):
+        fields = []
+        file_size, compress_size, offset = self.file_size, self.compress_size, self.offset
+        if file_size >= ZIP32_LIMIT:
+            fields.append(file_size)
+            file_size = ZIP32_LIMIT
+        if compress_size >= ZIP32_LIMIT:
+            fields.append(compress_size)
+            compress_size = ZIP32_LIMIT
+        if offset >= ZIP32_LIMIT:
+            fields.append(offset)
+            offset = ZIP32_LIMIT
+        extra = struct.pack("<HH" + "Q" * len(fields), 1, 8 * len(fields), *fields) if fields else b""
+        version = 45 if fields or self.zip64 else 20
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, 3 << 8 | version, version, self.flags, self.method, self.time,
+            self.date, self.crc, compress_size, file_size, len(self.name), len(extra), 0, 0, 0, self.external_attr,
+            offset
+        ) + self.name + extra
+
+
+class MemberWriter:
+    """Writable file object for one member of a ParallelZipWriter, see ParallelZipWriter.open."""
+
+    def __init__(self, archive, member, compresslevel):
+        self._archive = archive
+        self._member = member
+        self._compresslevel = compresslevel
+        self._buffer = bytearray()
+        self._zdict = b""
+
+    def write(self, data):
+        self._member.crc = zlib.crc32(data, self._member.crc)
+        self._member.file_size += len(data)
+        if self._member.method == ZIP_STORED:
+            self._archive._put(bytes(data))
+            return len(data)
+
+        self._buffer += data
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:CHUNK_SIZE]), last=False)
+            del self._buffer[:CHUNK_SIZE]
+        return len(data)
+
+    def _submit(self, chunk, last):
+        self._archive._put(self._archive._pool.submit(_deflate, chunk, self._compresslevel, self._zdict, last))
+        self._zdict = chunk[-WINDOW_SIZE:]
+
+    def close(self):
+        if self._member is None:
+            return
+        if self._member.method == ZIP_DEFLATED:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+        if not self._member.zip64 and self._member.file_size >= ZIP32_LIMIT:
+            raise ValueError(f"{self._member.arcname} is larger than expected, and too large without zip64")
+        self._archive._end(self._member)
+        self._member = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParallelZipWriter:
+    """Write a zip archive, deflating members concurrently and assembling them in order.
+
+    Example:
+        >>> with ParallelZipWriter("out.zip", compresslevel=6) as archive:
+        ...     archive.write("stats/zstat1.nii.gz", "model.feat/stats/zstat1.nii.gz")
+        ...     archive.write("report_log.html", "model.feat/report_log.html")
+    """
+
+    def __init__(self, filename, compresslevel=DEFAULT_COMPRESSLEVEL, n_workers=None, mode=MEMBER_MODE):
+        """
+        Args:
+            filename (str or file object): archive to write, or a writable
+                binary file object, which is left open
+            compresslevel (int, optional): deflate level, 0 (store all) to 9
+            n_workers (int, optional): compression threads. Defaults to the
+                number of cores.
+            mode (int, optional): permissions of the members
+        """
+        self._own_fp = isinstance(filename, (str, os.PathLike))
+        self.filename = str(filename) if self._own_fp else None
+        self.compresslevel = DEFAULT_COMPRESSLEVEL if compresslevel is None else int(compresslevel)
+        self.mode = mode
+        n_workers = n_workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        # compressed chunks waiting to be written, in archive order
+        self._pending = collections.deque()
+        self._max_pending = 4 * n_workers
+        self._members = []
+        self._open = None
+        self._current = None
+        self._fp = open(self.filename, "wb") if self._own_fp else filename
+
+    def open(self, arcname, mtime=None, size_hint=0, is_dir=False):
+        """Start a member and return a writable file object for its content.
+
+        Args:
+            arcname (str): member name
+            mtime (float, optional): modification time. Defaults to now.
+            size_hint (int, optional): expected size, members larger than 4
+                GiB need it to be written as zip64
+            is_dir (bool, optional): write a directory entry
+
+        Returns:
+            MemberWriter: close it before opening the next member
+        """
+        if self._open is not None and self._open._member is not None:
+            raise ValueError(f"Close member {self._open._member.arcname} before opening {arcname}")
+
+        method = ZIP_STORED if is_dir else compress_type(arcname, self.compresslevel)
+        zip64 = size_hint * 1.05 > ZIP32_LIMIT
+        member = _Member(arcname, method, time.time() if mtime is None else mtime, self.mode, is_dir, zip64)
+        self._put(member)
+        self._open = MemberWriter(self, member, self.compresslevel)
+        return self._open
+
+    def write(self, path, arcname, sinks=()):
+        """Copy a file or directory entry into the archive, and the file content to each of `sinks`.
+
+        Returns:
+            int: number of bytes copied
+        """
+        st = os.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            self.open(arcname.rstrip("/") + "/", mtime=st.st_mtime, is_dir=True).close()
+            return 0
+
+        nbytes = 0
+        with open(path, "rb") as src, self.open(arcname, mtime=st.st_mtime, size_hint=st.st_size) as dst:
+            for chunk in iter(lambda: src.read(COPY_BUFSIZE), b""):
+                dst.write(chunk)
+                for sink in sinks:
+                    sink.write(chunk)
+                nbytes += len(chunk)
+        return nbytes
+
+    def writestr(self, arcname, data, mtime=None):
+        """Write bytes as a member."""
+        with self.open(arcname, mtime=mtime, size_hint=len(data)) as dst:
+            dst.write(data)
+
+    def _put(self, item):
+        self._pending.append(item)
+        self._drain(self._max_pending)
+
+    def _end(self, member):
+        # marks the end of the member's data
+        self._pending.append(("end", member))
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending=0):
+        """Write out queued items, in order, until at most max_pending are left."""
+        while len(self._pending) > max_pending:
+            item = self._pending.popleft()
+            if isinstance(item, _Member):
+                self._current = item
+                item.offset = self._fp.tell()
+                self._fp.write(item.local_header())
+            elif isinstance(item, tuple):
+                # rewrite the local header with the final CRC and sizes
+                member = item[1]
+                end = self._fp.tell()
+                self._fp.seek(member.offset)
+                self._fp.write(member.local_header())
+                self._fp.seek(end)
+                self._members.append(member)
+            else:
+                data = item.result() if hasattr(item, "result") else item
+                self._current.compress_size += len(data)
+                self._fp.write(data)
+
+    def close(self):
+        """Write the remaining members and the central directory."""
+        if self._fp is None:
+            return
+        try:
+            if self._open is not None:
+                self._open.close()
+            self._drain()
+
+            start = self._fp.tell()
+            for member in self._members:
+                self._fp.write(member.central_header())
+            end = self._fp.tell()
+
+            entries, size = len(self._members), end - start
+            if entries >= ZIP_MAX_ENTRIES or start >= ZIP32_LIMIT or size >= ZIP32_LIMIT:
+                # zip64 end of central directory record and locator
+                self._fp.write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, entries, entries, size, start))
+                self._fp.write(struct.pack("<IIQI", 0x07064B50, 0, end, 1))
+                entries, size, start = min(entries, ZIP_MAX_ENTRIES), min(size, ZIP32_LIMIT), min(start, ZIP32_LIMIT)
+            self._fp.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, entries, entries, size, start, 0))
+        finally:
+            self._pool.shutdown()
+            if self._own_fp:
+                self._fp.close()
+            self._fp = None
+
+    def abort(self):
+        """Stop writing and discard the archive, if written to a file of its own."""
+        self._pool.shutdown()
+        if self._own_fp:
+            if self._fp is not None:
+                self._fp.close()
+            os.unlink(self.filename)
+        self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def zip_tree(src, zip_filename, arcprefix="", mode=MEMBER_MODE, compresslevel=DEFAULT_COMPRESSLEVEL, tee=None,
+             n_workers=None):
+    """Zip a directory tree in one pass, without staging a copy.
+
+    The archive is written under a temporary name and renamed into place.
+
+    Args:
+        src (str): directory to zip. Symbolic links are followed, as by
+            "zip -r".
+        zip_filename (str): archive to write
+        arcprefix (str, optional): archive path of `src`, e.g.
+            "<destination>/sub-01/ses-01/model.feat"
+        mode (int, optional): permissions of the members and of the archive
+        compresslevel (int, optional): deflate level, 0 (store all) to 9
+        tee (dict, optional): writable binary file objects, by path relative
+            to `src`, that also receive the content of that file
+        n_workers (int, optional): compression threads
+
+    Returns:
+        (nfiles, nbytes): number of files and their total size
+    """
+    tee = tee or {}
+    arcprefix = arcprefix.strip("/")
+    nfiles = nbytes = 0
+    start = time.monotonic()
+
+    with atomic_write(zip_filename, perms=mode) as fp:
+        with ParallelZipWriter(fp, compresslevel=compresslevel, n_workers=n_workers, mode=mode) as archive:
+            for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+                dirnames.sort()
+                reldir = os.path.relpath(dirpath, src)
+                arcdir = arcprefix if reldir == "." else "/".join(filter(None, [arcprefix, reldir.replace(os.sep, "/")]))
+                if arcdir:
+                    archive.write(dirpath, arcdir)
+
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    relpath = os.path.normpath(os.path.join(reldir, name))
+                    if not os.path.isfile(path):
+                        log.warning("Not zipping %s, not a regular file", path)
+                        continue
+                    nbytes += archive.write(path, "/".join(filter(None, [arcdir, name])), tee.get(relpath, ()))
+                    nfiles += 1
+
+    duration = max(time.monotonic() - start, 1e-6)
+    log.info(
+        "Zipped %d files (%.1f MB) to %s in %.1f s, %.1f MB/s",
+        nfiles, nbytes / MB, zip_filename, duration, nbytes / MB / duration
+    )
+    return nfiles, nbytes
@@ -0,0 +1,278 @@
+"""Read-only access to stored (uncompressed) zip members without extracting them.
+
+HCPPipeline archives usually store `.nii.gz` members with ZIP_STORED, since
+compressing gzip data again gains nothing. Such a member is simply a byte range
+inside the archive, so it can be read in place. `ZipVirtualFS` maps paths in
+the working directory onto those byte ranges. Readers that accept file objects
+(e.g. nibabel) read straight from the archive; tools that need a real path
+(e.g. FSL) get the member copied out with `materialize` only when asked for.
+"""
+
+import gzip
+import io
+import logging
+import os
+import shutil
+import struct
+from collections import namedtuple
+from pathlib import PurePosixPath
+from zipfile import ZIP_STORED
+
+import nibabel as nib
+
+log = logging.getLogger(__name__)
+
+# local file header, see APPNOTE.TXT 4.3.7
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+COPY_BUFSIZE = 4 * 1024 ** 2
+
+ZipMemberRange = namedtuple("ZipMemberRange", ["archive", "offset", "length"])
+
+class AtomicFile:
+    """A temporary file next to `path` that replaces `path` once committed, see `atomic_write`."""
+
+    def __init__(self, path, mode="wb", perms=None):
+        self.path = str(path)
+        self._perms = perms
+        directory = os.path.dirname(os.path.abspath(self.path))
+        while True:
+            self._tmp_name = os.path.join(directory, f".{os.path.basename(self.path)}.{os.urandom(4).hex()}.part")
+            try:
+                # created as open() would, so the umask applies
+                fd = os.open(self._tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                continue
+        self.file = os.fdopen(fd, mode)
+
+    def commit(self):
+        """Close the file and rename it to `path`."""
+        try:
+            self.file.close()
+            if self._perms is not None:
+                os.chmod(self._tmp_name, self._perms)
+            os.replace(self._tmp_name, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Close and discard the file, leaving `path` as it was."""
+        self.file.close()
+        if os.path.exists(self._tmp_name):
+            os.unlink(self._tmp_name)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def atomic_write(path, mode="wb", perms=None):
+    """Write `path` through a temporary file in the same directory, renamed into place when complete.
+
+    `path` is never left partially written: an error discards the temporary
+    file. Used as a context manager, the file object is returned and committed
+    on success; writers that outlive a single block call `commit` or `abort` on
+    the returned `AtomicFile` instead.
+
+    Args:
+        path (str): file to write
+        mode (str, optional): "wb" or "w". Defaults to "wb".
+        perms (int, optional): permissions of the file. Defaults to those
+            open() would give it.
+
+    Example:
+        >>> with atomic_write("design.fsf", "w") as fp:
+        ...     fp.write(text)
+    """
+    return AtomicFile(path, mode, perms)
+
+
+def copy_atomic(src, target):
+    """Stream a binary file object to `target`, renaming it into place when complete."""
+    with atomic_write(target) as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
+def member_range(zip_filename, info):
+    """Resolve a stored archive member to its byte range inside the archive.
+
+    Args:
+        zip_filename (str): path to the zip archive
+        info (ZipInfo): the member, taken from the archive's central directory
+
+    Returns:
+        ZipMemberRange: (archive, offset, length) of the member data
+
+    Raises:
+        ValueError: if the member is compressed or encrypted
+    """
+    if info.compress_type != ZIP_STORED or info.flag_bits & 0x1:
+        raise ValueError(f"{info.filename} is not a plain stored member of {zip_filename}")
+
+    with open(zip_filename, "rb") as fp:
+        fp.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"Bad local file header for {info.filename} in {zip_filename}")
+
+    filename_length, extra_length = header[-2:]
+    offset = info.header_offset + LOCAL_HEADER.size + filename_length + extra_length
+
+    return ZipMemberRange(str(zip_filename), offset, info.compress_size)
+
+
+class ZipRangeFile(io.RawIOBase):
+    """Seekable, read-only file object over a byte range of an archive.
+
+    Reads use `os.pread`, so several views may share one descriptor.
+    """
+
+    def __init__(self, fd, member):
+        super().__init__()
+        self._fd = fd
+        self._start = member.offset
+        self._length = member.length
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._length + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), max(0, self._length - self._pos))
+        if size == 0:
+            return 0
+        data = os.pread(self._fd, size, self._start + self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class ZipVirtualFS:
+    """Map working directory paths onto stored members of zip archives."""
+
+    def __init__(self):
+        self._members = {}
+        self._fds = {}
+
+    def add(self, path, member):
+        """Serve `member` (a ZipMemberRange) at `path`.
+
+        The parent directory of `path` is created so directory lookups behave
+        as if the member had been extracted.
+        """
+        path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._members[path] = member
+        log.debug("Serving %s from %s at offset %d", path, member.archive, member.offset)
+
+    def discard(self, path):
+        """Stop serving `path` from an archive, if it was."""
+        self._members.pop(os.path.abspath(path), None)
+
+    def paths(self):
+        """Return the sorted list of paths served from archives."""
+        return sorted(self._members)
+
+    @property
+    def nbytes(self):
+        """Total size of all members served in place."""
+        return sum(member.length for member in self._members.values())
+
+    def member(self, path):
+        """Return the ZipMemberRange served at `path`, or None if it is not virtual."""
+        return self._members.get(os.path.abspath(path))
+
+    def is_virtual(self, path):
+        """Return True if `path` is served from an archive rather than from disk."""
+        return os.path.abspath(path) in self._members
+
+    def glob(self, pattern):
+        """Return the sorted virtual paths matching a glob pattern."""
+        pattern = os.path.abspath(pattern)
+        return sorted(path for path in self._members if PurePosixPath(path).match(pattern))
+
+    def _fd(self, archive):
+        if archive not in self._fds:
+            self._fds[archive] = os.open(archive, os.O_RDONLY)
+        return self._fds[archive]
+
+    def open(self, path):
+        """Open `path` for binary reading, from its archive if it is virtual."""
+        member = self._members.get(os.path.abspath(path))
+        if member is None:
+            return open(path, "rb")
+        return io.BufferedReader(ZipRangeFile(self._fd(member.archive), member), COPY_BUFSIZE)
+
+    def load(self, path):
+        """Load a NIfTI image with nibabel, reading virtual paths in place.
+
+        Like `nibabel.load`, the image data are not read until accessed.
+        """
+        if not self.is_virtual(path):
+            return nib.load(path)
+
+        fileobj = self.open(path)
+        if str(path).endswith(".gz"):
+            fileobj = gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+        # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2, in either byte order
+        sizeof_hdr = fileobj.read(4)
+        fileobj.seek(0)
+        if 540 in struct.unpack("<i", sizeof_hdr) + struct.unpack(">i", sizeof_hdr):
+            return nib.Nifti2Image.from_stream(fileobj)
+        return nib.Nifti1Image.from_stream(fileobj)
+
+    def materialize(self, path):
+        """Copy a virtual member out to its path on disk, if not already there.
+
+        The copy is written to a temporary file and renamed into place, and the
+        path is no longer served from the archive afterwards.
+
+        Returns:
+            path (str): the (now real) path
+        """
+        path = os.path.abspath(path)
+        if path not in self._members:
+            return path
+
+        log.info("Materializing %s from %s", path, self._members[path].archive)
+        with self.open(path) as src:
+            copy_atomic(src, path)
+
+        del self._members[path]
+        return path
+
+    def close(self):
+        """Close all archive descriptors."""
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}